@@ -6,7 +6,7 @@ Handles checkout session creation and payment provider webhooks.
 
 from fastapi import APIRouter, Depends, HTTPException, Request
 from app.core.auth import get_current_user
-from app.core.usage import usage_tracker, TIER_LIMITS
+from app.core.usage import usage_tracker, usage_io, TIER_LIMITS
 from app.core.dodo_provider import dodo_provider
 import logging
 
@@ -66,10 +66,10 @@ async def dodo_webhook(request: Request):
     if result:
         email, new_tier = result
         # Find user by email and update their tier
-        user_record = usage_tracker.find_user_by_email(email)
+        user_record = await usage_io(usage_tracker.find_user_by_email, email)
         if user_record:
             sub, _ = user_record
-            usage_tracker.set_tier(sub, new_tier, provider="dodo")
+            await usage_io(usage_tracker.set_tier, sub, new_tier, provider="dodo")
             logger.info("Updated user %s to tier %s via Dodo webhook", sub, new_tier)
         else:
             logger.warning("Webhook received for unknown email: %s", email)
@@ -143,7 +143,7 @@ async def get_tiers():
 async def get_usage(user: dict = Depends(get_current_user)):
     """Return the current user's usage stats and tier info."""
     user_sub = user.get("sub", "")
-    user_record = usage_tracker.get_user(user_sub)
+    user_record = await usage_io(usage_tracker.get_user, user_sub)
 
     if not user_record:
         return {
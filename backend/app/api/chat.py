@@ -1,12 +1,33 @@
-from fastapi import APIRouter, HTTPException, Depends, Form, UploadFile, File, Request
+from fastapi import APIRouter, HTTPException, Depends, Form, UploadFile, File, Query, Request
 from fastapi.responses import JSONResponse
-from app.services.agent_orchestrator import process_chat_message
+from sse_starlette.sse import EventSourceResponse
+from starlette.background import BackgroundTask
+from app.services.agent_orchestrator import (
+    ROUTE_AGENT, ROUTE_CACHE, AgentResult, build_prompt_messages, get_openai_client,
+    process_chat_message, run_in_background, stream_chat_message, route_stats, with_attachment,
+)
+from app.core.config import settings
+from app.core.tracing import tracer
+from opentelemetry import trace
 from app.core.auth import get_current_user
 from datetime import datetime, timezone
+from typing import Optional, Tuple
+import asyncio
+import json
+import logging
 import uuid
 from app.models.history import ChatThreadModel, ChatMessageModel
-from app.services.history_service import history_service
-from app.core.usage import usage_tracker
+from app.services.history_service import HistoryService
+from app.services.answer_cache import answer_cache
+from app.services.context_budget import ContextWindow, context_budget
+from app.services.attachment_service import AttachmentError, ExtractedAttachment, SpooledUpload, attachment_service
+from app.services.attachment_index import chunk_index
+from app.services.admission import AdmissionRejected, admission
+from app.services.single_flight import as_follower_result, chat_flights, flight_key
+from app.core.usage import Reservation, usage_io, usage_tracker
+from app.core.token_accounting import estimate_turn, reconciliation
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
@@ -14,162 +35,597 @@ router = APIRouter()
 async def get_kernel(request: Request):
     return getattr(request.app.state, "ai_client", None)
 
+# Dependency: return the shared HistoryService initialised at app startup.
+async def get_history_service(request: Request) -> HistoryService:
+    return request.app.state.history_service
+
 @router.get("/history")
-async def get_history(user: dict = Depends(get_current_user)):
-    """Fetch all chat threads for the logged in user."""
+async def get_history(
+    limit: int = Query(50, ge=1, le=200),
+    continuation: Optional[str] = Query(None),
+    updated_since: Optional[datetime] = Query(None),
+    user: dict = Depends(get_current_user),
+    history_service: HistoryService = Depends(get_history_service),
+):
+    """
+    Fetch the logged in user's chat threads, most recently updated first, one page at a time.
+    Pass the returned `continuation` back to get the next page (it is null on the last page).
+    `updated_since` restricts the listing to threads changed after that time.
+    """
     user_sub = user.get("sub", "")
-    threads = history_service.get_user_threads(user_sub)
-    return {"threads": threads}
+    if updated_since is not None:
+        if updated_since.tzinfo is None:
+            updated_since = updated_since.replace(tzinfo=timezone.utc)
+        updated_since = updated_since.astimezone(timezone.utc).isoformat()
+
+    try:
+        threads, next_continuation = await history_service.get_user_threads(
+            user_sub, limit=limit, continuation=continuation, updated_since=updated_since
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"threads": threads, "continuation": next_continuation}
 
 @router.get("/history/{thread_id}")
-async def get_thread_history(thread_id: str, user: dict = Depends(get_current_user)):
-    """Fetch specific chat thread history."""
+async def get_thread_history(
+    thread_id: str,
+    limit: Optional[int] = Query(None, ge=1),
+    user: dict = Depends(get_current_user),
+    history_service: HistoryService = Depends(get_history_service),
+):
+    """
+    Fetch specific chat thread history.
+    With `limit`, only the newest stored chunks covering that many messages are loaded.
+    """
     user_sub = user.get("sub", "")
-    thread = history_service.get_thread(thread_id, user_sub)
+    thread = await history_service.get_thread(thread_id, user_sub, max_messages=limit)
     if not thread:
         raise HTTPException(status_code=404, detail="Thread not found")
-    return thread.model_dump()
+    return {
+        **thread.model_dump(),
+        "message_count": thread.message_count,
+        "message_offset": thread.message_offset,
+    }
+
+
+# ── Shared chat turn helpers ──────────────────────────────────
+
+def _quota_headers(remaining: Optional[int], daily_limit: Optional[int], tier: str) -> dict:
+    headers = {
+        "X-Tokens-Limit": str(daily_limit) if daily_limit else "unlimited",
+        "X-Tokens-Tier": tier,
+    }
+    if remaining is not None:
+        headers["X-Tokens-Remaining"] = str(remaining)
+    return headers
+
+
+async def _preflight(user: dict) -> Tuple[Optional[JSONResponse], str, Optional[int], Optional[Reservation]]:
+    """
+    Ensures the user exists, checks their daily budget and reserves
+    QUOTA_RESERVE_TOKENS of it for the turn (see app/core/quota.py).
+    Returns (quota_exceeded_response or None, tier, daily_limit, reservation).
+    The reservation must be settled by _finish_turn or released.
+    """
+    user_sub = user.get("sub", "")
+    await usage_io(usage_tracker.ensure_user, user_sub, name=user.get("name", ""), email=user.get("email", ""))
+
+    allowed, remaining, tier, daily_limit = await usage_io(usage_tracker.check_budget, user_sub)
+    if allowed:
+        # Concurrent turns (on any worker) each hold part of the budget, so they cannot all spend its last tokens.
+        reservation = await usage_io(usage_tracker.reserve, user_sub, settings.QUOTA_RESERVE_TOKENS)
+        if reservation is not None:
+            return None, tier, daily_limit, reservation
+
+    return JSONResponse(
+        status_code=429,
+        content={
+            "detail": "quota_exceeded",
+            "tier": tier,
+            "daily_limit": daily_limit,
+            "tokens_used": daily_limit,  # They've used it all
+        },
+        headers=_quota_headers(0, daily_limit, tier),
+    ), tier, daily_limit, None
+
+
+def _busy_response(rejected: AdmissionRejected, daily_limit: Optional[int], tier: str) -> JSONResponse:
+    """503 for a request the admission scheduler could not queue or admit in time."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "server_busy", "reason": rejected.reason, "retry_after": rejected.retry_after},
+        headers={**_quota_headers(None, daily_limit, tier), "Retry-After": str(rejected.retry_after)},
+    )
+
+
+class ClientDisconnected(Exception):
+    """The HTTP client went away before its turn finished."""
+
+
+# How often a blocking /chat request checks whether its client is still connected.
+DISCONNECT_POLL_SECONDS = 1.0
+
+
+async def _unless_disconnected(request: Request, awaitable):
+    """Await `awaitable`, cancelling it and raising ClientDisconnected if the client goes away first."""
+    work = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({work}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return work.result()
+            if await request.is_disconnected():
+                raise ClientDisconnected()
+    finally:
+        if not work.done():
+            work.cancel()
+            await asyncio.gather(work, return_exceptions=True)
+
+
+@tracer.start_as_current_span("chat.start_turn")
+async def _start_turn(
+    client,
+    history_service: HistoryService,
+    user_sub: str,
+    thread_id: Optional[str],
+    message: str,
+    file_name: Optional[str],
+) -> Tuple[ChatThreadModel, ContextWindow, Optional[list]]:
+    """
+    Loads (or creates) the thread, appends the user's message and builds the
+    bounded conversation context for the orchestrator (see context_budget.py).
+    Returns (thread, context, unsynced_history).
+    """
+    thread = None
+    if thread_id:
+        # Only the newest messages are needed, unless older ones still await summarisation.
+        thread = await history_service.get_thread(thread_id, user_sub, max_messages=context_budget.messages_to_load)
+        if thread and thread.message_offset > thread.summary_through:
+            thread = await history_service.get_thread(thread_id, user_sub)
+
+    if not thread:
+        # Create a new thread
+        safe_message = str(message)
+        thread_title = safe_message[:30] + "..." if len(safe_message) > 30 else safe_message
+        thread = ChatThreadModel(
+            user_id=user_sub,
+            title=thread_title,
+            created_at=datetime.now(timezone.utc).isoformat(),
+            updated_at=datetime.now(timezone.utc).isoformat(),
+            messages=[]
+        )
+
+    # Build user message model
+    user_msg = ChatMessageModel(
+        id=str(uuid.uuid4()),
+        role="user",
+        content=message,
+        timestamp=datetime.now(timezone.utc).isoformat(),
+        fileAttachment=file_name
+    )
+    thread.messages.append(user_msg)
+
+    # Newest prior messages verbatim, older ones as the thread's rolling summary
+    openai_client = await get_openai_client(client) if len(thread.messages) > 1 else None
+    context = await context_budget.prepare(openai_client, thread)
+
+    # The agent thread already holds everything up to agent_synced_count (an absolute index).
+    unsynced_history = None
+    if thread.agent_thread_id:
+        unsynced_history = context.history[max(0, thread.agent_synced_count - context.start):]
+    return thread, context, unsynced_history
+
+
+async def _spool_attachment(file: Optional[UploadFile]) -> Optional[SpooledUpload]:
+    """Copies an upload to a temporary file. Rejects unsupported or oversized files with 415/413."""
+    if not file:
+        return None
+    try:
+        return await attachment_service.spool(file)
+    except AttachmentError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
+@tracer.start_as_current_span("chat.extract_attachment")
+async def _extract_attachment(spooled: Optional[SpooledUpload]) -> Optional[ExtractedAttachment]:
+    """Extracts (or fetches cached) text for a spooled upload and indexes its chunks."""
+    if spooled is None:
+        return None
+    attachment = await attachment_service.extract(spooled)
+    await chunk_index.add_document(attachment)
+    return attachment
+
+
+@tracer.start_as_current_span("chat.attachment_context")
+async def _attachment_context(
+    thread: ChatThreadModel, message: str, attachment: Optional[ExtractedAttachment]
+) -> Optional[str]:
+    """
+    Attaches a new upload to the thread, then selects the chunks of the
+    thread's documents most relevant to this message (see attachment_index.py).
+    """
+    if attachment and attachment.sha256 not in thread.attachments:
+        thread.attachments.append(attachment.sha256)
+    if not thread.attachments:
+        return None
+    return await chunk_index.context_for(
+        thread.attachments, message, new_document=attachment.sha256 if attachment else None
+    )
+
+
+@tracer.start_as_current_span("chat.answer_cache")
+async def _lookup_answer(message: str, context: ContextWindow, file_name: Optional[str]):
+    """
+    Answer-cache lookup for the first turn of a conversation without attachments
+    (follow-ups depend on context the cache key does not capture).
+    Returns (cached result or None, probe to store the answer with, or None).
+    """
+    if context.history or context.summary or file_name:
+        return None, None
+    result, probe = await answer_cache.lookup(message)
+    trace.get_current_span().set_attribute("answer_cache.hit", result is not None)
+    return result, probe
+
+
+@tracer.start_as_current_span("chat.finish_turn")
+async def _finish_turn(
+    history_service: HistoryService,
+    user_sub: str,
+    prompt_message: str,
+    thread: ChatThreadModel,
+    result,
+    context: ContextWindow,
+    reservation: Optional[Reservation] = None,
+) -> dict:
+    """
+    Records token usage (settling the turn's reservation), appends the assistant reply and saves the thread.
+    `prompt_message` is the user message as sent to the model (with any attachment text).
+    Returns the response payload fields shared by the blocking and streaming endpoints.
+    """
+    # ── Record actual token usage ─────────────────────────
+    tokens_consumed = 0
+    model_name = "gpt-4o" # default fallback
+    usage_meta = None
+
+    if hasattr(result, 'metadata') and result.metadata:
+        usage_meta = result.metadata.get("usage")
+        model_name = result.metadata.get("model", "gpt-4o")
+        if usage_meta:
+            tokens_consumed = getattr(usage_meta, "total_tokens", 0)
+            if not tokens_consumed:
+                prompt_tokens = getattr(usage_meta, "prompt_tokens", 0)
+                completion_tokens = getattr(usage_meta, "completion_tokens", 0)
+                tokens_consumed = prompt_tokens + completion_tokens
+
+    # Cached answers carry their (reduced) charge; everything else is counted locally,
+    # to charge when no usage was reported and to reconcile against it when it was.
+    # Requests that shared a run are charged the same tokens as the request that led it.
+    reply_text = str(result)
+    if result.route != ROUTE_CACHE:
+        estimate = await estimate_turn(
+            build_prompt_messages(result.route, prompt_message, context.history, context.summary), reply_text
+        )
+        if tokens_consumed:
+            if not result.coalesced:
+                reconciliation.record(result.route, estimate, usage_meta)
+        else:
+            tokens_consumed = estimate.total_tokens
+
+    new_remaining = await usage_io(usage_tracker.record_usage, user_sub, tokens_consumed, reservation)
+    route_stats.record_tokens(result.route, tokens_consumed)
+    trace.get_current_span().set_attributes({
+        "chat.route": result.route,
+        "chat.coalesced": result.coalesced,
+        "chat.tokens_used": tokens_consumed,
+    })
+
+    # Build assistant message model
+    ai_msg = ChatMessageModel(
+        id=str(uuid.uuid4()),
+        role="assistant",
+        content=reply_text,
+        timestamp=datetime.now(timezone.utc).isoformat()
+    )
+    thread.messages.append(ai_msg)
+    thread.updated_at = datetime.now(timezone.utc).isoformat()
+
+    # A failed run leaves the user message on the agent thread but not our error text.
+    # Direct, cached and coalesced replies never reach this thread's agent thread;
+    # they stay unsynced until its next agent run.
+    if result.route == ROUTE_AGENT and not result.coalesced:
+        thread.agent_thread_id = result.thread_id
+        thread.agent_synced_count = thread.message_count - (0 if result.completed else 1)
+
+    # Save to Cosmos DB
+    saved_thread = await history_service.save_thread(thread)
+
+    return {
+        "reply": reply_text,
+        "sources": getattr(result, "sources", []) or [],
+        "thread_id": saved_thread.id,
+        "model": model_name,
+        "route": result.route,
+        "coalesced": result.coalesced,
+        "tokens_used": tokens_consumed,
+        "tokens_remaining": new_remaining,
+    }
+
+
+async def _abandon_turn(
+    history_service: HistoryService,
+    user_sub: str,
+    prompt_message: str,
+    thread: ChatThreadModel,
+    context: ContextWindow,
+    reservation: Optional[Reservation] = None,
+) -> None:
+    """
+    Bookkeeping for a turn whose client disconnected (its run has been cancelled).
+    Nothing is saved or charged unless CHAT_RECORD_DISCONNECTED is set.
+    """
+    logger.info(f"Client disconnected; turn on thread {thread.id} abandoned.")
+    if not settings.CHAT_RECORD_DISCONNECTED:
+        await usage_io(usage_tracker.release, reservation)
+        return
+    # No agent thread: the abandoned one has been discarded, so the next agent turn replays the history.
+    result = AgentResult(text="The request was cancelled.", usage_metadata={}, thread_id=None)
+    await _finish_turn(history_service, user_sub, prompt_message, thread, result, context, reservation)
+
 
 @router.post("/chat")
 async def chat_endpoint(
+    request: Request,
     message: str = Form(...),
     thread_id: str = Form(None),
     file: UploadFile = File(None),
     client = Depends(get_kernel),
+    history_service: HistoryService = Depends(get_history_service),
     user: dict = Depends(get_current_user)
 ):
     """
     Receives a chat message (and optional file) from the frontend and returns the AI's response.
     Enforces token-based daily quotas per user and saves to Cosmos DB history.
+    If the client disconnects before the answer is ready, the run is cancelled and
+    (by default) nothing is saved or charged.
     """
     user_sub = user.get("sub", "")
-    user_name = user.get("name", "")
-    user_email = user.get("email", "")
-
-    # Ensure user exists in usage tracker
-    usage_tracker.ensure_user(user_sub, name=user_name, email=user_email)
 
     # ── Pre-flight quota check ────────────────────────────────
-    allowed, remaining, tier, daily_limit = usage_tracker.check_budget(user_sub)
-    if not allowed:
-        return JSONResponse(
-            status_code=429,
-            content={
-                "detail": "quota_exceeded",
-                "tier": tier,
-                "daily_limit": daily_limit,
-                "tokens_used": daily_limit,  # They've used it all
-            },
-            headers={
-                "X-Tokens-Remaining": "0",
-                "X-Tokens-Limit": str(daily_limit) if daily_limit else "unlimited",
-                "X-Tokens-Tier": tier,
-            },
-        )
+    quota_response, tier, daily_limit, reservation = await _preflight(user)
+    if quota_response:
+        return quota_response
 
-    if not client:
-        raise HTTPException(
-            status_code=500, 
-            detail="Azure AI Project Connection String not configured properly in .env."
-        )
+    # Whatever happens below, a reservation the turn did not settle is handed back.
+    try:
+        if not client:
+            raise HTTPException(
+                status_code=500,
+                detail="Azure AI Project Connection String not configured properly in .env."
+            )
+
+        try:
+            admission.check(tier)
+        except AdmissionRejected as e:
+            return _busy_response(e, daily_limit, tier)
+
+        # Spool and extract the attachment up front so upload errors keep their 4xx status.
+        spooled = await _spool_attachment(file)
+        try:
+            attachment = await _extract_attachment(spooled)
+        except AttachmentError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        file_name = spooled.filename if spooled else None
+
+        try:
+            thread, context, unsynced_history = await _start_turn(
+                client, history_service, user_sub, thread_id, message, file_name
+            )
+            attachment_context = await _attachment_context(thread, message, attachment)
+
+            result, cache_probe = await _lookup_answer(message, context, file_name)
+            cache_hit = result is not None
+
+            async def run_turn():
+                async with admission.slot(tier):
+                    return await process_chat_message(
+                        client, message, attachment_context,
+                        history=context.history,
+                        agent_thread_id=thread.agent_thread_id,
+                        unsynced_history=unsynced_history,
+                        context_summary=context.summary,
+                    )
+
+            if not cache_hit:
+                # Identical concurrent turns share one run (see single_flight.py); runs wait for a slot.
+                # If the client disconnects meanwhile, its run is cancelled (unless others share it).
+                try:
+                    result = await _unless_disconnected(request, chat_flights.run(
+                        flight_key(message, context.history, context.summary, attachment_context), run_turn
+                    ))
+                except ClientDisconnected:
+                    await _abandon_turn(
+                        history_service, user_sub, with_attachment(message, attachment_context), thread, context,
+                        reservation,
+                    )
+                    return JSONResponse(status_code=499, content={"detail": "client_disconnected"})
+            if not result:
+                 raise Exception("Empty response from AI")
+
+            turn = await _finish_turn(
+                history_service, user_sub, with_attachment(message, attachment_context), thread, result, context,
+                reservation,
+            )
+            if cache_probe and not cache_hit and not result.coalesced:
+                await answer_cache.store(cache_probe, result, turn["tokens_used"])
 
+            response = JSONResponse(
+                content={
+                    "reply": turn["reply"],
+                    "sources": turn["sources"],
+                    "thread_id": turn["thread_id"],
+                    "model": turn["model"]
+                },
+                headers={
+                    **_quota_headers(turn["tokens_remaining"], daily_limit, tier),
+                    "X-Tokens-Used": str(turn["tokens_used"]),
+                    "X-Answer-Cache": "HIT" if cache_hit else "MISS",
+                    "X-Coalesced": "true" if turn["coalesced"] else "false",
+                    "X-Chat-Route": turn["route"],
+                },
+            )
+            return response
+
+        except AdmissionRejected as e:
+            return _busy_response(e, daily_limit, tier)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+    finally:
+        await usage_io(usage_tracker.release, reservation)
+
+
+@router.post("/chat/stream")
+async def chat_stream_endpoint(
+    message: str = Form(...),
+    thread_id: str = Form(None),
+    file: UploadFile = File(None),
+    client = Depends(get_kernel),
+    history_service: HistoryService = Depends(get_history_service),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Server-Sent Events variant of /chat.
+
+    Emits `search` (Bing tool progress), `delta` (answer text), and `citation`
+    events while the agent run is in flight. Quota is charged and the thread is
+    saved once the run finishes, after which a final `done` event carries the
+    same fields as the /chat response plus the token counters. Failures are
+    reported as an `error` event. With an uploaded file, an `attachment` event
+    is sent first, once its text has been extracted. If the client disconnects
+    mid-run, the run is cancelled and (by default) nothing is saved or charged.
+    """
+    user_sub = user.get("sub", "")
+
+    quota_response, tier, daily_limit, reservation = await _preflight(user)
+    if quota_response:
+        return quota_response
+
+    # Until the stream takes over the reservation, any early exit hands it back.
     try:
-        # Read the file content if provided
-        file_content = await file.read() if file else None
-        file_name = file.filename if file else None
-        file_content_type = file.content_type if file else None
-
-        # Try to load existing thread
-        thread = None
-        if thread_id:
-            thread = history_service.get_thread(thread_id, user_sub)
-            
-        if not thread:
-            # Create a new thread
-            safe_message = str(message)
-            thread_title = safe_message[:30] + "..." if len(safe_message) > 30 else safe_message
-            thread = ChatThreadModel(
-                user_id=user_sub,
-                title=thread_title,
-                created_at=datetime.now(timezone.utc).isoformat(),
-                updated_at=datetime.now(timezone.utc).isoformat(),
-                messages=[]
+        if not client:
+            raise HTTPException(
+                status_code=500,
+                detail="Azure AI Project Connection String not configured properly in .env."
             )
 
-        # Build user message model
-        user_msg = ChatMessageModel(
-            id=str(uuid.uuid4()),
-            role="user",
-            content=message,
-            timestamp=datetime.now(timezone.utc).isoformat(),
-            fileAttachment=file_name
-        )
-        thread.messages.append(user_msg)
+        try:
+            admission.check(tier)
+        except AdmissionRejected as e:
+            await usage_io(usage_tracker.release, reservation)
+            return _busy_response(e, daily_limit, tier)
 
-        # Build conversation history from prior thread messages (exclude the message just appended)
-        history = [
-            {"role": m.role, "content": m.content}
-            for m in thread.messages[:-1]
-            if m.role in ("user", "assistant")
-        ]
+        # The upload is only readable while the request is being handled; extraction happens in the stream.
+        spooled = await _spool_attachment(file)
+        file_name = spooled.filename if spooled else None
+    except BaseException:
+        await usage_io(usage_tracker.release, reservation)
+        raise
 
-        result = await process_chat_message(
-            client, message, file_content, file_name, file_content_type, history=history
-        )
-        if not result:
-             raise Exception("Empty response from AI")
-
-        # ── Record actual token usage ─────────────────────────
-        tokens_consumed = 0
-        model_name = "gpt-4o" # default fallback
-        
-        if hasattr(result, 'metadata') and result.metadata:
-            usage_meta = result.metadata.get("usage")
-            model_name = result.metadata.get("model", "gpt-4o")
-            if usage_meta:
-                tokens_consumed = getattr(usage_meta, "total_tokens", 0)
-                if not tokens_consumed:
-                    prompt_tokens = getattr(usage_meta, "prompt_tokens", 0)
-                    completion_tokens = getattr(usage_meta, "completion_tokens", 0)
-                    tokens_consumed = prompt_tokens + completion_tokens
-
-        # Fallback estimate if metadata unavailable
-        reply_text = str(result)
-        if tokens_consumed == 0:
-            tokens_consumed = max(100, len(message) // 2 + len(reply_text) // 2)
-
-        new_remaining = usage_tracker.record_usage(user_sub, tokens_consumed)
-
-        # Build assistant message model
-        ai_msg = ChatMessageModel(
-            id=str(uuid.uuid4()),
-            role="assistant",
-            content=reply_text,
-            timestamp=datetime.now(timezone.utc).isoformat()
-        )
-        thread.messages.append(ai_msg)
-        thread.updated_at = datetime.now(timezone.utc).isoformat()
-        
-        # Save to Cosmos DB
-        saved_thread = history_service.save_thread(thread)
-
-        sources = getattr(result, "sources", []) or []
-
-        response = JSONResponse(
-            content={
-                "reply": reply_text,
-                "sources": sources,
-                "thread_id": saved_thread.id,
-                "model": model_name
-            },
-            headers={
-                "X-Tokens-Remaining": str(new_remaining),
-                "X-Tokens-Limit": str(daily_limit) if daily_limit else "unlimited",
-                "X-Tokens-Tier": tier,
-                "X-Tokens-Used": str(tokens_consumed),
-            },
-        )
-        return response
+    async def event_source():
+        thread = context = attachment_context = None
+        finished = abandoned = False
+        try:
+            attachment = await _extract_attachment(spooled)
+            if attachment:
+                yield {
+                    "event": "attachment",
+                    "data": json.dumps({"filename": attachment.filename, "cached": attachment.cached}),
+                }
+
+            thread, context, unsynced_history = await _start_turn(
+                client, history_service, user_sub, thread_id, message, file_name
+            )
+            attachment_context = await _attachment_context(thread, message, attachment)
+
+            result, cache_probe = await _lookup_answer(message, context, file_name)
+            cache_hit = result is not None
+            key = flight_key(message, context.history, context.summary, attachment_context)
+            flight = None if cache_hit else chat_flights.follow(key)
+            if flight is not None:
+                # An identical turn is already running: wait for its result (or run our own if it fails).
+                result = as_follower_result(await chat_flights.wait(flight))
+
+            if result is not None:
+                # Replay a cached or shared answer in the same event shape as a live run.
+                yield {"event": "delta", "data": json.dumps({"text": result.text})}
+                for url in result.sources:
+                    yield {"event": "citation", "data": json.dumps({"url": url, "title": None})}
+            else:
+                chat_flights.lead(key)
+                try:
+                    async with admission.slot(tier):
+                        async for event, payload in stream_chat_message(
+                            client, message,
+                            history=context.history,
+                            agent_thread_id=thread.agent_thread_id,
+                            unsynced_history=unsynced_history,
+                            context_summary=context.summary,
+                            attachment_context=attachment_context,
+                        ):
+                            if event == "result":
+                                result = payload
+                            else:
+                                yield {"event": event, "data": json.dumps(payload)}
+                finally:
+                    chat_flights.finish(key, result)
+
+            if not result:
+                raise Exception("Empty response from AI")
+
+            turn = await _finish_turn(
+                history_service, user_sub, with_attachment(message, attachment_context), thread, result, context,
+                reservation,
+            )
+            finished = True
+            if cache_probe and not cache_hit and not result.coalesced:
+                await answer_cache.store(cache_probe, result, turn["tokens_used"])
+            yield {
+                "event": "done",
+                "data": json.dumps({
+                    **turn,
+                    "cached": cache_hit,
+                    "tokens_limit": daily_limit,
+                    "tier": tier,
+                }),
+            }
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client disconnected: the run has been cancelled by the orchestrator.
+            if thread is not None and not finished:
+                abandoned = True  # _abandon_turn settles or releases the reservation
+                run_in_background(_abandon_turn(
+                    history_service, user_sub, with_attachment(message, attachment_context), thread, context,
+                    reservation,
+                ))
+            raise
+        except AdmissionRejected as e:
+            yield {
+                "event": "error",
+                "data": json.dumps({"detail": "server_busy", "reason": e.reason, "retry_after": e.retry_after}),
+            }
+        except Exception as e:
+            logger.error(f"Error in chat stream: {e}", exc_info=True)
+            yield {"event": "error", "data": json.dumps({"detail": f"Error processing chat: {str(e)}"})}
+        finally:
+            if spooled:
+                spooled.discard()  # no-op once extracted
+            if not abandoned and reservation is not None and not reservation.settled:
+                # Detached: after a disconnect this generator is being cancelled, and so would an await here.
+                run_in_background(usage_io(usage_tracker.release, reservation))
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing chat: {str(e)}")
+    # The generator's finally never runs if the client goes away before the stream starts;
+    # the response's background task removes the spooled upload in every case.
+    return EventSourceResponse(
+        event_source(),
+        headers=_quota_headers(None, daily_limit, tier),
+        background=BackgroundTask(spooled.discard) if spooled else None,
+    )
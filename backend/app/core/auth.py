@@ -1,47 +1,191 @@
+import asyncio
+import hashlib
+import logging
+import time
 import jwt
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Dict, Any, Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jwt import PyJWKClient
+from opentelemetry import trace
+from app.core.config import settings
+from app.core.tracing import tracer
+
+logger = logging.getLogger(__name__)
 
 security = HTTPBearer()
 
 # Entra External ID CIAM Tenant Details
 CLIENT_ID = "b2d79546-175d-4a3e-9e0a-466bd6d291b6"
 TENANT_ID = "46f1d642-3c77-472b-8482-58028085c788"
+ISSUER = f"https://{TENANT_ID}.ciamlogin.com/{TENANT_ID}/v2.0"
 
 # The discovery endpoint for the JWKS keys provided by Microsoft Entra ID
 JWKS_URL = f"https://compliancechat.ciamlogin.com/{TENANT_ID}/discovery/v2.0/keys"
-jwks_client = PyJWKClient(JWKS_URL)
+jwks_client = PyJWKClient(JWKS_URL, cache_jwk_set=False)
+
+
+class JWKSCache:
+    """
+    Entra ID signing keys, indexed by `kid`.
+
+    The key set is fetched at startup and refreshed every JWKS_REFRESH_SECONDS
+    by a background task, so requests never wait on the JWKS endpoint. A token
+    signed with an unknown `kid` (key rollover) triggers one immediate refresh,
+    shared by all concurrent requests and rate-limited to one per
+    JWKS_MIN_REFRESH_INTERVAL seconds. PyJWKClient does blocking HTTP, so
+    fetches run in a worker thread.
+    """
+
+    def __init__(self, client: PyJWKClient, refresh_seconds: int = 3600, min_refresh_interval: int = 60):
+        self._client = client
+        self._refresh_seconds = refresh_seconds
+        self._min_refresh_interval = min_refresh_interval
+        self._keys: Dict[str, Any] = {}
+        self._lock = asyncio.Lock()
+        self._last_refresh = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self.refreshes = 0
+
+    async def start(self) -> None:
+        """Prefetch the key set and start the background refresh (called from the app lifespan)."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("JWKS prefetch failed, keys will be fetched on first use: %s", e)
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def refresh(self) -> None:
+        jwk_set = await asyncio.to_thread(self._client.get_jwk_set, True)
+        self._keys = {key.key_id: key for key in jwk_set.keys if key.public_key_use in ("sig", None)}
+        self._last_refresh = time.monotonic()
+        self.refreshes += 1
+        logger.info("JWKS refreshed: %d signing key(s).", len(self._keys))
+
+    async def get_signing_key(self, kid: Optional[str]):
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        async with self._lock:
+            # Another request may have refreshed while we waited for the lock.
+            key = self._keys.get(kid)
+            if key is None and time.monotonic() - self._last_refresh >= self._min_refresh_interval:
+                await self.refresh()
+                key = self._keys.get(kid)
+        if key is None:
+            raise jwt.exceptions.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+        return key
+
+    def stats(self) -> dict:
+        return {"keys": len(self._keys), "refreshes": self.refreshes}
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Background JWKS refresh failed, keeping current keys: %s", e)
+
 
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
+class VerifiedTokenCache:
+    """
+    Bounded LRU of tokens that already passed signature and claim checks,
+    keyed by the token's SHA-256 and dropped once the token's `exp` passes.
+    """
+
+    def __init__(self, max_entries: int = 10_000):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, user: Dict[str, Any], expires_at: Optional[float]) -> None:
+        if not expires_at:
+            return
+        self._entries[key] = (expires_at, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+jwks_cache = JWKSCache(
+    jwks_client,
+    refresh_seconds=settings.JWKS_REFRESH_SECONDS,
+    min_refresh_interval=settings.JWKS_MIN_REFRESH_INTERVAL,
+)
+token_cache = VerifiedTokenCache(max_entries=settings.JWT_CACHE_MAX_ENTRIES)
+
+
+@tracer.start_as_current_span("auth.verify_token")
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> Dict[str, Any]:
     """
     Validates the Bearer token sent in the Authorization header against
     Microsoft Entra External ID's public signing keys.
-    
+
+    Tokens seen before (and not yet expired) are served from the verified-token
+    cache without repeating the RS256 verification.
+
     Returns a dict with: sub, name, email (extracted from JWT claims).
     """
     token = credentials.credentials
+    cache_key = VerifiedTokenCache.key(token)
+    cached = token_cache.get(cache_key)
+    trace.get_current_span().set_attribute("auth.cache_hit", cached is not None)
+    if cached is not None:
+        return dict(cached)
+
     try:
-        # Fetch the signing key from the JWKS matching the token's kid header
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
-        
+        # Look up the signing key matching the token's kid header
+        signing_key = await jwks_cache.get_signing_key(jwt.get_unverified_header(token).get("kid"))
+
         # Verify and decode the token
         payload = jwt.decode(
             token,
             key=signing_key.key,
             algorithms=["RS256"],
             audience=CLIENT_ID,
-            issuer=f"https://{TENANT_ID}.ciamlogin.com/{TENANT_ID}/v2.0"
+            issuer=ISSUER
         )
 
         # Return structured user info
-        return {
+        user = {
             "sub": payload.get("sub", ""),
             "name": payload.get("name", ""),
             "email": payload.get("email", payload.get("preferred_username", "")),
             "raw": payload,
         }
+        token_cache.put(cache_key, user, payload.get("exp"))
+        return dict(user)
 
     except jwt.exceptions.PyJWKClientError as error:
         print(f"JWT PyJWKClientError: {error}")
@@ -21,6 +21,87 @@ class Settings:
     AZURE_COSMOS_DATABASE = os.getenv("AZURE_COSMOS_DATABASE", "ComplianceDB")
     AZURE_COSMOS_CONTAINER = os.getenv("AZURE_COSMOS_CONTAINER", "ChatHistory")
 
+    # Usage tracking store: "jsonlog" (in-memory + append log) or "sqlite"
+    USAGE_STORE_BACKEND = os.getenv("USAGE_STORE_BACKEND", "jsonlog")
+    USAGE_LOG_COMPACT_EVERY = int(os.getenv("USAGE_LOG_COMPACT_EVERY", "10000"))
+    # Write-behind: changed usage records are flushed every N ms, or once N are pending;
+    # up to N flushed records stay cached in memory
+    USAGE_FLUSH_INTERVAL_MS = int(os.getenv("USAGE_FLUSH_INTERVAL_MS", "500"))
+    USAGE_FLUSH_MAX_PENDING = int(os.getenv("USAGE_FLUSH_MAX_PENDING", "256"))
+    USAGE_CACHE_MAX_ENTRIES = int(os.getenv("USAGE_CACHE_MAX_ENTRIES", "100000"))
+
+    # Quota enforcement: "local" (one process), "sqlite" (workers on one host, QUOTA_SQLITE_PATH)
+    # or "cosmos" (replicas, QUOTA_COSMOS_CONTAINER in AZURE_COSMOS_DATABASE)
+    QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "local").lower()
+    QUOTA_SQLITE_PATH = os.getenv("QUOTA_SQLITE_PATH", "")
+    QUOTA_COSMOS_CONTAINER = os.getenv("QUOTA_COSMOS_CONTAINER", "UserQuota")
+    # Tokens reserved against the budget when a turn starts, settled to the actual count afterwards
+    QUOTA_RESERVE_TOKENS = int(os.getenv("QUOTA_RESERVE_TOKENS", "3000"))
+
+    # Authentication: JWKS refresh cadence and verified-token cache size
+    JWKS_REFRESH_SECONDS = int(os.getenv("JWKS_REFRESH_SECONDS", "3600"))
+    JWKS_MIN_REFRESH_INTERVAL = int(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "60"))
+    JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", "10000"))
+
+    # Turn routing: send follow-ups that only rework earlier answers to a no-tool completion
+    ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "true").lower() == "true"
+    # Ask AZURE_OPENAI_CHAT_DEPLOYMENT to classify turns the rules cannot decide
+    ROUTER_MODEL_CLASSIFIER = os.getenv("ROUTER_MODEL_CLASSIFIER", "false").lower() == "true"
+
+    # Context budget: newest messages sent verbatim, older ones folded into a rolling summary
+    CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "8000"))
+    CONTEXT_KEEP_MESSAGES = int(os.getenv("CONTEXT_KEEP_MESSAGES", "8"))
+    CONTEXT_FOLD_BATCH = int(os.getenv("CONTEXT_FOLD_BATCH", "4"))
+    CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "800"))
+
+    # Attachments: upload size cap, extraction worker processes, chunking and prompt budget (tokens)
+    ATTACHMENT_MAX_BYTES = int(os.getenv("ATTACHMENT_MAX_BYTES", str(25 * 1024 * 1024)))
+    ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", "2"))
+    ATTACHMENT_CHUNK_TOKENS = int(os.getenv("ATTACHMENT_CHUNK_TOKENS", "800"))
+    ATTACHMENT_PROMPT_TOKENS = int(os.getenv("ATTACHMENT_PROMPT_TOKENS", "6000"))
+    ATTACHMENT_TOP_K = int(os.getenv("ATTACHMENT_TOP_K", "6"))
+    ATTACHMENT_MIN_SCORE = float(os.getenv("ATTACHMENT_MIN_SCORE", "0.25"))
+    # Disk budgets for the extracted-text cache and the vector index (least recently used evicted first)
+    ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+    ATTACHMENT_INDEX_MAX_BYTES = int(os.getenv("ATTACHMENT_INDEX_MAX_BYTES", str(1024 * 1024 * 1024)))
+    ATTACHMENT_CACHE_MAX_AGE_DAYS = float(os.getenv("ATTACHMENT_CACHE_MAX_AGE_DAYS", "30"))
+
+    # Answer cache for repeated first-turn queries
+    ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+    # Cosine similarity above which a differently-worded query reuses an answer (embeddings)
+    ANSWER_CACHE_SEMANTIC = os.getenv("ANSWER_CACHE_SEMANTIC", "true").lower() == "true"
+    ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+    # Fraction of the original run's tokens charged for a cached answer
+    ANSWER_CACHE_CHARGE_RATIO = float(os.getenv("ANSWER_CACHE_CHARGE_RATIO", "0.1"))
+
+    # Admission control for chat runs: concurrent runs, waiting requests, longest wait (seconds),
+    # and each tier's share of freed slots ("tier:weight,...")
+    ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "16"))
+    ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+    ADMISSION_TIER_WEIGHTS = os.getenv("ADMISSION_TIER_WEIGHTS", "free:1,pro:2,max:4,elite:8")
+
+    # Agent run driver: overall ceiling, longest stall without a new run step, adaptive poll interval bounds
+    RUN_TIMEOUT_SECONDS = float(os.getenv("RUN_TIMEOUT_SECONDS", "120"))
+    RUN_STEP_TIMEOUT_SECONDS = float(os.getenv("RUN_STEP_TIMEOUT_SECONDS", "60"))
+    RUN_POLL_INITIAL_SECONDS = float(os.getenv("RUN_POLL_INITIAL_SECONDS", "0.25"))
+    RUN_POLL_MAX_SECONDS = float(os.getenv("RUN_POLL_MAX_SECONDS", "3"))
+
+    # Agents registered with a different definition (e.g. by workers still on the previous deploy)
+    # are kept this long after a worker first finds them superseded, then deleted
+    AGENT_STALE_GRACE_SECONDS = int(os.getenv("AGENT_STALE_GRACE_SECONDS", "86400"))
+
+    # Client disconnects: the run is always cancelled; optionally still save the user's message
+    # (with a "cancelled" reply) and charge the estimated prompt tokens
+    CHAT_RECORD_DISCONNECTED = os.getenv("CHAT_RECORD_DISCONNECTED", "false").lower() == "true"
+
+    # Tracing: "none", "console", "otlp" or "memory" (see app/core/tracing.py)
+    TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+
+    # Operator bearer token for GET /stats (internal service state); empty disables the endpoint
+    STATS_TOKEN = os.getenv("STATS_TOKEN", "")
+
     # Billing / Dodo Payments
     DODO_PAYMENTS_API_KEY = os.getenv("DODO_PAYMENTS_API_KEY", "")
     DODO_WEBHOOK_SECRET = os.getenv("DODO_WEBHOOK_SECRET", "")
@@ -0,0 +1,218 @@
+"""
+In-process metrics in the Prometheus text exposition format.
+
+Recording is a dict update in the calling thread under a per-metric lock
+(usage charges are recorded from worker threads): no I/O and no awaiting,
+so the hot path never blocks the event loop. Latency quantiles
+(p50/p95/p99) are computed at scrape time from a bounded window of the most
+recent observations per label set.
+
+Counters owned by the services (cache hits, Cosmos RU, admission queues) are
+not duplicated here; /metrics reads them from their stats objects when
+scraped, as MetricFamily values (see app/main.py).
+"""
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+QUANTILES = (0.5, 0.95, 0.99)
+SUMMARY_WINDOW = 2048
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+class MetricFamily:
+    """One metric name with its samples, ready to render."""
+
+    def __init__(self, name: str, kind: str, help_text: str):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.samples: List[Tuple[str, Dict[str, object], float]] = []
+
+    def add(self, value: float, suffix: str = "", **labels) -> "MetricFamily":
+        self.samples.append((self.name + suffix, labels, value))
+        return self
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, object]:
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> MetricFamily:
+        family = MetricFamily(self.name, self.kind, self.help)
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            family.add(value, **self._labels(key))
+        return family
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Summary(_Metric):
+    """Count, sum and windowed quantiles of observations (e.g. request latency)."""
+
+    kind = "summary"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (), window: int = SUMMARY_WINDOW):
+        super().__init__(name, help_text, labelnames)
+        self._window = window
+        self._series: Dict[tuple, list] = {}  # key -> [count, sum, recent observations]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0, 0.0, deque(maxlen=self._window)]
+            series[0] += 1
+            series[1] += value
+            series[2].append(value)
+
+    def collect(self) -> MetricFamily:
+        family = MetricFamily(self.name, self.kind, self.help)
+        with self._lock:
+            snapshot = [(key, count, total, list(recent)) for key, (count, total, recent) in self._series.items()]
+        for key, count, total, recent in snapshot:
+            labels = self._labels(key)
+            ordered = sorted(recent)
+            for q in QUANTILES:
+                if ordered:
+                    family.add(ordered[min(len(ordered) - 1, int(q * len(ordered)))], **labels, quantile=q)
+            family.add(total, "_sum", **labels)
+            family.add(count, "_count", **labels)
+        return family
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labelnames))
+
+    def summary(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Summary:
+        return self._register(Summary(name, help_text, labelnames))
+
+    def render(self, extra: Iterable[MetricFamily] = ()) -> str:
+        families = [metric.collect() for metric in self._metrics.values()] + list(extra)
+        return "\n".join(family.render() for family in families) + "\n"
+
+    def _register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+
+registry = MetricsRegistry()
+
+# ── Hot-path metrics ────────────────────────────────────────
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route template and status.", ("method", "route", "status")
+)
+http_latency = registry.summary(
+    "http_request_duration_seconds", "HTTP request latency (streams: until the stream ends).", ("method", "route")
+)
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being handled.")
+agent_runs_in_flight = registry.gauge("agent_runs_in_flight", "Agent runs currently executing.")
+agent_run_status = registry.counter(
+    "agent_runs_total", "Finished agent runs by final status.", ("status",)
+)
+tier_tokens = registry.counter(
+    "tokens_consumed_total", "Tokens charged to user quotas, by tier.", ("tier",)
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request rate, latency and concurrency per route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+        http_in_flight.inc()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_in_flight.dec()
+            route = scope.get("route")
+            # Unmatched paths share one label value so scanners cannot blow up the series count.
+            template = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "GET")
+            http_requests.inc(method=method, route=template, status=status)
+            http_latency.observe(time.perf_counter() - start, method=method, route=template)
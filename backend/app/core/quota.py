@@ -0,0 +1,518 @@
+"""
+Quota enforcement shared by several workers or replicas.
+
+UsageTracker keeps each user's record in one process's memory, so with more
+than one uvicorn worker (or container replica) every process enforces the
+budget against its own copy and they overwrite each other's files.
+SharedUsageTracker has the same interface but keeps no state of its own:
+
+- a user's daily usage is a counter row (sub, day) holding `used` and
+  `reserved` tokens, changed only by atomic increments in the database;
+- a turn reserves an estimate (QUOTA_RESERVE_TOKENS) before it runs. The
+  reservation is a conditional increment that fails once used + reserved
+  tokens reach the tier limit, so concurrent turns on different workers
+  cannot all spend the last tokens of a budget;
+- afterwards the reservation is settled in one increment (used += actual,
+  reserved -= estimate) or released if the turn failed.
+
+No lock is held across requests; each step is a single statement (SQLite
+upsert) or a single patch (Cosmos DB `incr` with a filter predicate).
+Counters are per UTC day, so there is no reset step to race on.
+
+Switching QUOTA_BACKEND away from "local" imports the existing usage store
+(USAGE_STORE_BACKEND: profiles, tiers and today's usage) once, on the first
+start; a marker profile records that it ran. If the import fails the app
+does not start, rather than dropping paid users to the free tier.
+
+Backends (QUOTA_BACKEND):
+  - "sqlite": one database file shared by the workers of a host (WAL mode);
+    also the stand-in for Cosmos DB in tests and benchmarks;
+  - "cosmos": a container partitioned by /sub, reached with the synchronous
+    SDK (calls run in worker threads, see usage_io); counter documents
+    expire after two days via TTL.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from opentelemetry import trace
+
+from app.core.config import settings
+from app.core.metrics import tier_tokens
+from app.core.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+COUNTER_TTL_SECONDS = 2 * 24 * 3600
+# Profile written once the legacy usage store has been imported.
+IMPORT_MARKER = "__usage_store_import__"
+PROFILE_FIELDS = ("email", "name", "tier", "payment_provider", "payment_customer_id", "created_at")
+
+
+class Reservation:
+    """
+    Tokens held against a user's daily budget while a turn runs. Settle it with
+    record_usage(..., reservation) once the actual count is known, or release() it.
+    """
+
+    __slots__ = ("sub", "day", "tokens", "settled")
+
+    def __init__(self, sub: str, day: str, tokens: int):
+        self.sub = sub
+        self.day = day
+        self.tokens = tokens
+        self.settled = False
+
+
+def _email_key(email: str) -> str:
+    return (email or "").strip().casefold()
+
+
+class QuotaCounters(ABC):
+    """
+    User profiles plus atomic per-day token counters.
+    Implementations must be safe to call from several threads and processes.
+    """
+
+    @abstractmethod
+    def get_profile(self, sub: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def add_profile(self, sub: str, profile: dict) -> bool:
+        """Insert a profile unless one exists. Returns False if another caller got there first."""
+        ...
+
+    @abstractmethod
+    def put_profile(self, sub: str, profile: dict) -> None:
+        ...
+
+    @abstractmethod
+    def find_profile_by_email(self, email: str) -> Optional[Tuple[str, dict]]:
+        """The earliest-created user registered with `email` (case-insensitive)."""
+        ...
+
+    @abstractmethod
+    def get_counter(self, sub: str, day: str) -> Tuple[int, int]:
+        """(used, reserved) tokens for the day; zeros if nothing was recorded."""
+        ...
+
+    @abstractmethod
+    def try_reserve(self, sub: str, day: str, tokens: int, limit: Optional[int]) -> bool:
+        """Atomically add `tokens` to reserved, only while used + reserved < limit (None: always)."""
+        ...
+
+    @abstractmethod
+    def settle(self, sub: str, day: str, used: int, reserved: int) -> int:
+        """Atomically add `used` and subtract `reserved`. Returns the day's new used total."""
+        ...
+
+    def close(self) -> None:
+        """Release connections."""
+
+
+class SQLiteQuotaCounters(QuotaCounters):
+    """
+    Counters and profiles in one SQLite database that every worker opens.
+    Each thread gets its own connection; WAL mode lets readers run alongside
+    the single writer, and busy_timeout queues writers from other processes.
+    """
+
+    def __init__(self, db_path: str, busy_timeout_ms: int = 5000):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db_path = db_path
+        self._busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_users ("
+            "sub TEXT PRIMARY KEY, email_key TEXT, created_at TEXT, profile TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS quota_users_email ON quota_users (email_key, created_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_daily ("
+            "sub TEXT NOT NULL, day TEXT NOT NULL, used INTEGER NOT NULL DEFAULT 0, "
+            "reserved INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (sub, day))"
+        )
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=2)).strftime("%Y-%m-%d")
+        conn.execute("DELETE FROM quota_daily WHERE day < ?", (cutoff,))
+
+    def get_profile(self, sub: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT profile FROM quota_users WHERE sub = ?", (sub,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_profile(self, sub: str, profile: dict) -> bool:
+        cursor = self._conn().execute(
+            "INSERT INTO quota_users (sub, email_key, created_at, profile) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(sub) DO NOTHING",
+            (sub, _email_key(profile.get("email", "")), profile.get("created_at"), json.dumps(profile)),
+        )
+        return cursor.rowcount == 1
+
+    def put_profile(self, sub: str, profile: dict) -> None:
+        self._conn().execute(
+            "INSERT INTO quota_users (sub, email_key, created_at, profile) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(sub) DO UPDATE SET email_key = excluded.email_key, profile = excluded.profile",
+            (sub, _email_key(profile.get("email", "")), profile.get("created_at"), json.dumps(profile)),
+        )
+
+    def find_profile_by_email(self, email: str) -> Optional[Tuple[str, dict]]:
+        row = self._conn().execute(
+            "SELECT sub, profile FROM quota_users WHERE email_key = ? ORDER BY created_at LIMIT 1",
+            (_email_key(email),),
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def get_counter(self, sub: str, day: str) -> Tuple[int, int]:
+        row = self._conn().execute(
+            "SELECT used, reserved FROM quota_daily WHERE sub = ? AND day = ?", (sub, day)
+        ).fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    def try_reserve(self, sub: str, day: str, tokens: int, limit: Optional[int]) -> bool:
+        if limit is not None and limit <= 0:
+            return False
+        cursor = self._conn().execute(
+            "INSERT INTO quota_daily (sub, day, used, reserved) VALUES (?, ?, 0, ?) "
+            "ON CONFLICT(sub, day) DO UPDATE SET reserved = reserved + excluded.reserved "
+            "WHERE ? IS NULL OR used + reserved < ?",
+            (sub, day, tokens, limit, limit),
+        )
+        return cursor.rowcount == 1
+
+    def settle(self, sub: str, day: str, used: int, reserved: int) -> int:
+        row = self._conn().execute(
+            "INSERT INTO quota_daily (sub, day, used, reserved) VALUES (?, ?, ?, 0) "
+            "ON CONFLICT(sub, day) DO UPDATE SET used = used + excluded.used, reserved = MAX(0, reserved - ?) "
+            "RETURNING used",
+            (sub, day, used, reserved),
+        ).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit: every statement is its own transaction.
+            conn = sqlite3.connect(self._db_path, isolation_level=None, check_same_thread=False)
+            conn.execute(f"PRAGMA busy_timeout={int(self._busy_timeout_ms)}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+
+class CosmosQuotaCounters(QuotaCounters):
+    """
+    One Cosmos DB container partitioned by /sub: a "profile" document per user
+    and a "day-YYYY-MM-DD" counter document per user and day. Counters are only
+    changed with patch `incr` operations, so concurrent writers never overwrite
+    each other; the reservation's limit check is the patch's filter predicate.
+    """
+
+    def __init__(self, container):
+        self._container = container
+
+    def get_profile(self, sub: str) -> Optional[dict]:
+        try:
+            return self._container.read_item(item="profile", partition_key=sub)["profile"]
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    def add_profile(self, sub: str, profile: dict) -> bool:
+        try:
+            self._container.create_item(body=self._profile_doc(sub, profile))
+            return True
+        except exceptions.CosmosResourceExistsError:
+            return False
+
+    def put_profile(self, sub: str, profile: dict) -> None:
+        self._container.upsert_item(body=self._profile_doc(sub, profile))
+
+    def find_profile_by_email(self, email: str) -> Optional[Tuple[str, dict]]:
+        # Cross-partition, but only billing webhooks look users up by email.
+        items = self._container.query_items(
+            query="SELECT TOP 1 c.sub, c.profile FROM c WHERE c.doc_type = 'profile' "
+                  "AND c.email_key = @email_key ORDER BY c.created_at",
+            parameters=[{"name": "@email_key", "value": _email_key(email)}],
+            enable_cross_partition_query=True,
+        )
+        for item in items:
+            return item["sub"], item["profile"]
+        return None
+
+    def get_counter(self, sub: str, day: str) -> Tuple[int, int]:
+        try:
+            item = self._container.read_item(item=f"day-{day}", partition_key=sub)
+        except exceptions.CosmosResourceNotFoundError:
+            return 0, 0
+        return item.get("used", 0), item.get("reserved", 0)
+
+    def try_reserve(self, sub: str, day: str, tokens: int, limit: Optional[int]) -> bool:
+        if limit is not None and limit <= 0:
+            return False
+        predicate = None if limit is None else f"FROM c WHERE c.used + c.reserved < {int(limit)}"
+        try:
+            self._patch_counter(sub, day, [{"op": "incr", "path": "/reserved", "value": tokens}], predicate)
+            return True
+        except exceptions.CosmosAccessConditionFailedError:
+            return False
+
+    def settle(self, sub: str, day: str, used: int, reserved: int) -> int:
+        item = self._patch_counter(sub, day, [
+            {"op": "incr", "path": "/used", "value": used},
+            {"op": "incr", "path": "/reserved", "value": -reserved},
+        ])
+        return item.get("used", 0)
+
+    def _patch_counter(self, sub: str, day: str, operations: List[dict], predicate: Optional[str] = None) -> dict:
+        counter_id = f"day-{day}"
+        try:
+            return self._container.patch_item(
+                item=counter_id, partition_key=sub, patch_operations=operations, filter_predicate=predicate
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+        # First charge of the day: create the zeroed counter (another worker may beat us to it), then patch.
+        try:
+            self._container.create_item(body={
+                "id": counter_id, "sub": sub, "doc_type": "daily", "day": day,
+                "used": 0, "reserved": 0, "ttl": COUNTER_TTL_SECONDS,
+            })
+        except exceptions.CosmosResourceExistsError:
+            pass
+        return self._container.patch_item(
+            item=counter_id, partition_key=sub, patch_operations=operations, filter_predicate=predicate
+        )
+
+    @staticmethod
+    def _profile_doc(sub: str, profile: dict) -> dict:
+        return {
+            "id": "profile", "sub": sub, "doc_type": "profile",
+            "email_key": _email_key(profile.get("email", "")),
+            "created_at": profile.get("created_at"), "profile": profile,
+        }
+
+
+def create_quota_counters(backend: str, sqlite_path: str) -> QuotaCounters:
+    """Build the counters selected by QUOTA_BACKEND ('sqlite' or 'cosmos')."""
+    if backend == "sqlite":
+        return SQLiteQuotaCounters(sqlite_path)
+    if backend != "cosmos":
+        raise ValueError(f"Unknown quota backend: {backend}")
+    if not (settings.AZURE_COSMOS_ENDPOINT and settings.AZURE_COSMOS_KEY):
+        raise ValueError("QUOTA_BACKEND=cosmos needs AZURE_COSMOS_ENDPOINT and AZURE_COSMOS_KEY")
+    client = CosmosClient(settings.AZURE_COSMOS_ENDPOINT, credential=settings.AZURE_COSMOS_KEY)
+    database = client.create_database_if_not_exists(id=settings.AZURE_COSMOS_DATABASE)
+    container = database.create_container_if_not_exists(
+        id=settings.QUOTA_COSMOS_CONTAINER,
+        partition_key=PartitionKey(path="/sub"),
+        default_ttl=-1,  # TTL on, per document: only counters carry one
+    )
+    return CosmosQuotaCounters(container)
+
+
+class SharedUsageTracker:
+    """
+    UsageTracker's interface over QuotaCounters shared by every worker.
+    Holds no per-user state in the process; see the module docstring.
+    """
+
+    # Calls go to a database; async callers run them in a worker thread (usage_io).
+    blocking_io = True
+
+    def __init__(self, counters: QuotaCounters, tier_limits: Dict[str, Optional[int]]):
+        self._counters = counters
+        self._tier_limits = tier_limits
+        self.reservations = 0
+        self.denied = 0
+        self.released = 0
+
+    @tracer.start_as_current_span("usage.ensure_user")
+    def ensure_user(self, sub: str, name: str = "", email: str = "") -> dict:
+        profile = self._counters.get_profile(sub)
+        if profile is None:
+            profile = self._new_profile(email=email, name=name)
+            if not self._counters.add_profile(sub, profile):
+                profile = self._counters.get_profile(sub) or profile
+        elif email and email != profile.get("email", ""):
+            profile["email"] = email
+            self._counters.put_profile(sub, profile)
+        return self._with_usage(sub, profile)
+
+    @tracer.start_as_current_span("usage.check_budget")
+    def check_budget(self, sub: str) -> Tuple[bool, int, str, Optional[int]]:
+        profile = self._counters.get_profile(sub)
+        if profile is None:
+            free_limit = self._tier_limits["free"]
+            return True, free_limit or 0, "free", free_limit
+        tier = profile.get("tier", "free")
+        limit = self._tier_limits.get(tier)
+        if limit is None:
+            return True, -1, tier, None
+        used, _ = self._counters.get_counter(sub, self._today())
+        remaining = max(0, limit - used)
+        return remaining > 0, remaining, tier, limit
+
+    @tracer.start_as_current_span("usage.reserve")
+    def reserve(self, sub: str, tokens: int) -> Optional[Reservation]:
+        profile = self._counters.get_profile(sub)
+        limit = self._tier_limits.get(profile.get("tier", "free")) if profile else self._tier_limits["free"]
+        day = self._today()
+        if not self._counters.try_reserve(sub, day, tokens, limit):
+            self.denied += 1
+            return None
+        self.reservations += 1
+        return Reservation(sub, day, tokens)
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        if reservation is None or reservation.settled:
+            return
+        reservation.settled = True
+        self.released += 1
+        self._counters.settle(reservation.sub, reservation.day, 0, reservation.tokens)
+
+    @tracer.start_as_current_span("usage.record_usage")
+    def record_usage(self, sub: str, tokens_consumed: int, reservation: Optional[Reservation] = None) -> int:
+        trace.get_current_span().set_attribute("usage.tokens", tokens_consumed)
+        held = 0
+        day = self._today()
+        if reservation is not None and not reservation.settled:
+            reservation.settled = True
+            held = reservation.tokens
+            if reservation.day != day:
+                # The turn started before midnight UTC: its hold sits on yesterday's counter.
+                self._counters.settle(sub, reservation.day, 0, held)
+                held = 0
+        used = self._counters.settle(sub, day, tokens_consumed, held)
+
+        profile = self._counters.get_profile(sub)
+        tier = profile.get("tier", "free") if profile else "free"
+        tier_tokens.inc(tokens_consumed, tier=tier)
+        limit = self._tier_limits.get(tier)
+        if limit is None:
+            return -1
+        return max(0, limit - used)
+
+    @tracer.start_as_current_span("usage.set_tier")
+    def set_tier(
+        self,
+        sub: str,
+        tier: str,
+        provider: Optional[str] = None,
+        customer_id: Optional[str] = None,
+        email: Optional[str] = None,
+    ) -> None:
+        profile = self._counters.get_profile(sub) or self._new_profile(email=email or "")
+        profile["tier"] = tier
+        if provider is not None:
+            profile["payment_provider"] = provider
+        if customer_id is not None:
+            profile["payment_customer_id"] = customer_id
+        if email:
+            profile["email"] = email
+        self._counters.put_profile(sub, profile)
+
+    def get_user(self, sub: str) -> Optional[dict]:
+        profile = self._counters.get_profile(sub)
+        return self._with_usage(sub, profile) if profile is not None else None
+
+    def find_user_by_email(self, email: str) -> Optional[Tuple[str, dict]]:
+        if not _email_key(email):
+            return None
+        found = self._counters.find_profile_by_email(email)
+        if found is None:
+            return None
+        sub, profile = found
+        return sub, self._with_usage(sub, profile)
+
+    def check_email_index(self) -> List[str]:
+        """The email lookup is a database index here; nothing can drift."""
+        return []
+
+    def needs_import(self) -> bool:
+        """True until import_records() has completed against these counters."""
+        return self._counters.get_profile(IMPORT_MARKER) is None
+
+    def import_records(self, records: Iterable[Tuple[str, dict]], source: str = "") -> int:
+        """
+        Copy UsageTracker records (profiles, tiers and today's usage) into the
+        shared counters. Users that already have a profile are left alone, so
+        a rerun, or several workers importing at once, never double counts.
+        Returns the number of users imported.
+        """
+        day = self._today()
+        imported = 0
+        for sub, record in records:
+            profile = {field: record.get(field) for field in PROFILE_FIELDS}
+            profile["email"] = profile["email"] or ""
+            profile["name"] = profile["name"] or ""
+            profile["tier"] = profile["tier"] or "free"
+            if not self._counters.add_profile(sub, profile):
+                continue
+            imported += 1
+            if record.get("last_query_date") == day and record.get("tokens_used_today"):
+                self._counters.settle(sub, day, int(record["tokens_used_today"]), 0)
+        self._counters.put_profile(IMPORT_MARKER, {
+            "email": "", "name": "", "tier": "free", "source": source, "users": imported,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        })
+        logger.info("Imported %d user(s) from the %s usage store into the shared quota counters.", imported, source)
+        return imported
+
+    async def start(self) -> None:
+        """Nothing to run in the background: every change is written when it happens."""
+
+    async def stop(self) -> None:
+        pass
+
+    def flush(self) -> int:
+        return 0
+
+    def close(self) -> None:
+        self._counters.close()
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self._counters).__name__,
+            "reservations": self.reservations,
+            "denied": self.denied,
+            "released": self.released,
+        }
+
+    def _with_usage(self, sub: str, profile: dict) -> dict:
+        """The profile in UsageTracker's record shape, with today's counter."""
+        day = self._today()
+        used, _ = self._counters.get_counter(sub, day)
+        return {**profile, "tokens_used_today": used, "last_query_date": day}
+
+    def _new_profile(self, email: str = "", name: str = "") -> Dict[str, Any]:
+        return {
+            "email": email,
+            "name": name,
+            "tier": "free",
+            "payment_provider": None,
+            "payment_customer_id": None,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
@@ -0,0 +1,185 @@
+"""
+Token counting with tiktoken.
+
+Encoders are built once per model and reused. Deployment names tiktoken does
+not know (e.g. "model-router") use the gpt-4o family encoding. tiktoken
+downloads its BPE files on first use; if that fails, counts fall back to a
+characters/4 estimate and loading is retried after ENCODER_RETRY_SECONDS.
+
+Chat turns are charged from the usage the service reports; when none is
+reported (streamed completions, failed runs), the locally counted prompt
+and reply are charged instead. Both are compared per route in
+`reconciliation`.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-4o"
+DEFAULT_ENCODING = "o200k_base"
+ENCODER_RETRY_SECONDS = 300
+
+# Chat format framing: each message costs a few tokens beyond its content,
+# and every reply is primed with <|start|>assistant<|message|>.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+_encoders: Dict[str, object] = {}
+_failed_at: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def get_encoder(model: str = DEFAULT_MODEL):
+    """Return the cached tiktoken encoding for `model`, or None if it cannot be loaded."""
+    encoder = _encoders.get(model)
+    if encoder is not None:
+        return encoder
+    if time.monotonic() - _failed_at.get(model, -ENCODER_RETRY_SECONDS) < ENCODER_RETRY_SECONDS:
+        return None
+
+    with _lock:
+        if model in _encoders:
+            return _encoders[model]
+        try:
+            try:
+                encoder = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoder = tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception as e:
+            _failed_at[model] = time.monotonic()
+            logger.warning("tiktoken encoding for %s unavailable, estimating token counts: %s", model, e)
+            return None
+        _encoders[model] = encoder
+        _failed_at.pop(model, None)
+        return encoder
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Number of tokens in `text` for `model`."""
+    if not text:
+        return 0
+    encoder = get_encoder(model)
+    if encoder is None:
+        return max(1, len(text) // 4)
+    return len(encoder.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: Iterable[dict], model: str = DEFAULT_MODEL, reply_priming: bool = True) -> int:
+    """Prompt tokens for a list of {"role", "content"} chat messages."""
+    total = TOKENS_PER_REPLY if reply_priming else 0
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(message.get("content") or "", model)
+    return total
+
+
+def split_by_tokens(text: str, max_tokens: int, overlap_tokens: int = 0, model: str = DEFAULT_MODEL) -> List[str]:
+    """Split text into consecutive pieces of at most `max_tokens` tokens, each repeating the last `overlap_tokens`."""
+    if not text:
+        return []
+    step = max(1, max_tokens - overlap_tokens)
+    encoder = get_encoder(model)
+    if encoder is None:
+        # Same chars/4 approximation as count_tokens().
+        return [text[i:i + max_tokens * 4] for i in range(0, max(1, len(text) - overlap_tokens * 4), step * 4)]
+    tokens = encoder.encode(text, disallowed_special=())
+    return [encoder.decode(tokens[i:i + max_tokens]) for i in range(0, max(1, len(tokens) - overlap_tokens), step)]
+
+
+# ── Async counting ──────────────────────────────────────────
+
+# Texts longer than this are encoded in a worker thread so a long reply
+# does not stall the event loop.
+OFFLOAD_THRESHOLD_CHARS = 20_000
+
+
+async def count_tokens_async(text: str, model: str = DEFAULT_MODEL) -> int:
+    if len(text or "") < OFFLOAD_THRESHOLD_CHARS:
+        return count_tokens(text, model)
+    return await asyncio.to_thread(count_tokens, text, model)
+
+
+async def count_message_tokens_async(messages: List[dict], model: str = DEFAULT_MODEL) -> int:
+    if sum(len(m.get("content") or "") for m in messages) < OFFLOAD_THRESHOLD_CHARS:
+        return count_message_tokens(messages, model)
+    return await asyncio.to_thread(count_message_tokens, messages, model)
+
+
+class TokenEstimate:
+    def __init__(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+async def estimate_turn(prompt_messages: List[dict], completion: str, model: str = DEFAULT_MODEL) -> TokenEstimate:
+    """Count the prompt we sent and the reply we got."""
+    return TokenEstimate(
+        await count_message_tokens_async(prompt_messages, model),
+        await count_tokens_async(completion, model),
+    )
+
+
+# ── Reconciliation ──────────────────────────────────────────
+
+class ReconciliationStats:
+    """
+    Compares local estimates with the usage the service reported, per route.
+    Agent runs bill Bing results and tool calls as prompt tokens, so their
+    reported prompt usage is expected to exceed what we can count locally.
+    """
+
+    def __init__(self):
+        self._routes: Dict[str, dict] = {}
+
+    def record(self, route: str, estimate: TokenEstimate, usage) -> dict:
+        actual_prompt = getattr(usage, "prompt_tokens", 0) or 0
+        actual_completion = getattr(usage, "completion_tokens", 0) or 0
+        actual_total = getattr(usage, "total_tokens", 0) or actual_prompt + actual_completion
+        report = {
+            "route": route,
+            "estimated_prompt": estimate.prompt_tokens,
+            "estimated_completion": estimate.completion_tokens,
+            "actual_prompt": actual_prompt,
+            "actual_completion": actual_completion,
+            "actual_total": actual_total,
+            "delta_total": actual_total - estimate.total_tokens,
+        }
+        entry = self._routes.setdefault(route, {
+            "turns": 0, "estimated_prompt": 0, "estimated_completion": 0,
+            "actual_prompt": 0, "actual_completion": 0, "abs_delta": 0,
+        })
+        entry["turns"] += 1
+        entry["estimated_prompt"] += estimate.prompt_tokens
+        entry["estimated_completion"] += estimate.completion_tokens
+        entry["actual_prompt"] += actual_prompt
+        entry["actual_completion"] += actual_completion
+        entry["abs_delta"] += abs(report["delta_total"])
+        logger.debug("Token reconciliation: %s", report)
+        return report
+
+    def snapshot(self) -> dict:
+        out = {}
+        for route, e in self._routes.items():
+            actual = e["actual_prompt"] + e["actual_completion"]
+            out[route] = {
+                **e,
+                "prompt_ratio": round(e["actual_prompt"] / e["estimated_prompt"], 3) if e["estimated_prompt"] else None,
+                "completion_ratio": (
+                    round(e["actual_completion"] / e["estimated_completion"], 3) if e["estimated_completion"] else None
+                ),
+                "mean_abs_error_pct": round(100 * e["abs_delta"] / actual, 1) if actual else None,
+            }
+        return out
+
+
+reconciliation = ReconciliationStats()
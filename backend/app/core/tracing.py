@@ -0,0 +1,137 @@
+"""
+OpenTelemetry tracing for the chat pipeline.
+
+Every stage of a turn (token verification, quota checks, history reads and
+writes, attachment processing, routing, assistant lookup, thread replay, the
+agent run and its polling, message listing) opens a span, so a slow request
+can be broken down stage by stage. Spans carry the Cosmos DB RU charge, token
+counts and Bing tool-call counts as attributes.
+
+TRACING_EXPORTER selects where spans go:
+  - "none" (default): no provider is installed and spans are no-ops;
+  - "console": printed to stdout, for local debugging;
+  - "otlp": sent to OTEL_EXPORTER_OTLP_ENDPOINT (needs the OTLP exporter package);
+  - "memory": kept in-process; configure_tracing() returns the exporter, whose
+    get_finished_spans() tests and benchmarks can inspect.
+"""
+
+import logging
+from typing import Optional
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SimpleSpanProcessor,
+    SpanExporter,
+)
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Proxy tracer: a no-op until configure_tracing() installs a provider.
+tracer = trace.get_tracer("compliance.chat")
+
+_provider: Optional[TracerProvider] = None
+
+
+def _build_exporter(name: str) -> Optional[SpanExporter]:
+    if name == "memory":
+        return InMemorySpanExporter()
+    if name == "console":
+        return ConsoleSpanExporter()
+    if name == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        except ImportError as e:
+            logger.warning("OTLP trace exporter unavailable, tracing disabled: %s", e)
+            return None
+        return OTLPSpanExporter()
+    if name not in ("", "none"):
+        logger.warning("Unknown TRACING_EXPORTER %r, tracing disabled", name)
+    return None
+
+
+def configure_tracing(exporter: str = settings.TRACING_EXPORTER) -> Optional[SpanExporter]:
+    """
+    Install the tracer provider (once per process) and attach an exporter.
+    Returns the exporter, or None when tracing stays disabled.
+    """
+    global _provider
+
+    span_exporter = _build_exporter(exporter)
+    if span_exporter is None:
+        return None
+    if _provider is None:
+        _provider = TracerProvider(
+            resource=Resource.create({"service.name": settings.PROJECT_NAME, "service.version": settings.VERSION})
+        )
+        trace.set_tracer_provider(_provider)
+    # Export synchronously in-process; batch everything that leaves the process.
+    processor = SimpleSpanProcessor(span_exporter) if exporter == "memory" else BatchSpanProcessor(span_exporter)
+    _provider.add_span_processor(processor)
+    logger.info("Tracing enabled with the %s exporter", exporter)
+    return span_exporter
+
+
+def shutdown_tracing() -> None:
+    """Flush pending spans (called from the app lifespan)."""
+    if _provider is not None:
+        _provider.force_flush()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware opening the root span of each HTTP request, so the stage
+    spans of a request (including a streamed response) share one trace.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope.get("method", "GET")
+        with tracer.start_as_current_span(
+            f"{method} {scope.get('path', '')}",
+            kind=trace.SpanKind.SERVER,
+            attributes={"http.request.method": method, "url.path": scope.get("path", "")},
+        ) as span:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.response.status_code", message["status"])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                route = scope.get("route")
+                if route is not None and hasattr(route, "path"):
+                    # Name by route template so /api/history/{thread_id} is one span name.
+                    span.update_name(f"{method} {route.path}")
+                    span.set_attribute("http.route", route.path)
+
+
+def add_to_span(key: str, amount: float) -> None:
+    """Add `amount` to a numeric attribute of the current span (e.g. RU charged by several Cosmos calls)."""
+    span = trace.get_current_span()
+    if not span.is_recording():
+        return
+    current = (getattr(span, "attributes", None) or {}).get(key, 0)
+    span.set_attribute(key, current + amount)
+
+
+def set_usage_attributes(span, usage) -> None:
+    """Token counts from an OpenAI usage object as span attributes."""
+    if usage is None or not span.is_recording():
+        return
+    span.set_attribute("llm.prompt_tokens", getattr(usage, "prompt_tokens", 0) or 0)
+    span.set_attribute("llm.completion_tokens", getattr(usage, "completion_tokens", 0) or 0)
+    span.set_attribute("llm.total_tokens", getattr(usage, "total_tokens", 0) or 0)
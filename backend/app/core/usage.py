@@ -2,14 +2,28 @@
 Token-based usage tracking and tier management.
 
 Tracks per-user daily token consumption against tier limits.
-Backed by a local JSON file (swappable to Cosmos DB in production).
+Records are kept by a pluggable UsageStore (see app.core.usage_store);
+the default is an in-memory dict with a write-ahead log and JSON snapshot.
+Updates are cached in memory and written to the store in batches.
 """
 
-import json
+import asyncio
+import logging
 import os
 import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from opentelemetry import trace
+
+from app.core.config import settings
+from app.core.metrics import tier_tokens
+from app.core.quota import Reservation, SharedUsageTracker, create_quota_counters
+from app.core.tracing import tracer
+from app.core.usage_store import JsonLogUsageStore, SQLiteUsageStore, UsageStore
+
+logger = logging.getLogger(__name__)
 
 # Tier configuration: tier_name -> daily_token_limit (None = unlimited)
 TIER_LIMITS: Dict[str, Optional[int]] = {
@@ -21,41 +35,91 @@ TIER_LIMITS: Dict[str, Optional[int]] = {
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
 USAGE_FILE = os.path.join(DATA_DIR, "user_usage.json")
+USAGE_LOG_FILE = os.path.join(DATA_DIR, "user_usage.log")
+USAGE_DB_FILE = os.path.join(DATA_DIR, "user_usage.db")
+QUOTA_DB_FILE = settings.QUOTA_SQLITE_PATH or os.path.join(DATA_DIR, "user_quota.db")
+
+
+def create_usage_store(backend: str = settings.USAGE_STORE_BACKEND) -> UsageStore:
+    """Build the usage store selected by USAGE_STORE_BACKEND ('jsonlog' or 'sqlite')."""
+    if backend == "sqlite":
+        return SQLiteUsageStore(USAGE_DB_FILE)
+    if backend != "jsonlog":
+        raise ValueError(f"Unknown usage store backend: {backend}")
+    return JsonLogUsageStore(
+        USAGE_FILE, USAGE_LOG_FILE, compact_every=settings.USAGE_LOG_COMPACT_EVERY
+    )
 
 
 class UsageTracker:
     """
-    Thread-safe, file-backed per-user token usage tracker.
+    Thread-safe per-user token usage tracker.
     Each user is identified by their Entra ID `sub` claim.
+
+    Reads and updates go to an in-memory cache of records, so quota checks and
+    charges never wait on storage. Changed records are written behind: the
+    background flusher (start()/stop(), run from the app lifespan) hands them
+    to the store in one batch every `flush_interval` seconds, or as soon as
+    `flush_max_pending` records are waiting. close() flushes what is left.
+    Tier changes from billing are flushed immediately.
+    A case-folded email -> sub index serves billing webhook lookups.
+
+    Records belong to this process: with several workers or replicas use
+    SharedUsageTracker (QUOTA_BACKEND, see app.core.quota) instead.
     """
 
-    def __init__(self, filepath: str = USAGE_FILE):
-        self._filepath = filepath
+    # Cache misses read the store, set_tier() flushes (and may compact the JSON
+    # log), and email changes can scan every record: async callers go through usage_io.
+    blocking_io = True
+
+    def __init__(
+        self,
+        store: Optional[UsageStore] = None,
+        flush_interval: float = settings.USAGE_FLUSH_INTERVAL_MS / 1000,
+        flush_max_pending: int = settings.USAGE_FLUSH_MAX_PENDING,
+        cache_max_entries: int = settings.USAGE_CACHE_MAX_ENTRIES,
+    ):
+        self._store = store if store is not None else create_usage_store()
+        self._flush_interval = flush_interval
+        self._flush_max_pending = flush_max_pending
+        self._cache_max_entries = cache_max_entries
+        # Lock order: _flush_lock (one flush at a time) before _lock (records, dirty set,
+        # email index) before _store_lock (the store).
+        self._flush_lock = threading.Lock()
         self._lock = threading.Lock()
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        if not os.path.exists(filepath):
-            self._write({})
+        self._store_lock = threading.Lock()
+        self._records: "OrderedDict[str, dict]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._reserved: Dict[str, int] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.records_flushed = 0
+        self.flush_errors = 0
+        self._email_index: Dict[str, str] = self._build_email_index()
 
     # ── Public API ──────────────────────────────────────────────
 
+    @tracer.start_as_current_span("usage.ensure_user")
     def ensure_user(self, sub: str, name: str = "", email: str = "") -> dict:
-        """Create user record if it doesn't exist. Returns the user record."""
+        """
+        Create user record if it doesn't exist. Returns the user record.
+        A changed (or previously missing) email on an existing record is updated.
+        """
         with self._lock:
-            data = self._read()
-            if sub not in data:
-                data[sub] = {
-                    "email": email,
-                    "name": name,
-                    "tier": "free",
-                    "payment_provider": None,
-                    "payment_customer_id": None,
-                    "tokens_used_today": 0,
-                    "last_query_date": self._today(),
-                    "created_at": datetime.now(timezone.utc).isoformat(),
-                }
-                self._write(data)
-            return data[sub]
+            user = self._get(sub)
+            if user is None:
+                user = self._new_record(email=email, name=name, tier="free")
+                self._put(sub, user)
+                self._index_email(sub, "", email)
+            elif email and email != user.get("email", ""):
+                self._index_email(sub, user.get("email", ""), email)
+                user["email"] = email
+                self._put(sub, user)
+            return dict(user)
 
+    @tracer.start_as_current_span("usage.check_budget")
     def check_budget(self, sub: str) -> Tuple[bool, int, str, Optional[int]]:
         """
         Pre-flight budget check.
@@ -68,15 +132,13 @@ class UsageTracker:
             - daily_limit: the tier's daily limit (None if unlimited)
         """
         with self._lock:
-            data = self._read()
-            user = data.get(sub)
+            user = self._get(sub)
             if not user:
                 free_limit = TIER_LIMITS["free"]
                 return True, free_limit or 0, "free", free_limit
 
             # Reset daily counter if date changed
-            self._maybe_reset_daily(data, sub)
-            user = data[sub]
+            self._maybe_reset_daily(sub, user)
 
             tier = user.get("tier", "free")
             limit = TIER_LIMITS.get(tier)
@@ -89,97 +151,328 @@ class UsageTracker:
             allowed = remaining > 0
             return allowed, remaining, tier, limit
 
-    def record_usage(self, sub: str, tokens_consumed: int) -> int:
+    @tracer.start_as_current_span("usage.reserve")
+    def reserve(self, sub: str, tokens: int) -> Optional[Reservation]:
+        """
+        Hold `tokens` of the user's remaining budget for a turn about to run.
+        Returns None when used plus already-reserved tokens leave no headroom,
+        so concurrent turns cannot all pass the budget check on the last tokens.
         """
-        Record tokens consumed after a successful AI response.
+        with self._lock:
+            user = self._get(sub)
+            if user is not None:
+                self._maybe_reset_daily(sub, user)
+                limit = TIER_LIMITS.get(user.get("tier", "free"))
+                held = self._reserved.get(sub, 0)
+                if limit is not None and user.get("tokens_used_today", 0) + held >= limit:
+                    return None
+                self._reserved[sub] = held + tokens
+            return Reservation(sub, self._today(), tokens if user is not None else 0)
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        """Give back a reservation whose turn produced no charge. No-op once settled."""
+        if reservation is None or reservation.settled:
+            return
+        with self._lock:
+            self._settle(reservation)
+
+    @tracer.start_as_current_span("usage.record_usage")
+    def record_usage(self, sub: str, tokens_consumed: int, reservation: Optional[Reservation] = None) -> int:
+        """
+        Record tokens consumed after a successful AI response, settling the
+        turn's reservation if it has one.
 
         Returns the new remaining token count (-1 if unlimited).
         """
+        trace.get_current_span().set_attribute("usage.tokens", tokens_consumed)
         with self._lock:
-            data = self._read()
-            if sub not in data:
+            if reservation is not None and not reservation.settled:
+                self._settle(reservation)
+            user = self._get(sub)
+            if user is None:
                 return 0
 
-            self._maybe_reset_daily(data, sub)
-            data[sub]["tokens_used_today"] += tokens_consumed
-            data[sub]["last_query_date"] = self._today()
-            self._write(data)
+            self._maybe_reset_daily(sub, user, persist=False)
+            user["tokens_used_today"] += tokens_consumed
+            user["last_query_date"] = self._today()
+            self._put(sub, user)
 
-            tier = data[sub].get("tier", "free")
+            tier = user.get("tier", "free")
+            tier_tokens.inc(tokens_consumed, tier=tier)
             limit = TIER_LIMITS.get(tier)
             if limit is None:
                 return -1
-            return max(0, limit - data[sub]["tokens_used_today"])
+            return max(0, limit - user["tokens_used_today"])
 
+    @tracer.start_as_current_span("usage.set_tier")
     def set_tier(
         self,
         sub: str,
         tier: str,
         provider: Optional[str] = None,
         customer_id: Optional[str] = None,
+        email: Optional[str] = None,
     ) -> None:
         """Update a user's subscription tier (called by billing webhooks)."""
         with self._lock:
-            data = self._read()
-            if sub not in data:
-                data[sub] = {
-                    "email": "",
-                    "name": "",
-                    "tier": tier,
-                    "payment_provider": provider,
-                    "payment_customer_id": customer_id,
-                    "tokens_used_today": 0,
-                    "last_query_date": self._today(),
-                    "created_at": datetime.now(timezone.utc).isoformat(),
-                }
+            user = self._get(sub)
+            if user is None:
+                user = self._new_record(
+                    email=email or "", tier=tier, provider=provider, customer_id=customer_id
+                )
+                self._index_email(sub, "", user["email"])
             else:
-                data[sub]["tier"] = tier
+                user["tier"] = tier
                 if provider is not None:
-                    data[sub]["payment_provider"] = provider
+                    user["payment_provider"] = provider
                 if customer_id is not None:
-                    data[sub]["payment_customer_id"] = customer_id
-            self._write(data)
+                    user["payment_customer_id"] = customer_id
+                if email and email != user.get("email", ""):
+                    self._index_email(sub, user.get("email", ""), email)
+                    user["email"] = email
+            self._put(sub, user)
+        # A paid upgrade must survive a crash; don't leave it to the next flush.
+        self.flush()
 
     def get_user(self, sub: str) -> Optional[dict]:
         """Get a user's record."""
         with self._lock:
-            data = self._read()
-            return data.get(sub)
+            user = self._get(sub)
+            return dict(user) if user is not None else None
 
     def find_user_by_email(self, email: str) -> Optional[Tuple[str, dict]]:
-        """Find a user by email. Returns (sub, record) or None."""
+        """Find a user by email (case-insensitive). Returns (sub, record) or None."""
+        with self._lock:
+            sub = self._email_index.get(self._email_key(email))
+            if sub is None:
+                return None
+            record = self._get(sub)
+            return (sub, dict(record)) if record is not None else None
+
+    def check_email_index(self) -> List[str]:
+        """
+        Compare the maintained email index with one rebuilt from the store.
+        Returns a list of human-readable discrepancies (empty when consistent).
+        """
         with self._lock:
-            data = self._read()
-            for sub, record in data.items():
-                if record.get("email", "").lower() == email.lower():
-                    return sub, record
-            return None
+            expected = self._build_email_index()
+            actual = dict(self._email_index)
+
+        problems = []
+        for key in expected.keys() - actual.keys():
+            problems.append(f"missing index entry for {key!r} -> {expected[key]}")
+        for key in actual.keys() - expected.keys():
+            problems.append(f"stale index entry {key!r} -> {actual[key]}")
+        for key in expected.keys() & actual.keys():
+            if expected[key] != actual[key]:
+                problems.append(f"index entry {key!r} -> {actual[key]}, expected {expected[key]}")
+        return problems
+
+    # ── Write-behind flushing ───────────────────────────────────
+
+    async def start(self) -> None:
+        """Start the background flusher (called from the app lifespan)."""
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """Stop the background flusher and write out pending records."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._loop = self._wake = None
+        await asyncio.to_thread(self.flush)
+
+    def flush(self) -> int:
+        """Write every changed record to the store in one batch. Returns the number written."""
+        # Flushes are serialised: an older batch must not reach the store after a newer one,
+        # and nothing may be evicted while a batch holding it is still being written.
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                batch = {sub: dict(self._records[sub]) for sub in self._dirty}
+                self._dirty.clear()
+            try:
+                with self._store_lock:
+                    self._store.put_many(batch)
+            except Exception:
+                self.flush_errors += 1
+                with self._lock:
+                    self._dirty.update(batch)  # retried on the next flush
+                raise
+            with self._lock:
+                self.flushes += 1
+                self.records_flushed += len(batch)
+                self._evict()
+            return len(batch)
+
+    def close(self) -> None:
+        """Flush pending records and the underlying store (called on application shutdown)."""
+        self.flush()
+        with self._store_lock:
+            self._store.close()
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._records),
+            "pending": len(self._dirty),
+            "flushes": self.flushes,
+            "records_flushed": self.records_flushed,
+            "flush_errors": self.flush_errors,
+            "reserved_tokens": sum(self._reserved.values()),
+        }
+
+    async def _flush_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error("Usage flush failed, will retry: %s", e)
 
     # ── Internal helpers ────────────────────────────────────────
 
-    def _maybe_reset_daily(self, data: dict, sub: str) -> None:
+    def _get(self, sub: str) -> Optional[dict]:
+        """The cached record for `sub`, loading it from the store on first use. Caller holds _lock."""
+        user = self._records.get(sub)
+        if user is not None:
+            self._records.move_to_end(sub)
+            return user
+        with self._store_lock:
+            user = self._store.get(sub)
+        if user is not None:
+            self._records[sub] = user = dict(user)
+        return user
+
+    def _put(self, sub: str, user: dict) -> None:
+        """Cache `user` and queue it for the next flush. Caller holds _lock."""
+        self._records[sub] = user
+        self._records.move_to_end(sub)
+        self._dirty.add(sub)
+        if len(self._dirty) >= self._flush_max_pending and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _settle(self, reservation: Reservation) -> None:
+        """Drop a reservation's hold. Caller holds _lock."""
+        reservation.settled = True
+        held = self._reserved.get(reservation.sub, 0) - reservation.tokens
+        if held > 0:
+            self._reserved[reservation.sub] = held
+        else:
+            self._reserved.pop(reservation.sub, None)
+
+    def _evict(self) -> None:
+        """Drop the least recently used records that have been flushed. Caller holds _lock."""
+        excess = len(self._records) - self._cache_max_entries
+        for sub in list(self._records):
+            if excess <= 0:
+                break
+            if sub not in self._dirty:
+                del self._records[sub]
+                excess -= 1
+
+    def _items(self) -> Iterator[Tuple[str, dict]]:
+        """All records: cached ones (possibly not flushed yet), then the rest of the store."""
+        yield from list(self._records.items())
+        with self._store_lock:
+            stored = [(sub, record) for sub, record in self._store.items() if sub not in self._records]
+        yield from stored
+
+    @staticmethod
+    def _email_key(email: str) -> str:
+        return (email or "").strip().casefold()
+
+    def _build_email_index(self) -> Dict[str, str]:
+        """Full scan of the store; the first user registered with an email owns it."""
+        index: Dict[str, str] = {}
+        for sub, record in self._items():
+            key = self._email_key(record.get("email", ""))
+            if key:
+                index.setdefault(key, sub)
+        return index
+
+    def _index_email(self, sub: str, old_email: str, new_email: str) -> None:
+        old_key, new_key = self._email_key(old_email), self._email_key(new_email)
+        if old_key and self._email_index.get(old_key) == sub:
+            del self._email_index[old_key]
+            # Hand the address to any other user still registered with it.
+            for other_sub, record in self._items():
+                if other_sub != sub and self._email_key(record.get("email", "")) == old_key:
+                    self._email_index[old_key] = other_sub
+                    break
+        if new_key:
+            self._email_index.setdefault(new_key, sub)
+
+    def _maybe_reset_daily(self, sub: str, user: dict, persist: bool = True) -> None:
         """Reset daily counter if the date has changed (mutates in place)."""
         today = self._today()
-        if data[sub].get("last_query_date") != today:
-            data[sub]["tokens_used_today"] = 0
-            data[sub]["last_query_date"] = today
-            self._write(data)
+        if user.get("last_query_date") != today:
+            user["tokens_used_today"] = 0
+            user["last_query_date"] = today
+            if persist:
+                self._put(sub, user)
+
+    def _new_record(
+        self,
+        email: str = "",
+        name: str = "",
+        tier: str = "free",
+        provider: Optional[str] = None,
+        customer_id: Optional[str] = None,
+    ) -> dict:
+        return {
+            "email": email,
+            "name": name,
+            "tier": tier,
+            "payment_provider": provider,
+            "payment_customer_id": customer_id,
+            "tokens_used_today": 0,
+            "last_query_date": self._today(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
 
     @staticmethod
     def _today() -> str:
         return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-    def _read(self) -> dict:
+
+def create_usage_tracker(backend: str = settings.QUOTA_BACKEND):
+    """
+    The tracker selected by QUOTA_BACKEND: "local" (this process only),
+    "sqlite" (workers sharing one host) or "cosmos" (replicas).
+    """
+    if backend == "local":
+        return UsageTracker()
+    tracker = SharedUsageTracker(create_quota_counters(backend, QUOTA_DB_FILE), TIER_LIMITS)
+    if tracker.needs_import():
+        # One-time: bring over the profiles, tiers and today's usage the local tracker kept.
+        store = create_usage_store()
         try:
-            with open(self._filepath, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            tracker.import_records(store.items(), source=settings.USAGE_STORE_BACKEND)
+        finally:
+            store.close()
+    return tracker
 
-    def _write(self, data: dict) -> None:
-        with open(self._filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+
+async def usage_io(fn, *args, **kwargs):
+    """
+    Call a usage_tracker method from async code. Trackers whose calls can touch
+    storage run them in a worker thread instead of on the event loop.
+    """
+    if usage_tracker.blocking_io:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
 
 
 # Singleton instance
-usage_tracker = UsageTracker()
+usage_tracker = create_usage_tracker()
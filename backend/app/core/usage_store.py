@@ -0,0 +1,194 @@
+"""
+Storage backends for per-user usage records.
+
+UsageTracker talks to a UsageStore instead of reading and rewriting the
+whole usage file on every call. Two implementations are provided:
+
+- JsonLogUsageStore: in-memory dict + write-ahead append log, periodically
+  compacted into a JSON snapshot via atomic rename. The snapshot uses the
+  same layout as the original user_usage.json, so existing data loads as-is.
+- SQLiteUsageStore: one row per user in a SQLite database in WAL mode.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UsageStore(ABC):
+    """
+    Key-value store for usage records, keyed by the user's `sub` claim.
+    Implementations are not thread-safe; UsageTracker serialises access.
+    """
+
+    @abstractmethod
+    def get(self, sub: str) -> Optional[dict]:
+        """Return the user's record, or None if unknown."""
+        ...
+
+    @abstractmethod
+    def put(self, sub: str, record: dict) -> None:
+        """Insert or replace the user's record durably."""
+        ...
+
+    def put_many(self, records: Dict[str, dict]) -> None:
+        """Insert or replace several records (a write-behind flush)."""
+        for sub, record in records.items():
+            self.put(sub, record)
+
+    @abstractmethod
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """Iterate over all (sub, record) pairs."""
+        ...
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.items())
+
+    def close(self) -> None:
+        """Flush and release any resources."""
+
+
+class JsonLogUsageStore(UsageStore):
+    """
+    All records live in a dict; each put() appends one JSON line to the log.
+
+    On load the snapshot is read and the log replayed on top of it. Once the
+    log holds `compact_every` entries (and on load/close), the dict is written
+    to a temporary file and atomically renamed over the snapshot, and the log
+    is truncated. Intended for a single process; see SQLiteUsageStore for a
+    backend that several workers can share.
+    """
+
+    def __init__(self, snapshot_path: str, log_path: str, compact_every: int = 10_000):
+        self._snapshot_path = snapshot_path
+        self._log_path = log_path
+        self._compact_every = compact_every
+        self._data: Dict[str, dict] = {}
+        self._log_entries = 0
+        os.makedirs(os.path.dirname(snapshot_path), exist_ok=True)
+
+        self._load()
+        if self._log_entries or not os.path.exists(snapshot_path):
+            self.compact()
+        self._log = open(self._log_path, "a", encoding="utf-8")
+
+    def get(self, sub: str) -> Optional[dict]:
+        return self._data.get(sub)
+
+    def put(self, sub: str, record: dict) -> None:
+        self._data[sub] = record
+        self._log.write(json.dumps({"sub": sub, "record": record}, ensure_ascii=False) + "\n")
+        self._log.flush()
+        self._log_entries += 1
+        if self._log_entries >= self._compact_every:
+            self.compact()
+
+    def put_many(self, records: Dict[str, dict]) -> None:
+        self._data.update(records)
+        self._log.write("".join(
+            json.dumps({"sub": sub, "record": record}, ensure_ascii=False) + "\n" for sub, record in records.items()
+        ))
+        self._log.flush()
+        self._log_entries += len(records)
+        if self._log_entries >= self._compact_every:
+            self.compact()
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        return iter(self._data.items())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def compact(self) -> None:
+        """Write a fresh snapshot and truncate the log."""
+        tmp_path = f"{self._snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+
+        log = getattr(self, "_log", None)
+        if log:
+            log.truncate(0)
+        else:
+            open(self._log_path, "w").close()
+        self._log_entries = 0
+
+    def close(self) -> None:
+        if self._log_entries:
+            self.compact()
+        self._log.close()
+
+    def _load(self) -> None:
+        try:
+            with open(self._snapshot_path, "r", encoding="utf-8") as f:
+                self._data = json.load(f)
+        except FileNotFoundError:
+            self._data = {}
+        except json.JSONDecodeError as e:
+            logger.error("Usage snapshot %s is corrupt, starting empty: %s", self._snapshot_path, e)
+            self._data = {}
+
+        try:
+            with open(self._log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-append; everything before it is intact.
+                        logger.warning("Skipping unreadable usage log entry in %s", self._log_path)
+                        continue
+                    self._data[entry["sub"]] = entry["record"]
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteUsageStore(UsageStore):
+    """One row per user, stored as JSON, in a SQLite database using WAL journaling."""
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_usage (sub TEXT PRIMARY KEY, record TEXT NOT NULL)"
+        )
+
+    def get(self, sub: str) -> Optional[dict]:
+        row = self._conn.execute("SELECT record FROM user_usage WHERE sub = ?", (sub,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, sub: str, record: dict) -> None:
+        self._conn.execute(
+            "INSERT INTO user_usage (sub, record) VALUES (?, ?) "
+            "ON CONFLICT(sub) DO UPDATE SET record = excluded.record",
+            (sub, json.dumps(record, ensure_ascii=False)),
+        )
+
+    def put_many(self, records: Dict[str, dict]) -> None:
+        # One transaction for the whole batch: a single WAL commit instead of one per record.
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT INTO user_usage (sub, record) VALUES (?, ?) "
+                "ON CONFLICT(sub) DO UPDATE SET record = excluded.record",
+                [(sub, json.dumps(record, ensure_ascii=False)) for sub, record in records.items()],
+            )
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        for sub, record in self._conn.execute("SELECT sub, record FROM user_usage"):
+            yield sub, json.loads(record)
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM user_usage").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
@@ -1,11 +1,19 @@
+import asyncio
 import os
 import logging
+import secrets
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.chat import router as chat_router
 from app.api.billing import router as billing_router
 from app.core.config import settings
+from app.core.usage import usage_tracker
+from app.core.auth import jwks_cache, token_cache
+from app.core.token_accounting import reconciliation
+from app.core.metrics import MetricFamily, MetricsMiddleware, registry
+from app.core.tracing import TracingMiddleware, configure_tracing, shutdown_tracing
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +23,94 @@ async def lifespan(app: FastAPI):
     """
     Initialises the AIProjectClient once at startup and tears it down on shutdown.
     Sharing a single client across all requests avoids per-request auth overhead
-    and connection-list scans for the Bing grounding tool.
+    and connection-list scans for the Bing grounding tool. The Compliance agent
+    itself is registered (or an existing one adopted) here too, and the async
+    Cosmos history client is opened once and shared. Entra ID signing keys are
+    prefetched here and then refreshed in the background, and the usage
+    tracker's write-behind flusher runs until shutdown, when it is drained.
     """
-    from app.services.agent_orchestrator import create_kernel
+    from app.services.agent_orchestrator import create_kernel, warm_up_agent, shutdown_agent
+    from app.services.history_service import create_history_service
+    from app.services.answer_cache import answer_cache
+    from app.services.attachment_index import chunk_index
+    from app.services.attachment_service import attachment_service
+    from app.services.embeddings import create_embedder
+    configure_tracing()
+    await jwks_cache.start()
+    await usage_tracker.start()
+    app.state.history_service = await create_history_service()
     app.state.ai_client = await create_kernel()
     if app.state.ai_client:
         logger.info("AIProjectClient initialised and ready.")
+        await warm_up_agent(app.state.ai_client)
+        embedder = await create_embedder(app.state.ai_client)
+        chunk_index.configure_embedder(embedder)
+        if settings.ANSWER_CACHE_SEMANTIC:
+            answer_cache.configure_embedder(embedder)
     else:
         logger.error("AIProjectClient could not be initialised — AI features are disabled.")
     yield
+    await jwks_cache.stop()
+    await shutdown_agent()
+    await app.state.history_service.close()
+    attachment_service.close()
+    await usage_tracker.stop()
+    await asyncio.to_thread(usage_tracker.close)
     if getattr(app.state, "ai_client", None):
         await app.state.ai_client.close()
         logger.info("AIProjectClient closed.")
+    shutdown_tracing()
+
+
+def service_metrics(app: FastAPI):
+    """
+    Scrape-time metric families read from the counters the services already
+    keep, so serving /metrics adds no bookkeeping to the request path.
+    """
+    from app.services.answer_cache import answer_cache
+    from app.services.attachment_service import attachment_service
+    from app.services.single_flight import chat_flights
+    from app.services.admission import admission
+
+    answers, tokens = answer_cache.stats(), token_cache.stats()
+    attachments, flights = attachment_service.stats(), chat_flights.stats()
+    caches = {
+        "answer": (answers["hits"], answers["misses"]),
+        "verified_token": (tokens["hits"], tokens["misses"]),
+        "attachment_text": (attachments["cache_hits"], attachments["extractions"]),
+        "single_flight": (flights["coalesced"], flights["runs"]),
+    }
+    lookups = MetricFamily("cache_lookups_total", "counter", "Cache lookups by cache and result.")
+    ratio = MetricFamily("cache_hit_ratio", "gauge", "Cache hits / lookups since startup.")
+    for cache, (hits, misses) in caches.items():
+        lookups.add(hits, cache=cache, result="hit").add(misses, cache=cache, result="miss")
+        ratio.add(hits / (hits + misses) if hits + misses else 0, cache=cache)
+
+    charge = MetricFamily("cosmos_request_charge_total", "counter", "Cosmos DB request units by history operation.")
+    calls = MetricFamily("cosmos_requests_total", "counter", "Cosmos DB requests by history operation.")
+    history_service = getattr(app.state, "history_service", None)
+    for operation, op_stats in (history_service.request_charges.snapshot() if history_service else {}).items():
+        charge.add(op_stats["total_ru"], operation=operation)
+        calls.add(op_stats["count"], operation=operation)
+
+    admission_stats = admission.stats()
+    running = MetricFamily("admission_running", "gauge", "Chat runs holding an admission slot.")
+    running.add(admission_stats["running"])
+    queued = MetricFamily("admission_queue_depth", "gauge", "Chat runs waiting for a slot, by tier.")
+    rejected = MetricFamily("admission_rejected_total", "counter", "Chat runs rejected by admission, by tier.")
+    for tier, tier_stats in admission_stats["tiers"].items():
+        queued.add(tier_stats["queued"], tier=tier)
+        rejected.add(tier_stats["rejected"], tier=tier)
+
+    return [lookups, ratio, charge, calls, running, queued, rejected]
+
+
+def _require_stats_token(request: Request) -> None:
+    if not settings.STATS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), settings.STATS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid stats token")
 
 
 def create_app() -> FastAPI:
@@ -49,6 +133,12 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
     )
 
+    # Root span per request; stage spans nest under it (see app/core/tracing.py)
+    app.add_middleware(TracingMiddleware)
+
+    # Request rate, latency and in-flight gauges for /metrics (see app/core/metrics.py)
+    app.add_middleware(MetricsMiddleware)
+
     # Include routers
     app.include_router(chat_router, prefix="/api", tags=["Chat"])
     app.include_router(billing_router, prefix="/api/billing", tags=["Billing"])
@@ -57,6 +147,38 @@ def create_app() -> FastAPI:
     def health_check():
         return {"status": "healthy", "service": settings.PROJECT_NAME}
 
+    @app.get("/stats", include_in_schema=False)
+    def service_stats(request: Request):
+        """Internal service state for operators: `Authorization: Bearer <STATS_TOKEN>`."""
+        _require_stats_token(request)
+        from app.services.agent_orchestrator import assistant_registry, route_stats, run_stats
+        from app.services.answer_cache import answer_cache
+        from app.services.context_budget import context_budget
+        from app.services.attachment_service import attachment_service
+        from app.services.attachment_index import chunk_index
+        from app.services.single_flight import chat_flights
+        from app.services.admission import admission
+        history_service = getattr(request.app.state, "history_service", None)
+        return {
+            "agent": {**assistant_registry.stats(), "runs": run_stats.snapshot()},
+            "routing": route_stats.snapshot(),
+            "token_reconciliation": reconciliation.snapshot(),
+            "auth": {"jwks": jwks_cache.stats(), "token_cache": token_cache.stats()},
+            "usage": usage_tracker.stats(),
+            "context": context_budget.stats(),
+            "answer_cache": answer_cache.stats(),
+            "single_flight": chat_flights.stats(),
+            "admission": admission.stats(),
+            "attachments": {**attachment_service.stats(), "index": chunk_index.stats()},
+            "cosmos_ru": history_service.request_charges.snapshot() if history_service else {},
+        }
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics(request: Request):
+        return PlainTextResponse(
+            registry.render(extra=service_metrics(request.app)), media_type="text/plain; version=0.0.4"
+        )
+
     return app
 
 app = create_app()
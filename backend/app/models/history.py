@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from typing import List, Optional
 from datetime import datetime, timezone
 import uuid
@@ -27,11 +27,40 @@ class ChatThreadModel(BaseModel):
     created_at: str
     updated_at: str
     messages: List[ChatMessageModel] = []
+
+    # Azure AI Agent thread mirroring this conversation, and how many of
+    # `messages` it already contains (so each turn only appends the new ones).
+    agent_thread_id: Optional[str] = None
+    agent_synced_count: int = 0
+
+    # Rolling summary of every message before absolute index `summary_through`;
+    # only the messages after it are sent verbatim (see context_budget.py).
+    context_summary: Optional[str] = None
+    summary_through: int = 0
+
+    # Content hashes of the documents attached to this conversation; their
+    # chunks are searched on every turn (see attachment_index.py).
+    attachments: List[str] = []
     
     # Required by CosmosDB typically
     partition_key: str = Field(default="")
 
+    # Storage bookkeeping (not serialised): `messages` may hold only the newest
+    # part of the conversation, starting at absolute index `message_offset`, and
+    # the first `persisted_count` messages are already stored.
+    _message_offset: int = PrivateAttr(default=0)
+    _persisted_count: int = PrivateAttr(default=0)
+
     def __init__(self, **data):
         super().__init__(**data)
         if not self.partition_key:
             self.partition_key = self.user_id
+
+    @property
+    def message_offset(self) -> int:
+        return self._message_offset
+
+    @property
+    def message_count(self) -> int:
+        """Total messages in the conversation, including any not loaded."""
+        return self._message_offset + len(self.messages)
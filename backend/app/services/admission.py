@@ -0,0 +1,192 @@
+"""
+Admission control for chat runs.
+
+At most ADMISSION_MAX_CONCURRENT runs execute at once; further requests wait
+in one FIFO queue per tier (the TIER_LIMITS tiers). When a run finishes, the
+freed slot goes to the head of a tier chosen by stride scheduling on
+ADMISSION_TIER_WEIGHTS: with the defaults an Elite request is admitted eight
+times as often as a free one under contention, but no tier is starved.
+
+A request is rejected with AdmissionRejected (served as 503 + Retry-After)
+when ADMISSION_MAX_QUEUE requests are already waiting, or when it has waited
+ADMISSION_QUEUE_TIMEOUT seconds without a slot.
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+
+from app.core.config import settings
+from app.core.usage import TIER_LIMITS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIER = "free"
+WAIT_SAMPLES = 512
+
+
+class AdmissionRejected(Exception):
+    """No slot available; `retry_after` is the suggested wait in whole seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def parse_tier_weights(spec: str) -> Dict[str, float]:
+    """"free:1,pro:2" → {"free": 1.0, "pro": 2.0, ...}; tiers not listed get weight 1."""
+    weights = {tier: 1.0 for tier in TIER_LIMITS}
+    for part in spec.split(","):
+        tier, _, weight = part.partition(":")
+        if tier.strip() and weight.strip():
+            weights[tier.strip()] = max(float(weight), 0.01)
+    return weights
+
+
+class _TierQueue:
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.pass_value = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self.max_wait = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        self.admitted += 1
+        self.waits.append(seconds)
+        self.max_wait = max(self.max_wait, seconds)
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "weight": self.weight,
+            "queued": sum(1 for w in self.waiters if not w.done()),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_s": round(sum(waits) / len(waits), 3) if waits else None,
+            "p95_wait_s": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else None,
+            "max_wait_s": round(self.max_wait, 3),
+        }
+
+
+class AdmissionScheduler:
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        max_queue: int = 64,
+        queue_timeout: float = 30.0,
+        tier_weights: Dict[str, float] = None,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._tiers: Dict[str, _TierQueue] = {
+            tier: _TierQueue(weight) for tier, weight in (tier_weights or parse_tier_weights("")).items()
+        }
+        self._running = 0
+        self._virtual_time = 0.0
+        self._avg_run_s = None  # moving average of slot hold times
+        self.timeouts = 0
+
+    @asynccontextmanager
+    async def slot(self, tier: str):
+        """Hold one run slot for the duration of the block."""
+        await self.acquire(tier)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def check(self, tier: str) -> None:
+        """Fail fast, before any work is done for a request, if it could not even be queued."""
+        if self._running >= self.max_concurrent and self.queued >= self.max_queue:
+            self._tier(tier).rejected += 1
+            raise AdmissionRejected("queue_full", self.retry_after())
+
+    async def acquire(self, tier: str) -> None:
+        queue = self._tier(tier)
+        if self._running < self.max_concurrent and not self.queued:
+            self._running += 1
+            queue.record_wait(0.0)
+            return
+
+        self.check(tier)
+        waiter = asyncio.get_running_loop().create_future()
+        if not any(not w.done() for w in queue.waiters):
+            # A tier that was idle rejoins at the current virtual time instead of its stale pass value.
+            queue.pass_value = max(queue.pass_value, self._virtual_time)
+        queue.waiters.append(waiter)
+        self._grant()
+        enqueued = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release(None)  # the slot was granted just as we gave up; pass it on
+            else:
+                waiter.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.timeouts += 1
+                queue.rejected += 1
+                raise AdmissionRejected("queue_timeout", self.retry_after())
+            raise
+        queue.record_wait(time.monotonic() - enqueued)
+
+    def release(self, held_seconds=None) -> None:
+        self._running -= 1
+        if held_seconds is not None:
+            self._avg_run_s = held_seconds if self._avg_run_s is None else 0.9 * self._avg_run_s + 0.1 * held_seconds
+        self._grant()
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for q in self._tiers.values() for w in q.waiters if not w.done())
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to free up for a newly queued request."""
+        per_run = self._avg_run_s or 30.0
+        return max(1, min(120, math.ceil(per_run * (self.queued + 1) / self.max_concurrent)))
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "max_concurrent": self.max_concurrent,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "timeouts": self.timeouts,
+            "avg_run_s": round(self._avg_run_s, 3) if self._avg_run_s is not None else None,
+            "tiers": {tier: q.stats() for tier, q in self._tiers.items()},
+        }
+
+    def _tier(self, tier: str) -> _TierQueue:
+        return self._tiers.get(tier) or self._tiers.setdefault(DEFAULT_TIER, _TierQueue(1.0))
+
+    def _grant(self) -> None:
+        while self._running < self.max_concurrent:
+            for queue in self._tiers.values():
+                while queue.waiters and queue.waiters[0].done():
+                    queue.waiters.popleft()  # cancelled or timed out
+            active = [q for q in self._tiers.values() if q.waiters]
+            if not active:
+                return
+            queue = min(active, key=lambda q: q.pass_value)
+            self._virtual_time = queue.pass_value
+            queue.pass_value += 1.0 / queue.weight
+            self._running += 1
+            queue.waiters.popleft().set_result(None)
+
+
+admission = AdmissionScheduler(
+    max_concurrent=settings.ADMISSION_MAX_CONCURRENT,
+    max_queue=settings.ADMISSION_MAX_QUEUE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT,
+    tier_weights=parse_tier_weights(settings.ADMISSION_TIER_WEIGHTS),
+)
@@ -1,9 +1,21 @@
 import os
+import json
+import asyncio
+import hashlib
 import logging
-from typing import Optional
+import re
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, List, Optional, Set, Tuple
 from azure.ai.projects.aio import AIProjectClient
 from azure.identity.aio import DefaultAzureCredential
 from azure.ai.agents.models import BingGroundingTool
+from openai import BadRequestError, NotFoundError
+from opentelemetry import trace
+from app.core.config import settings
+from app.core.metrics import agent_run_status, agent_runs_in_flight
+from app.core.tracing import set_usage_attributes, tracer
+from app.services.sanitization_service import SanitizationService
 
 logger = logging.getLogger(__name__)
 
@@ -99,23 +111,292 @@ Always structure answers using this exact format:
 - **Multimodal Products:** Devices with multiple radio technologies (BT + Wi-Fi + LTE) requiring \
   simultaneous multi-band certification across jurisdictions"""
 
+AGENT_MODEL = "gpt-4o"
+AGENT_NAME = "ComplianceAgent"
+OPENAI_API_VERSION = "2024-05-01-preview"
+
+# ---------------------------------------------------------------------------
+# Turn routing — full grounded agent vs. fast no-tool completion
+# ---------------------------------------------------------------------------
+ROUTE_AGENT = "agent"    # Azure AI Agent + Bing Grounding (multi-search research)
+ROUTE_DIRECT = "direct"  # Plain chat completion over the conversation so far
+ROUTE_CACHE = "cache"    # Served from the answer cache (see answer_cache.py)
+
+DIRECT_SYSTEM_PROMPT = """You are the Global Type Approval (GTA) Compliance Specialist continuing \
+a conversation. The user's new message asks you to rework, explain or reformat information that is \
+already in the conversation above. Answer using ONLY that information. Do not introduce frequency bands, \
+power limits, dates, fees or standard numbers that do not already appear in the conversation; if the \
+request needs new regulatory facts, say that a new research query is needed. Keep any citations that \
+appear in the earlier answers."""
+
+CLASSIFIER_PROMPT = """Decide whether a chat message needs NEW regulatory research (live web searches) \
+or can be answered from the conversation so far (summarising, reformatting, translating or explaining \
+earlier answers). Reply with exactly one word: RESEARCH or CONTEXT."""
+
+# Asks for information the conversation may not contain yet.
+_RESEARCH_CUES = re.compile(
+    r"\b(latest|current(ly)?|amend\w*|updat\w*|revis\w*|search|look\s+up|find|sources?|cite|citations?|"
+    r"verify|official|links?|urls?|recent|new|still|requirements?\s+for|20\d\d)\b",
+    re.IGNORECASE,
+)
+# Explicitly asks to rework what is already in the conversation. Pronouns ("it", "this", "that")
+# are not cues: "Does this also apply to BLE?" is a new research question.
+_FOLLOW_UP_CUES = re.compile(
+    r"\b(summar\w*|table|tabular|translate|rephrase|reword|shorte\w*|simplif\w*|bullets?|re-?format\w*|"
+    r"rewrite|condense|tl;?dr|thanks|thank\s+you)\b",
+    re.IGNORECASE,
+)
+# Names a band, device, standard or requirement; research when the conversation has not covered it.
+_SUBJECT_TERMS = re.compile(
+    r"\d+(?:\.\d+)?\s*[kmgt]hz\b|\d+(?:\.\d+)?\s*(?:dbm|mw)\b|"
+    r"\b(?:bluetooth|ble|wi-?fi(?:\s*\d+e?)?|wlan|lte|5g|nr|nfc|uwb|zigbee|lora\w*|rfid|gsm|dect|srd|"
+    r"access\s+points?|routers?|smartphones?|wearables?|drones?|modules?|"
+    r"(?:en|iec|iso|etsi|ieee|cispr|rss|as/nzs)\s*[\d][\d.\-]*|part\s*\d+|"
+    r"accredit\w*|test(?:ing)?\s+labs?|label+ing|marking|sar|emc|safety|certificat\w*|registration|fees?|"
+    r"local\s+representatives?|import\w*|renewal|validity)\b",
+    re.IGNORECASE,
+)
+
 # ---------------------------------------------------------------------------
 # Module-level Bing tools cache — resolved once per process lifetime
 # ---------------------------------------------------------------------------
 _cached_bing_definitions: Optional[list] = None
 _bing_cache_populated: bool = False
 
+# Shared AsyncAzureOpenAI client — get_openai_client() builds a fresh client
+# (and connection pool) on every call, so it is resolved once and reused.
+_cached_openai_client = None
+
 
 class AgentResult:
-    def __init__(self, text: str, usage_metadata: dict, sources: list = None):
+    def __init__(
+        self,
+        text: str,
+        usage_metadata: dict,
+        sources: list = None,
+        thread_id: str = None,
+        completed: bool = False,
+        route: str = None,
+    ):
         self.text = text
         self.metadata = usage_metadata
         self.sources = sources or []
+        self.thread_id = thread_id  # Agent thread the run executed on
+        self.completed = completed  # True when the reply was produced by a completed run
+        self.route = route or ROUTE_AGENT  # Which path produced the reply; only "agent" touches the agent thread
+        self.coalesced = False  # True on copies handed to requests that shared another request's run
 
     def __str__(self):
         return self.text
 
 
+class AssistantRegistry:
+    """
+    Lifecycle manager for the persistent Compliance agent.
+
+    The assistant is keyed by a fingerprint of model + instructions + tool
+    definitions, stored in its metadata. On first use a process adopts the
+    newest assistant named AGENT_NAME with a matching fingerprint (left by a
+    previous start or registered by another worker) and deletes the other
+    assistants with that fingerprint; only when none matches is a new one
+    created. Assistants with another fingerprint may still be in use by
+    workers on another deploy: they are marked superseded in their metadata
+    and only deleted once that mark is older than AGENT_STALE_GRACE_SECONDS.
+    Requests reuse the registered assistant while the fingerprint matches; a
+    changed prompt or tool set rotates it (create new, delete old). The
+    assistant is kept on shutdown for the next start.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._assistant_id: Optional[str] = None
+        self._fingerprint: Optional[str] = None
+        self.creates = 0
+        self.creates_avoided = 0
+        self.adopted = 0
+        self.rotations = 0
+
+    @staticmethod
+    def fingerprint(model: str, instructions: str, tools: list) -> str:
+        def _default(obj):
+            return obj.as_dict() if hasattr(obj, "as_dict") else str(obj)
+
+        payload = json.dumps(
+            {"model": model, "instructions": instructions, "tools": tools},
+            sort_keys=True,
+            default=_default,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get_assistant_id(self, openai_client, model: str, instructions: str, tools: list) -> str:
+        """Return the id of an assistant matching the given definition, creating it if needed."""
+        key = self.fingerprint(model, instructions, tools)
+        if self._assistant_id and self._fingerprint == key:
+            self.creates_avoided += 1
+            return self._assistant_id
+
+        async with self._lock:
+            # Another request may have created it while we waited for the lock.
+            if self._assistant_id and self._fingerprint == key:
+                self.creates_avoided += 1
+                return self._assistant_id
+
+            stale_id = self._assistant_id
+            if stale_id is None:
+                adopted_id = await self._adopt(openai_client, key)
+                if adopted_id:
+                    self._assistant_id, self._fingerprint = adopted_id, key
+                    self.adopted += 1
+                    return adopted_id
+
+            trace.get_current_span().set_attribute("agent.assistant_created", True)
+            agent = await openai_client.beta.assistants.create(
+                model=model,
+                name=AGENT_NAME,
+                instructions=instructions,
+                tools=tools,
+                metadata={"fingerprint": key[:32]},
+            )
+            self._assistant_id, self._fingerprint = agent.id, key
+            self.creates += 1
+            logger.info(f"Registered agent {agent.id} with {len(tools)} tool(s).")
+
+            if stale_id:
+                self.rotations += 1
+                logger.info(f"Agent definition changed; rotating out {stale_id}.")
+                await self._delete(openai_client, stale_id)
+            return agent.id
+
+    def invalidate(self) -> None:
+        """Forget the registered assistant so the next request recreates it."""
+        self._assistant_id = None
+        self._fingerprint = None
+
+    async def close(self, openai_client) -> None:
+        """Forget the registered assistant (application shutdown); the next start adopts it."""
+        async with self._lock:
+            self.invalidate()
+
+    def stats(self) -> dict:
+        return {
+            "assistant_id": self._assistant_id,
+            "creates": self.creates,
+            "creates_avoided": self.creates_avoided,
+            "adopted": self.adopted,
+            "rotations": self.rotations,
+        }
+
+    @tracer.start_as_current_span("agent.adopt_assistant")
+    async def _adopt(self, openai_client, key: str) -> Optional[str]:
+        """
+        The newest AGENT_NAME assistant whose metadata fingerprint matches `key`,
+        or None. Older assistants with the same fingerprint are deleted; ones
+        with another fingerprint are marked superseded, and deleted once the
+        mark is older than the grace period. Lookup failures are logged and
+        treated as no match.
+        """
+        try:
+            ours = [a async for a in openai_client.beta.assistants.list(limit=100, order="desc") if a.name == AGENT_NAME]
+        except Exception as e:
+            logger.warning(f"Could not list existing agents, registering a new one: {e}")
+            return None
+        matching = [a for a in ours if (a.metadata or {}).get("fingerprint") == key[:32]]
+        keep = max(matching, key=lambda a: a.created_at or 0) if matching else None
+        now = int(time.time())
+        for assistant in ours:
+            if assistant is keep:
+                continue
+            if assistant in matching:
+                logger.info(f"Deleting duplicate agent {assistant.id}.")
+                await self._delete(openai_client, assistant.id)
+                continue
+            metadata = dict(assistant.metadata or {})
+            try:
+                superseded_at = int(metadata["superseded_at"])
+            except (KeyError, ValueError):
+                metadata["superseded_at"] = str(now)
+                logger.info(f"Leaving agent {assistant.id} with another definition; marked superseded.")
+                await self._update_metadata(openai_client, assistant.id, metadata)
+                continue
+            if now - superseded_at >= settings.AGENT_STALE_GRACE_SECONDS:
+                logger.info(f"Deleting agent {assistant.id}, superseded {now - superseded_at}s ago.")
+                await self._delete(openai_client, assistant.id)
+            else:
+                logger.info(f"Leaving agent {assistant.id}, superseded {now - superseded_at}s ago.")
+        if keep is None:
+            return None
+        if "superseded_at" in (keep.metadata or {}):
+            # Marked by a worker on another definition; this one is still in use.
+            await self._update_metadata(openai_client, keep.id, {"fingerprint": key[:32]})
+        logger.info(f"Reusing registered agent {keep.id}.")
+        return keep.id
+
+    @staticmethod
+    async def _update_metadata(openai_client, assistant_id: str, metadata: dict) -> None:
+        try:
+            await openai_client.beta.assistants.update(assistant_id, metadata=metadata)
+        except Exception as e:
+            logger.warning(f"Failed to update agent {assistant_id}: {e}")
+
+    @staticmethod
+    async def _delete(openai_client, assistant_id: str) -> None:
+        try:
+            await openai_client.beta.assistants.delete(assistant_id)
+            logger.info(f"Deleted agent {assistant_id}.")
+        except Exception as e:
+            logger.warning(f"Failed to delete agent {assistant_id}: {e}")
+
+
+assistant_registry = AssistantRegistry()
+
+
+class RouteStats:
+    """
+    Per-route turn counts, latency and charged tokens, so the time and quota
+    saved by skipping the grounded agent can be measured.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._reasons = {}
+        self.classifier_calls = 0
+        self.classifier_tokens = 0
+
+    def record_latency(self, route: str, reason: str, seconds: float) -> None:
+        entry = self._route(route)
+        entry["turns"] += 1
+        entry["latency_s"] += seconds
+        self._reasons[reason] = self._reasons.get(reason, 0) + 1
+
+    def record_tokens(self, route: str, tokens: int) -> None:
+        entry = self._route(route)
+        entry["charged"] += 1
+        entry["tokens"] += tokens
+
+    def snapshot(self) -> dict:
+        routes = {
+            route: {
+                "turns": e["turns"],
+                "avg_latency_s": round(e["latency_s"] / e["turns"], 3) if e["turns"] else None,
+                "total_tokens": e["tokens"],
+                "avg_tokens": round(e["tokens"] / e["charged"]) if e["charged"] else None,
+            }
+            for route, e in self._routes.items()
+        }
+        return {
+            "routes": routes,
+            "reasons": dict(self._reasons),
+            "classifier_calls": self.classifier_calls,
+            "classifier_tokens": self.classifier_tokens,
+        }
+
+    def _route(self, route: str) -> dict:
+        return self._routes.setdefault(route, {"turns": 0, "latency_s": 0.0, "charged": 0, "tokens": 0})
+
+
+route_stats = RouteStats()
+
+
 async def create_kernel() -> Optional[AIProjectClient]:
     """
     Initializes AIProjectClient.
@@ -163,6 +444,133 @@ async def _resolve_bing_tools(client: AIProjectClient) -> list:
     return []
 
 
+async def get_openai_client(client: AIProjectClient):
+    """Returns the process-wide AsyncAzureOpenAI client, creating it on first use."""
+    global _cached_openai_client
+
+    if _cached_openai_client is None:
+        _cached_openai_client = await client.get_openai_client(api_version=OPENAI_API_VERSION)
+    return _cached_openai_client
+
+
+@tracer.start_as_current_span("agent.get_assistant")
+async def _get_agent_id(client: AIProjectClient, openai_client) -> str:
+    tool_definitions = await _resolve_bing_tools(client)
+    return await assistant_registry.get_assistant_id(
+        openai_client, AGENT_MODEL, SYSTEM_PROMPT, tool_definitions
+    )
+
+
+async def warm_up_agent(client: AIProjectClient) -> None:
+    """
+    Resolves the Bing tools and registers the Compliance agent at startup so the
+    first chat request does not pay for it. Failures are logged, not raised; the
+    registry will retry lazily on the next request.
+    """
+    if not client:
+        return
+    try:
+        openai_client = await get_openai_client(client)
+        await _get_agent_id(client, openai_client)
+    except Exception as e:
+        logger.warning(f"Agent warm-up failed, will create lazily: {e}")
+
+
+async def shutdown_agent() -> None:
+    """Forgets the registered agent (kept for the next start) and closes the shared OpenAI client."""
+    global _cached_openai_client
+
+    if _cached_openai_client is None:
+        return
+    await assistant_registry.close(_cached_openai_client)
+    await _cached_openai_client.close()
+    _cached_openai_client = None
+
+
+def _as_thread_messages(turns: Optional[list]) -> list:
+    """Converts {"role", "content"} turns into Assistants thread message params."""
+    return [
+        {"role": turn.get("role", "user"), "content": turn.get("content", "")}
+        for turn in (turns or [])
+        if turn.get("content") and turn.get("role", "user") in ("user", "assistant")
+    ]
+
+
+@tracer.start_as_current_span("agent.prepare_thread")
+async def _prepare_thread(
+    openai_client,
+    message: str,
+    history: Optional[list],
+    agent_thread_id: Optional[str],
+    unsynced_history: Optional[list],
+) -> Tuple[str, List[str]]:
+    """
+    Returns (thread id, ids of the messages added to an existing thread) for
+    an agent thread holding the full conversation plus the current user message.
+
+    An existing thread only receives the turns it has not seen yet (normally
+    none) and the new message. If it no longer exists, a fresh thread is
+    created with the whole history in a single batched call.
+    """
+    span = trace.get_current_span()
+    if agent_thread_id:
+        added = []
+        try:
+            span.set_attribute("agent.replayed_messages", len(_as_thread_messages(unsynced_history)))
+            for turn in _as_thread_messages(unsynced_history) + [{"role": "user", "content": message}]:
+                created = await openai_client.beta.threads.messages.create(thread_id=agent_thread_id, **turn)
+                added.append(created.id)
+            return agent_thread_id, added
+        except NotFoundError:
+            logger.info(f"Agent thread {agent_thread_id} no longer exists; replaying history.")
+        except BadRequestError as e:
+            # e.g. a cancelled run that is still winding down, or another turn's run, on the thread
+            logger.info(f"Agent thread {agent_thread_id} cannot take messages ({e}); replaying history.")
+            run_in_background(_delete_messages(openai_client, agent_thread_id, added))
+
+    seed = _as_thread_messages(history) + [{"role": "user", "content": message}]
+    span.set_attribute("agent.new_thread", True)
+    span.set_attribute("agent.replayed_messages", len(seed) - 1)
+    try:
+        thread = await openai_client.beta.threads.create(messages=seed)
+    except BadRequestError as e:
+        # Some API versions reject "assistant" role messages on create; keep the user turns.
+        logger.debug(f"Batched history replay rejected, retrying with user turns only: {e}")
+        thread = await openai_client.beta.threads.create(
+            messages=[m for m in seed if m["role"] == "user"]
+        )
+    return thread.id, []
+
+
+def _has_active_run(e: BadRequestError) -> bool:
+    """True for the error runs.create raises while another run is active on the thread."""
+    return "active run" in str(e).lower()
+
+
+async def _fork_thread(
+    openai_client, busy_thread_id: str, added_message_ids: List[str], message: str, history: Optional[list]
+) -> str:
+    """
+    Moves a turn whose agent thread is busy with another turn of the same
+    conversation (a double submit, a second tab) to a fresh thread with the
+    history replayed. The messages it added to the busy thread are removed,
+    best effort, so that thread keeps matching the saved history.
+    """
+    logger.info(f"Agent thread {busy_thread_id} has an active run from another turn; replaying history.")
+    run_in_background(_delete_messages(openai_client, busy_thread_id, added_message_ids))
+    thread_id, _ = await _prepare_thread(openai_client, message, history, None, None)
+    return thread_id
+
+
+async def _delete_messages(openai_client, thread_id: str, message_ids: List[str]) -> None:
+    for message_id in message_ids:
+        try:
+            await openai_client.beta.threads.messages.delete(message_id, thread_id=thread_id)
+        except Exception as e:
+            logger.warning(f"Could not remove message {message_id} from agent thread {thread_id}: {e}")
+            return
+
+
 def _extract_text_and_citations(message) -> tuple:
     """
     Extracts the plain-text response and a de-duplicated list of citation URLs
@@ -186,108 +594,648 @@ def _extract_text_and_citations(message) -> tuple:
     return "".join(text_parts), sources
 
 
+def _run_metadata(run) -> dict:
+    metadata = {"model": f"{AGENT_MODEL} (Azure AI Agent + Bing Grounding)"}
+    if getattr(run, "usage", None):
+        class _Usage:
+            def __init__(self, r):
+                self.total_tokens = getattr(r.usage, "total_tokens", 0)
+                self.prompt_tokens = getattr(r.usage, "prompt_tokens", 0)
+                self.completion_tokens = getattr(r.usage, "completion_tokens", 0)
+        metadata["usage"] = _Usage(run)
+    return metadata
+
+
+def _incomplete_run_result(run, thread_id: str, status: Optional[str] = None) -> AgentResult:
+    """Maps a run that did not complete to a user-facing AgentResult (`status` overrides the run's)."""
+    status = status or run.status
+    logger.error(
+        f"Run {run.id} ended with status '{status}'. "
+        f"last_error={getattr(run, 'last_error', None)}"
+    )
+    friendly_errors = {
+        "failed":    "The agent encountered an error while researching your query. Please try again.",
+        "expired":   "The search took too long and timed out. Try a more specific question.",
+        "cancelled": "The request was cancelled.",
+    }
+    msg = friendly_errors.get(status, f"Unexpected agent status: {status}.")
+    return AgentResult(text=msg, usage_metadata={}, sources=[], thread_id=thread_id)
+
+
+# ---------------------------------------------------------------------------
+# Run driver — adaptive polling with overall and per-step timeouts
+# ---------------------------------------------------------------------------
+# Polls start at RUN_POLL_INITIAL_SECONDS, so short answers are picked up
+# promptly, and back off by RUN_POLL_BACKOFF up to RUN_POLL_MAX_SECONDS, so a
+# two-minute multi-search run costs a few dozen polls rather than one a
+# second. A run is cancelled on the service when it exceeds
+# RUN_TIMEOUT_SECONDS, when no new run step appears for
+# RUN_STEP_TIMEOUT_SECONDS, or when the task driving it is cancelled.
+
+RUN_POLL_BACKOFF = 1.5
+TERMINAL_RUN_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete", "requires_action"}
+
+
+class RunDriverStats:
+    def __init__(self):
+        self.runs = 0
+        self.polls = 0
+        self.step_checks = 0
+        self.timeouts = 0
+        self.step_timeouts = 0
+        self.cancelled = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "runs": self.runs,
+            "avg_polls": round(self.polls / self.runs, 1) if self.runs else None,
+            "step_checks": self.step_checks,
+            "timeouts": self.timeouts,
+            "step_timeouts": self.step_timeouts,
+            "cancelled": self.cancelled,
+        }
+
+
+run_stats = RunDriverStats()
+
+
+async def _latest_step(openai_client, thread_id: str, run_id: str) -> Optional[Tuple[str, str]]:
+    """(id, status) of the run's newest step, or None before the first one."""
+    run_stats.step_checks += 1
+    steps = await openai_client.beta.threads.runs.steps.list(
+        thread_id=thread_id, run_id=run_id, limit=1, order="desc"
+    )
+    return (steps.data[0].id, steps.data[0].status) if steps.data else None
+
+
+async def cancel_run(openai_client, thread_id: str, run_id: str) -> None:
+    """Best-effort cancellation of a run on the service."""
+    try:
+        await openai_client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        run_stats.cancelled += 1
+        logger.info(f"Cancelled run {run_id} on thread {thread_id}.")
+    except Exception as e:
+        logger.warning(f"Could not cancel run {run_id}: {e}")
+
+
+async def discard_thread(openai_client, thread_id: str) -> None:
+    """Best-effort deletion of an agent thread left inconsistent by an abandoned run."""
+    try:
+        await openai_client.beta.threads.delete(thread_id)
+        logger.info(f"Deleted abandoned agent thread {thread_id}.")
+    except Exception as e:
+        logger.warning(f"Could not delete agent thread {thread_id}: {e}")
+
+
+async def abandon_run(openai_client, thread_id: str, run_id: Optional[str]) -> None:
+    """
+    Clean up after a client that went away mid-run: stop the run, then drop
+    the agent thread, which now holds a user message our history will not
+    (the next turn replays the history into a fresh thread).
+    """
+    if run_id:
+        await cancel_run(openai_client, thread_id, run_id)
+    await discard_thread(openai_client, thread_id)
+
+
+_background_tasks: set = set()
+
+
+def run_in_background(coro) -> asyncio.Task:
+    """Run cleanup that must outlive a cancelled request; the task is kept referenced until done."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def _count_tool_calls(openai_client, thread_id: str, run_id: str) -> Optional[int]:
+    """Tool (Bing) calls made by a finished run, or None if they cannot be listed."""
+    try:
+        steps = await openai_client.beta.threads.runs.steps.list(thread_id=thread_id, run_id=run_id, limit=100)
+    except Exception as e:
+        logger.debug(f"Could not list steps of run {run_id}: {e}")
+        return None
+    details = [getattr(step, "step_details", None) for step in steps.data]
+    return sum(len(getattr(d, "tool_calls", None) or []) for d in details if getattr(d, "type", None) == "tool_calls")
+
+
+@tracer.start_as_current_span("agent.run")
+async def drive_run(
+    openai_client,
+    thread_id: str,
+    assistant_id: str,
+    timeout: float = settings.RUN_TIMEOUT_SECONDS,
+    step_timeout: float = settings.RUN_STEP_TIMEOUT_SECONDS,
+    **run_options,
+) -> Tuple[object, Optional[str]]:
+    """
+    Create a run and poll it to a terminal status.
+    Returns (run, timeout_reason), where timeout_reason is "timeout" or
+    "step_timeout" if the run was cancelled for taking too long.
+    """
+    runs = openai_client.beta.threads.runs
+    run = await runs.create(thread_id=thread_id, assistant_id=assistant_id, **run_options)
+    run_stats.runs += 1
+    span = trace.get_current_span()
+    span.set_attribute("agent.run_id", run.id)
+    polls = 0
+    outcome = "error"
+    agent_runs_in_flight.inc()
+
+    start = time.monotonic()
+    progress_at = start
+    interval = settings.RUN_POLL_INITIAL_SECONDS
+    last_status, last_step = run.status, None
+    try:
+        while run.status not in TERMINAL_RUN_STATUSES:
+            now = time.monotonic()
+            if now - start >= timeout:
+                run_stats.timeouts += 1
+                outcome = "timeout"
+                span.set_attributes({"agent.run_status": outcome, "agent.polls": polls})
+                await cancel_run(openai_client, thread_id, run.id)
+                return run, outcome
+            if now - progress_at >= step_timeout:
+                step = await _latest_step(openai_client, thread_id, run.id)
+                if step == last_step:
+                    run_stats.step_timeouts += 1
+                    outcome = "step_timeout"
+                    span.set_attributes({"agent.run_status": outcome, "agent.polls": polls})
+                    await cancel_run(openai_client, thread_id, run.id)
+                    return run, outcome
+                last_step, progress_at = step, now
+
+            await asyncio.sleep(min(interval, max(0.0, start + timeout - now)))
+            interval = min(interval * RUN_POLL_BACKOFF, settings.RUN_POLL_MAX_SECONDS)
+            run = await runs.retrieve(thread_id=thread_id, run_id=run.id)
+            run_stats.polls += 1
+            polls += 1
+            if run.status != last_status:
+                last_status, progress_at = run.status, time.monotonic()
+
+        outcome = run.status
+        span.set_attributes({"agent.run_status": run.status, "agent.polls": polls})
+        set_usage_attributes(span, getattr(run, "usage", None))
+        if span.is_recording() and run.status == "completed":
+            # One extra API call, made only while traces are being recorded.
+            tool_calls = await _count_tool_calls(openai_client, thread_id, run.id)
+            if tool_calls is not None:
+                span.set_attribute("agent.bing_tool_calls", tool_calls)
+        return run, None
+    except asyncio.CancelledError:
+        # The caller went away: stop the run so it no longer consumes tokens and Bing calls.
+        outcome = "abandoned"
+        await asyncio.shield(cancel_run(openai_client, thread_id, run.id))
+        raise
+    finally:
+        agent_runs_in_flight.dec()
+        agent_run_status.inc(status=outcome)
+
+
+def _mentions(text: str) -> set:
+    """Regulation IDs and jurisdiction codes mentioned in the text."""
+    found = set(SanitizationService.identify_jurisdictions(text))
+    regulation_id = SanitizationService.identify_regulation_id(text.upper())
+    if regulation_id != "UNKNOWN_REGULATION_ID":
+        found.add(regulation_id)
+    return found
+
+
+def _new_subjects(message: str, context_summary: Optional[str], history: Optional[list]) -> Set[str]:
+    """Bands, devices, standards and requirement topics in `message` that the conversation has not mentioned."""
+    covered = " ".join([context_summary or ""] + [turn.get("content", "") for turn in history or []])
+    covered = re.sub(r"\s+", "", covered).lower()
+    terms = {re.sub(r"\s+", "", m.group(0)).lower() for m in _SUBJECT_TERMS.finditer(message)}
+    return {term for term in terms if term not in covered}
+
+
+@tracer.start_as_current_span("agent.classify")
+async def classify_turn(
+    openai_client,
+    message: str,
+    history: Optional[list],
+    has_attachment: bool = False,
+    context_summary: Optional[str] = None,
+) -> Tuple[str, str]:
+    """
+    Decides whether a turn needs the grounded agent or can be answered from the
+    conversation with a single no-tool completion. Returns (route, reason).
+
+    Rules first; anything they cannot decide goes to the agent, or to a one-word
+    model classification when ROUTER_MODEL_CLASSIFIER is enabled. Mentioning a
+    regulation, jurisdiction, band, device or requirement that the conversation
+    has not covered yet always means research; only explicit rework requests
+    (summarise, shorten, tabulate, translate, reformat) go direct by rule.
+    """
+    if not settings.ROUTER_ENABLED:
+        return ROUTE_AGENT, "router_disabled"
+    if not history and not context_summary:
+        return ROUTE_AGENT, "first_turn"
+    if has_attachment:
+        return ROUTE_AGENT, "attachment"
+
+    covered = _mentions(context_summary or "")
+    for turn in history or []:
+        covered |= _mentions(turn.get("content", ""))
+    if _mentions(message) - covered:
+        return ROUTE_AGENT, "new_regulation"
+    if _RESEARCH_CUES.search(message):
+        return ROUTE_AGENT, "research_cue"
+    if _new_subjects(message, context_summary, history):
+        return ROUTE_AGENT, "new_subject"
+    if _FOLLOW_UP_CUES.search(message):
+        return ROUTE_DIRECT, "follow_up_cue"
+
+    if settings.ROUTER_MODEL_CLASSIFIER:
+        try:
+            response = await openai_client.chat.completions.create(
+                model=settings.AZURE_OPENAI_CHAT_DEPLOYMENT,
+                messages=[
+                    {"role": "system", "content": CLASSIFIER_PROMPT},
+                    {"role": "user", "content": f"Previous answer:\n{(history or [{}])[-1].get('content', '')[:1500]}\n\n"
+                                                f"New message:\n{message}"},
+                ],
+                max_tokens=5,
+                temperature=0,
+            )
+            route_stats.classifier_calls += 1
+            route_stats.classifier_tokens += getattr(response.usage, "total_tokens", 0) or 0
+            if "CONTEXT" in (response.choices[0].message.content or "").upper():
+                return ROUTE_DIRECT, "model_context"
+            return ROUTE_AGENT, "model_research"
+        except Exception as e:
+            logger.warning(f"Turn classifier call failed, using the agent: {e}")
+
+    return ROUTE_AGENT, "default"
+
+
+def _summary_instructions(context_summary: Optional[str]) -> Optional[str]:
+    if not context_summary:
+        return None
+    return f"Summary of the earlier part of this conversation:\n{context_summary}"
+
+
+def _direct_messages(message: str, history: Optional[list], context_summary: Optional[str]) -> list:
+    summary = _summary_instructions(context_summary)
+    return (
+        [{"role": "system", "content": DIRECT_SYSTEM_PROMPT}]
+        + ([{"role": "system", "content": summary}] if summary else [])
+        + _as_thread_messages(history)
+        + [{"role": "user", "content": message}]
+    )
+
+
+def with_attachment(message: str, attachment_context: Optional[str]) -> str:
+    """The user message as sent to the model, with extracted attachment text appended."""
+    if not attachment_context:
+        return message
+    return (
+        f"{message}\n\n---\nThe user attached a document. Use the extracted text below as the document's "
+        f"content; quote page numbers where given.\n\n{attachment_context}"
+    )
+
+
+def build_prompt_messages(route: str, message: str, history: Optional[list], context_summary: Optional[str]) -> list:
+    """The chat messages a turn on `route` sends to the model, for local token counting."""
+    if route == ROUTE_DIRECT:
+        return _direct_messages(message, history, context_summary)
+    summary = _summary_instructions(context_summary)
+    return (
+        [{"role": "system", "content": SYSTEM_PROMPT}]
+        + ([{"role": "system", "content": summary}] if summary else [])
+        + _as_thread_messages(history)
+        + [{"role": "user", "content": message}]
+    )
+
+
+def _run_context_options(history: Optional[list], context_summary: Optional[str]) -> dict:
+    """
+    Run options limiting the agent to the same context window as the direct route:
+    the agent thread keeps every message, but the run only reads the verbatim
+    window plus the new message, with the rolling summary as extra instructions.
+    """
+    options = {"truncation_strategy": {"type": "last_messages", "last_messages": len(history or []) + 1}}
+    summary = _summary_instructions(context_summary)
+    if summary:
+        options["additional_instructions"] = summary
+    return options
+
+
+def _direct_result(text: str, model: Optional[str], usage, agent_thread_id: Optional[str]) -> AgentResult:
+    metadata = {"model": f"{model or settings.AZURE_OPENAI_CHAT_DEPLOYMENT} (direct)"}
+    if usage is not None:
+        metadata["usage"] = usage
+    # The agent thread did not see this turn; it is replayed as unsynced history on the next agent run.
+    return AgentResult(
+        text=text.strip(), usage_metadata=metadata, sources=[],
+        thread_id=agent_thread_id, completed=True, route=ROUTE_DIRECT,
+    )
+
+
+@tracer.start_as_current_span("agent.direct_completion")
+async def _direct_completion(
+    openai_client, message: str, history: list, agent_thread_id: Optional[str], context_summary: Optional[str]
+) -> AgentResult:
+    response = await openai_client.chat.completions.create(
+        model=settings.AZURE_OPENAI_CHAT_DEPLOYMENT,
+        messages=_direct_messages(message, history, context_summary),
+    )
+    set_usage_attributes(trace.get_current_span(), response.usage)
+    return _direct_result(
+        response.choices[0].message.content or "", response.model, response.usage, agent_thread_id
+    )
+
+
+async def _stream_direct_completion(
+    openai_client, message: str, history: list, agent_thread_id: Optional[str], context_summary: Optional[str]
+) -> AsyncIterator[Tuple[str, object]]:
+    stream = await openai_client.chat.completions.create(
+        model=settings.AZURE_OPENAI_CHAT_DEPLOYMENT,
+        messages=_direct_messages(message, history, context_summary),
+        stream=True,
+    )
+    text_parts = []
+    model = None
+    usage = None
+    try:
+        async for chunk in stream:
+            model = chunk.model or model
+            usage = getattr(chunk, "usage", None) or usage
+            for choice in chunk.choices or []:
+                text = getattr(choice.delta, "content", None)
+                if text:
+                    text_parts.append(text)
+                    yield "delta", {"text": text}
+    finally:
+        await stream.close()
+    yield "result", _direct_result("".join(text_parts), model, usage, agent_thread_id)
+
+
+@tracer.start_as_current_span("agent.process_turn")
 async def process_chat_message(
     client: AIProjectClient,
     message: str,
-    file_content: bytes = None,
-    file_name: str = None,
-    file_content_type: str = None,
+    attachment_context: str = None,
     history: list = None,
+    agent_thread_id: str = None,
+    unsynced_history: list = None,
+    context_summary: str = None,
 ) -> Optional[AgentResult]:
     """
-    Processes a user's compliance query using Azure AI Agent Service with Bing Grounding.
+    Processes a user's compliance query using Azure AI Agent Service with Bing Grounding,
+    or with a fast no-tool completion when classify_turn() finds the turn only
+    reworks earlier answers.
 
     Args:
-        client:   Initialised AIProjectClient.
-        message:  The user's current query.
-        history:  List of prior conversation turns as {"role": str, "content": str} dicts,
-                  oldest-first. The agent replays these into the thread for full context.
+        client:             Initialised AIProjectClient.
+        message:            The user's current query.
+        attachment_context: Extracted text from the user's attachment for this turn, if any.
+        history:            List of prior conversation turns as {"role": str, "content": str} dicts,
+                            oldest-first. Only replayed when no usable agent thread exists.
+        agent_thread_id:    Agent thread from a previous turn of this conversation, if any.
+        unsynced_history:   Turns from `history` that `agent_thread_id` has not seen yet.
+        context_summary:    Rolling summary of the conversation before `history`, if any.
     """
     if not client:
         logger.error("AIProjectClient not initialized.")
         return None
 
+    start = time.perf_counter()
+    try:
+        openai_client = await get_openai_client(client)
+        route, reason = await classify_turn(
+            openai_client, message, history, has_attachment=bool(attachment_context), context_summary=context_summary
+        )
+        message = with_attachment(message, attachment_context)
+        logger.info(f"Turn routed to '{route}' ({reason}).")
+        trace.get_current_span().set_attributes({"chat.route": route, "chat.route_reason": reason})
+
+        if route == ROUTE_DIRECT:
+            result = await _direct_completion(openai_client, message, history, agent_thread_id, context_summary)
+        else:
+            result = await _run_agent(
+                client, openai_client, message, history, agent_thread_id, unsynced_history, context_summary
+            )
+
+    except Exception as e:
+        logger.error(f"Error in process_chat_message: {e}", exc_info=True)
+        return None
+
+    route_stats.record_latency(route, reason, time.perf_counter() - start)
+    return result
+
+
+async def _run_agent(
+    client: AIProjectClient,
+    openai_client,
+    message: str,
+    history: Optional[list],
+    agent_thread_id: Optional[str],
+    unsynced_history: Optional[list],
+    context_summary: Optional[str],
+) -> AgentResult:
+    agent_id = await _get_agent_id(client, openai_client)
+
+    thread_id, added = await _prepare_thread(
+        openai_client, message, history, agent_thread_id, unsynced_history
+    )
+
+    logger.info(f"Executing run on thread {thread_id} ...")
+    run_options = _run_context_options(history, context_summary)
     try:
-        tool_definitions = await _resolve_bing_tools(client)
+        try:
+            run, timed_out = await drive_run(openai_client, thread_id, agent_id, **run_options)
+        except BadRequestError as e:
+            if not added or not _has_active_run(e):
+                raise
+            thread_id = await _fork_thread(openai_client, thread_id, added, message, history)
+            run, timed_out = await drive_run(openai_client, thread_id, agent_id, **run_options)
+    except NotFoundError:
+        # The registered assistant was deleted out from under us; recreate next time.
+        assistant_registry.invalidate()
+        raise
+    except asyncio.CancelledError:
+        # drive_run has already cancelled the run.
+        run_in_background(discard_thread(openai_client, thread_id))
+        raise
+
+    if timed_out:
+        return _incomplete_run_result(run, thread_id, status="expired")
+    if run.status != "completed":
+        return _incomplete_run_result(run, thread_id)
+
+    # The thread persists across turns, so only consider messages from this run.
+    with tracer.start_as_current_span("agent.list_messages"):
+        messages_page = await openai_client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id)
+    assistant_messages = [m for m in messages_page.data if m.role == "assistant"]
+
+    if not assistant_messages:
+        return AgentResult(
+            text="No response generated from agent.", usage_metadata={}, sources=[], thread_id=thread_id
+        )
+
+    final_text, sources = _extract_text_and_citations(assistant_messages[0])
+
+    metadata = _run_metadata(run)
+    logger.info(f"Run complete. {len(sources)} citation(s) extracted.")
+    return AgentResult(
+        text=final_text.strip(),
+        usage_metadata=metadata,
+        sources=sources,
+        thread_id=thread_id,
+        completed=True,
+    )
+
 
-        openai_client = await client.get_openai_client(api_version="2024-05-01-preview")
+async def stream_chat_message(
+    client: AIProjectClient,
+    message: str,
+    history: list = None,
+    agent_thread_id: str = None,
+    unsynced_history: list = None,
+    context_summary: str = None,
+    attachment_context: str = None,
+) -> AsyncIterator[Tuple[str, object]]:
+    """
+    Streaming variant of process_chat_message built on the Assistants run event stream.
+
+    Yields (event, payload) tuples as the run progresses:
+        ("search",   {"step_id", "tool", "status"})  tool (Bing) step started / finished
+        ("delta",    {"text"})                        incremental answer text
+        ("citation", {"url", "title"})                newly seen source URL
+        ("result",   AgentResult)                     always last; the assembled answer
+    Arguments have the same meaning as for process_chat_message. Turns routed
+    to the direct completion emit only "delta" events before the result.
+    """
+    start = time.perf_counter()
+    openai_client = await get_openai_client(client)
+    route, reason = await classify_turn(
+        openai_client, message, history, has_attachment=bool(attachment_context), context_summary=context_summary
+    )
+    message = with_attachment(message, attachment_context)
+    logger.info(f"Turn routed to '{route}' ({reason}).")
+    trace.get_current_span().set_attributes({"chat.route": route, "chat.route_reason": reason})
 
-        agent = await openai_client.beta.assistants.create(
-            model="gpt-4o",
-            name="ComplianceAgent",
-            instructions=SYSTEM_PROMPT,
-            tools=tool_definitions,
+    if route == ROUTE_DIRECT:
+        events = _stream_direct_completion(openai_client, message, history, agent_thread_id, context_summary)
+    else:
+        events = _stream_agent(
+            client, openai_client, message, history, agent_thread_id, unsynced_history, context_summary
         )
-        logger.info(f"Created agent {agent.id} with {len(tool_definitions)} tool(s).")
+    async with aclosing(events):
+        async for event, payload in events:
+            if event == "result":
+                route_stats.record_latency(route, reason, time.perf_counter() - start)
+            yield event, payload
 
+
+async def _stream_agent(
+    client: AIProjectClient,
+    openai_client,
+    message: str,
+    history: Optional[list],
+    agent_thread_id: Optional[str],
+    unsynced_history: Optional[list],
+    context_summary: Optional[str],
+) -> AsyncIterator[Tuple[str, object]]:
+    agent_id = await _get_agent_id(client, openai_client)
+    thread_id, added = await _prepare_thread(
+        openai_client, message, history, agent_thread_id, unsynced_history
+    )
+
+    logger.info(f"Streaming run on thread {thread_id} ...")
+    # Not made the current span: the generator may be closed from another context.
+    span = tracer.start_span("agent.stream_run")
+    run_options = {"assistant_id": agent_id, "stream": True, **_run_context_options(history, context_summary)}
+    try:
         try:
-            thread = await openai_client.beta.threads.create()
-
-            # Replay conversation history so the agent has full multi-turn context.
-            for turn in (history or []):
-                role = turn.get("role", "user")
-                content = turn.get("content", "")
-                if content and role in ("user", "assistant"):
-                    try:
-                        await openai_client.beta.threads.messages.create(
-                            thread_id=thread.id,
-                            role=role,
-                            content=content,
-                        )
-                    except Exception as hist_e:
-                        # Non-fatal: some API versions reject "assistant" role on create.
-                        logger.debug(f"Could not replay history turn (role={role}): {hist_e}")
-
-            # Add the current user query.
-            await openai_client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=message,
-            )
+            stream = await openai_client.beta.threads.runs.create(thread_id=thread_id, **run_options)
+        except BadRequestError as e:
+            if not added or not _has_active_run(e):
+                raise
+            thread_id = await _fork_thread(openai_client, thread_id, added, message, history)
+            stream = await openai_client.beta.threads.runs.create(thread_id=thread_id, **run_options)
+    except NotFoundError:
+        span.end()
+        assistant_registry.invalidate()
+        raise
+    except BaseException:
+        span.end()
+        raise
 
-            logger.info(f"Executing run on thread {thread.id} ...")
-            run = await openai_client.beta.threads.runs.create_and_poll(
-                thread_id=thread.id,
-                assistant_id=agent.id,
-                timeout=120,  # 2-minute ceiling for complex multi-search Bing runs
-            )
+    text_parts = []
+    sources = []
+    seen = set()
+    run = None
+    tool_calls = 0
+    agent_runs_in_flight.inc()
 
-            if run.status != "completed":
-                logger.error(
-                    f"Run {run.id} ended with status '{run.status}'. "
-                    f"last_error={getattr(run, 'last_error', None)}"
-                )
-                friendly_errors = {
-                    "failed":    "The agent encountered an error while researching your query. Please try again.",
-                    "expired":   "The search took too long and timed out. Try a more specific question.",
-                    "cancelled": "The request was cancelled.",
-                }
-                msg = friendly_errors.get(run.status, f"Unexpected agent status: {run.status}.")
-                return AgentResult(text=msg, usage_metadata={}, sources=[])
-
-            messages_page = await openai_client.beta.threads.messages.list(thread_id=thread.id)
-            assistant_messages = [m for m in messages_page.data if m.role == "assistant"]
-
-            if not assistant_messages:
-                return AgentResult(text="No response generated from agent.", usage_metadata={}, sources=[])
-
-            final_text, sources = _extract_text_and_citations(assistant_messages[0])
-
-            metadata = {"model": "gpt-4o (Azure AI Agent + Bing Grounding)"}
-            if hasattr(run, "usage") and run.usage:
-                class _Usage:
-                    def __init__(self, r):
-                        self.total_tokens = getattr(r.usage, "total_tokens", 0)
-                        self.prompt_tokens = getattr(r.usage, "prompt_tokens", 0)
-                        self.completion_tokens = getattr(r.usage, "completion_tokens", 0)
-                metadata["usage"] = _Usage(run)
-
-            logger.info(f"Run complete. {len(sources)} citation(s) extracted.")
-            return AgentResult(text=final_text.strip(), usage_metadata=metadata, sources=sources)
-
-        finally:
-            await openai_client.beta.assistants.delete(agent.id)
+    try:
+        async for event in stream:
+            kind = event.event
 
-    except Exception as e:
-        logger.error(f"Error in process_chat_message: {e}", exc_info=True)
-        return None
+            if kind in ("thread.run.step.created", "thread.run.step.completed"):
+                details = getattr(event.data, "step_details", None)
+                if getattr(details, "type", None) == "tool_calls":
+                    if kind == "thread.run.step.completed":
+                        tool_calls += len(getattr(details, "tool_calls", None) or [])
+                    for call in getattr(details, "tool_calls", None) or []:
+                        yield "search", {
+                            "step_id": event.data.id,
+                            "tool": getattr(call, "type", "tool"),
+                            "status": event.data.status,
+                        }
+
+            elif kind == "thread.message.delta":
+                for block in event.data.delta.content or []:
+                    if block.type != "text" or not block.text:
+                        continue
+                    if block.text.value:
+                        text_parts.append(block.text.value)
+                        yield "delta", {"text": block.text.value}
+                    for annotation in getattr(block.text, "annotations", None) or []:
+                        if getattr(annotation, "type", None) != "url_citation":
+                            continue
+                        citation = getattr(annotation, "url_citation", None)
+                        url = getattr(citation, "url", None)
+                        if url and url not in seen:
+                            seen.add(url)
+                            sources.append(url)
+                            yield "citation", {"url": url, "title": getattr(citation, "title", None)}
+
+            elif kind.startswith("thread.run.") and not kind.startswith("thread.run.step."):
+                run = event.data
+    except (asyncio.CancelledError, GeneratorExit):
+        # The client went away (or the consumer stopped reading) mid-run.
+        if run is None or run.status not in TERMINAL_RUN_STATUSES:
+            run_in_background(abandon_run(openai_client, thread_id, getattr(run, "id", None)))
+        raise
+    finally:
+        status = getattr(run, "status", None)
+        outcome = status if status in TERMINAL_RUN_STATUSES else "abandoned"
+        agent_runs_in_flight.dec()
+        agent_run_status.inc(status=outcome)
+        span.set_attributes({"agent.run_status": outcome, "agent.bing_tool_calls": tool_calls})
+        set_usage_attributes(span, getattr(run, "usage", None))
+        span.end()
+        await stream.close()
+
+    if run is None:
+        logger.error(f"Run stream on thread {thread_id} ended without a run status.")
+        yield "result", AgentResult(
+            text="No response generated from agent.", usage_metadata={}, sources=[], thread_id=thread_id
+        )
+        return
+    if run.status != "completed":
+        yield "result", _incomplete_run_result(run, thread_id)
+        return
+
+    logger.info(f"Streamed run complete. {len(sources)} citation(s) extracted.")
+    yield "result", AgentResult(
+        text="".join(text_parts).strip(),
+        usage_metadata=_run_metadata(run),
+        sources=sources,
+        thread_id=thread_id,
+        completed=True,
+    )
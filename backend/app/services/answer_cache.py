@@ -0,0 +1,255 @@
+"""
+Answer cache for repeated compliance queries.
+
+Many users ask the same first question ("FCC Part 15.247 power limits",
+"NOM-208-SCFI-2016 requirements"), and each one used to cost a full
+multi-search agent run. Completed, grounded answers are cached under the
+normalised query plus the jurisdiction it targets:
+
+- exact hits: sha256 of (jurisdiction, normalised query text);
+- semantic hits (optional): cosine similarity of query embeddings from the
+  AZURE_OPENAI_EMBEDDING_DEPLOYMENT, only between queries with the same
+  jurisdiction and the same regulation numbers, so "NOM-121" never answers
+  for "NOM-208".
+
+Entries expire after ANSWER_CACHE_TTL_SECONDS and never outlive the calendar
+year they were produced in, because the agent's "verify latest amendments"
+search is pinned to the current year. LOW-confidence and uncited answers are
+not cached. A hit still charges the user ANSWER_CACHE_CHARGE_RATIO of the
+tokens the original run consumed.
+"""
+
+import hashlib
+import logging
+import math
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.services.agent_orchestrator import ROUTE_CACHE, AgentResult
+from app.services.embeddings import Embedder
+from app.services.sanitization_service import SanitizationService
+
+logger = logging.getLogger(__name__)
+
+_LOW_CONFIDENCE = re.compile(r"confidence level:?\**\s*low", re.IGNORECASE)
+
+
+def normalize_query(query: str) -> str:
+    """Case-fold, strip punctuation (keeping "-", "." and "/" inside identifiers) and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", query).casefold()
+    text = re.sub(r"[^\w\s\-./]", " ", text)
+    text = re.sub(r"(?<!\w)[\-./]+|[\-./]+(?!\w)", " ", text)
+    return " ".join(text.split())
+
+
+def detect_jurisdiction(query: str) -> str:
+    """
+    Jurisdiction descriptor used to partition the cache: the matched
+    jurisdiction codes plus any structured Regulation ID in the query.
+    """
+    codes = SanitizationService.identify_jurisdictions(normalize_query(query))
+    regulation_id = SanitizationService.identify_regulation_id(query.upper())
+    parts = ["+".join(codes) or "GLOBAL"]
+    if regulation_id != "UNKNOWN_REGULATION_ID":
+        parts.append(regulation_id)
+    return "|".join(parts)
+
+
+def _regulation_numbers(normalized: str) -> Tuple[str, ...]:
+    """Numbers such as "15.247", "208", "2016" — semantic hits must agree on all of them."""
+    return tuple(sorted(set(re.findall(r"\d+(?:[./]\d+)*", normalized))))
+
+
+class CacheProbe:
+    """The cache key material computed for one query, reused to store the answer after a miss."""
+
+    def __init__(self, query: str):
+        self.normalized = normalize_query(query)
+        self.jurisdiction = detect_jurisdiction(query)
+        self.numbers = _regulation_numbers(self.normalized)
+        self.key = hashlib.sha256(f"{self.jurisdiction}\n{self.normalized}".encode("utf-8")).hexdigest()
+        self.embedding: Optional[np.ndarray] = None
+
+
+class _Entry:
+    def __init__(self, probe: CacheProbe, text: str, sources: list, model: str, tokens: int, expires_at: float):
+        self.jurisdiction = probe.jurisdiction
+        self.numbers = probe.numbers
+        self.embedding = probe.embedding
+        self.text = text
+        self.sources = list(sources)
+        self.model = model
+        self.tokens = tokens
+        self.expires_at = expires_at
+
+
+def _year_end(now: float) -> float:
+    """Epoch seconds of the next 1 January (UTC) after `now`."""
+    year = datetime.fromtimestamp(now, tz=timezone.utc).year
+    return datetime(year + 1, 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+class AnswerCache:
+    """
+    In-process LRU of completed agent answers with TTL expiry.
+
+    lookup() returns a ready AgentResult on a hit; on a miss, pass the
+    returned probe to store() once the run has completed.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: int = 86_400,
+        max_entries: int = 2_000,
+        similarity_threshold: float = 0.95,
+        charge_ratio: float = 0.1,
+        embedder: Optional[Embedder] = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.charge_ratio = charge_ratio
+        self.embedder = embedder
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.rejected = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def configure_embedder(self, embedder: Optional[Embedder]) -> None:
+        self.embedder = embedder
+
+    async def lookup(self, query: str) -> Tuple[Optional[AgentResult], CacheProbe]:
+        """Return (cached result or None, probe)."""
+        probe = CacheProbe(query)
+        now = time.time()
+
+        entry = self._live_entry(probe.key, now)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(probe.key)
+            return self._as_result(entry), probe
+
+        if self.embedder is not None and self.similarity_threshold < 1:
+            key = await self._semantic_match(probe, now)
+            if key is not None:
+                self.hits += 1
+                self.semantic_hits += 1
+                self._entries.move_to_end(key)
+                return self._as_result(self._entries[key]), probe
+
+        self.misses += 1
+        return None, probe
+
+    async def store(self, probe: CacheProbe, result: AgentResult, tokens_used: int) -> bool:
+        """Cache a completed answer. Returns False when the answer is not cacheable."""
+        if not self._cacheable(result):
+            self.rejected += 1
+            return False
+
+        if self.embedder is not None and probe.embedding is None:
+            await self._embed(probe)
+
+        now = time.time()
+        model = (result.metadata or {}).get("model", "gpt-4o")
+        self._entries[probe.key] = _Entry(
+            probe, result.text, result.sources, model, tokens_used,
+            expires_at=min(now + self.ttl_seconds, _year_end(now)),
+        )
+        self._entries.move_to_end(probe.key)
+        self.stores += 1
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "rejected": self.rejected,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "semantic": self.embedder is not None,
+        }
+
+    @staticmethod
+    def _cacheable(result: AgentResult) -> bool:
+        # Only grounded answers from a completed run; LOW confidence means nothing authoritative was found.
+        return bool(result.completed and result.text and result.sources and not _LOW_CONFIDENCE.search(result.text))
+
+    def _live_entry(self, key: str, now: float) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        return entry
+
+    async def _semantic_match(self, probe: CacheProbe, now: float) -> Optional[str]:
+        candidates: List[Tuple[str, np.ndarray]] = []
+        for key in list(self._entries):
+            entry = self._live_entry(key, now)
+            if (
+                entry is not None
+                and entry.embedding is not None
+                and entry.jurisdiction == probe.jurisdiction
+                and entry.numbers == probe.numbers
+            ):
+                candidates.append((key, entry.embedding))
+        if not candidates or not await self._embed(probe):
+            return None
+
+        scores = np.stack([vector for _, vector in candidates]) @ probe.embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity_threshold:
+            logger.info(f"Answer cache semantic hit (similarity {scores[best]:.3f}).")
+            return candidates[best][0]
+        return None
+
+    async def _embed(self, probe: CacheProbe) -> bool:
+        try:
+            probe.embedding = (await self.embedder.embed([probe.normalized]))[0]
+            return True
+        except Exception as e:
+            logger.warning(f"Query embedding failed, answer cache falls back to exact matching: {e}")
+            return False
+
+    def _as_result(self, entry: _Entry) -> AgentResult:
+        charge = max(1, math.ceil(entry.tokens * self.charge_ratio))
+        return AgentResult(
+            text=entry.text,
+            usage_metadata={"model": f"{entry.model} (cached)", "usage": SimpleNamespace(total_tokens=charge)},
+            sources=entry.sources,
+            completed=True,
+            route=ROUTE_CACHE,
+        )
+
+
+answer_cache = AnswerCache(
+    ttl_seconds=settings.ANSWER_CACHE_TTL_SECONDS,
+    max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+    similarity_threshold=settings.ANSWER_CACHE_SIMILARITY,
+    charge_ratio=settings.ANSWER_CACHE_CHARGE_RATIO,
+)
+
@@ -0,0 +1,267 @@
+"""
+Per-thread retrieval index over attachment chunks.
+
+Each extracted document is split into token-budgeted chunks, embedded in
+batched calls and stored once per content hash as a NumPy archive
+(data/attachment_index/<sha256>.npz: unit vectors plus chunk texts). A
+thread lists the documents attached to it (ChatThreadModel.attachments);
+its index is the concatenation of their vectors, searched by cosine
+similarity (a dot product of unit vectors). Each turn then carries only the
+most relevant chunks, up to ATTACHMENT_PROMPT_TOKENS, however large the
+documents are.
+
+Vectors from a different embedder (the deployment changed) are rebuilt from
+the stored chunks, or from the cached extracted text. If embedding fails, the
+turn falls back to each document's leading chunks instead of failing.
+The index directory is kept within ATTACHMENT_INDEX_MAX_BYTES (see CacheBudget).
+"""
+
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from app.core.config import settings
+from app.core.token_accounting import count_tokens
+from app.services.attachment_service import DATA_DIR, CacheBudget, ExtractedAttachment, attachment_service
+from app.services.embeddings import Embedder, LocalHashEmbedder
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.path.join(DATA_DIR, "attachment_index")
+
+
+class DocumentVectors:
+    def __init__(
+        self,
+        sha256: str,
+        filename: str,
+        chunks: List[str],
+        chunk_tokens: List[int],
+        vectors: Optional[np.ndarray],
+        embedder: Optional[str],
+    ):
+        self.sha256 = sha256
+        self.filename = filename
+        self.chunks = chunks
+        self.chunk_tokens = chunk_tokens
+        self.vectors = vectors            # one unit row per chunk; None if embedding failed
+        self.embedder = embedder          # Embedder.name the vectors came from
+
+
+class ChunkIndex:
+    """
+    Stores document vectors on disk and keeps the most recently used ones in
+    memory (up to `max_documents`).
+    """
+
+    def __init__(
+        self,
+        embedder: Optional[Embedder] = None,
+        index_dir: str = INDEX_DIR,
+        top_k: int = 6,
+        min_score: float = 0.25,
+        max_documents: int = 64,
+        max_bytes: int = 1024 * 1024 * 1024,
+        max_age: float = 30 * 86400,
+    ):
+        self.embedder = embedder or LocalHashEmbedder()
+        self._index_dir = index_dir
+        self.disk_budget = CacheBudget(index_dir, max_bytes, max_age)
+        self.top_k = top_k
+        self.min_score = min_score
+        self._max_documents = max_documents
+        self._documents: "OrderedDict[str, DocumentVectors]" = OrderedDict()
+        self.documents_indexed = 0
+        self.chunks_embedded = 0
+        self.searches = 0
+        self.embedding_errors = 0
+
+    def configure_embedder(self, embedder: Optional[Embedder]) -> None:
+        if embedder is not None:
+            self.embedder = embedder
+            self._documents.clear()
+
+    async def add_document(self, attachment: ExtractedAttachment) -> DocumentVectors:
+        """Chunk and embed a document, unless vectors for it (from this embedder) are already stored."""
+        document = await self._load(attachment.sha256)
+        if document is not None and document.embedder == self.embedder.name:
+            return document
+        chunks = await asyncio.to_thread(attachment.chunks)
+        return await self._index(attachment.sha256, attachment.filename, chunks)
+
+    async def _document(self, sha256: str) -> Optional[DocumentVectors]:
+        """
+        The document's vectors in the current embedder's space. Vectors from
+        another embedder are re-embedded from their stored chunks, or from the
+        cached extracted text when the index file is gone.
+        """
+        document = await self._load(sha256)
+        if document is not None and document.embedder == self.embedder.name:
+            return document
+        if document is not None:
+            return await self._index(sha256, document.filename, document.chunks, document.chunk_tokens)
+        attachment = await attachment_service.cached(sha256)
+        if attachment is None:
+            return None
+        return await self._index(sha256, attachment.filename, await asyncio.to_thread(attachment.chunks))
+
+    async def _index(
+        self, sha256: str, filename: str, chunks: List[str], chunk_tokens: Optional[List[int]] = None
+    ) -> DocumentVectors:
+        if chunk_tokens is None:
+            chunk_tokens = await asyncio.to_thread(lambda: [count_tokens(c) for c in chunks])
+        try:
+            vectors = await self.embedder.embed(chunks)
+        except Exception as e:
+            # Not remembered or saved: the next turn tries to embed it again.
+            self.embedding_errors += 1
+            logger.warning(f"Embedding {filename} failed, using its leading chunks: {e}")
+            return DocumentVectors(sha256, filename, chunks, chunk_tokens, None, None)
+        document = DocumentVectors(sha256, filename, chunks, chunk_tokens, vectors, self.embedder.name)
+        await asyncio.to_thread(self._save, document)
+        self._remember(document)
+        self.documents_indexed += 1
+        self.chunks_embedded += len(chunks)
+        logger.info(f"Indexed {filename}: {len(chunks)} chunk(s).")
+        return document
+
+    async def context_for(
+        self,
+        document_ids: List[str],
+        query: str,
+        budget_tokens: int = settings.ATTACHMENT_PROMPT_TOKENS,
+        new_document: Optional[str] = None,
+    ) -> Optional[str]:
+        """
+        Attachment text for the prompt of a turn asking `query`.
+
+        Documents that fit in the budget together are included whole. Otherwise
+        the top-k chunks scoring at least `min_score` are included, best first,
+        plus the opening chunk of `new_document` (just uploaded this turn) so
+        "summarise this report" still sees its title and scope. Documents that
+        could not be embedded contribute their leading chunks. Returns None
+        when nothing is relevant.
+        """
+        documents = [d for d in [await self._document(sha) for sha in document_ids] if d is not None]
+        if not documents:
+            return None
+
+        if sum(sum(d.chunk_tokens) for d in documents) <= budget_tokens:
+            return self._format([(d, i) for d in documents for i in range(len(d.chunks))])
+
+        picked = [(d, 0) for d in documents if d.sha256 == new_document]
+        unsearched = [d for d in documents if d.vectors is None]
+        try:
+            hits = await self.search([d for d in documents if d.vectors is not None], query)
+        except Exception as e:
+            self.embedding_errors += 1
+            logger.warning(f"Embedding the attachment query failed, using leading chunks: {e}")
+            hits, unsearched = [], documents
+        candidates = [(d, i) for _, d, i in hits] + [(d, i) for d in unsearched for i in range(len(d.chunks))]
+        seen = {(d.sha256, i) for d, i in picked}
+        for d, i in candidates:
+            if (d.sha256, i) not in seen:
+                seen.add((d.sha256, i))
+                picked.append((d, i))
+        if not picked:
+            return None
+
+        selected, used = [], 0
+        for d, i in picked:
+            if used + d.chunk_tokens[i] > budget_tokens:
+                break
+            selected.append((d, i))
+            used += d.chunk_tokens[i]
+        return self._format(selected) if selected else None
+
+    async def search(self, documents: List[DocumentVectors], query: str) -> List[Tuple[float, DocumentVectors, int]]:
+        """Top-k (score, document, chunk_index) by cosine similarity, above `min_score`."""
+        owners = [(d, i) for d in documents for i in range(len(d.chunks))]
+        if not owners:
+            return []
+        matrix = np.concatenate([d.vectors for d in documents])
+        query_vector = (await self.embedder.embed([query]))[0]
+        scores = matrix @ query_vector
+
+        k = min(self.top_k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        self.searches += 1
+        return [(float(scores[j]), *owners[j]) for j in best if scores[j] >= self.min_score]
+
+    def stats(self) -> dict:
+        return {
+            "embedder": self.embedder.name,
+            "documents_indexed": self.documents_indexed,
+            "chunks_embedded": self.chunks_embedded,
+            "documents_loaded": len(self._documents),
+            "searches": self.searches,
+            "embedding_errors": self.embedding_errors,
+            "disk": self.disk_budget.stats(),
+        }
+
+    @staticmethod
+    def _format(selected: List[Tuple[DocumentVectors, int]]) -> str:
+        return "\n\n".join(
+            f"[Attachment: {d.filename}, excerpt {i + 1}/{len(d.chunks)}]\n{d.chunks[i]}" for d, i in selected
+        )
+
+    def _remember(self, document: DocumentVectors) -> None:
+        self._documents[document.sha256] = document
+        self._documents.move_to_end(document.sha256)
+        while len(self._documents) > self._max_documents:
+            self._documents.popitem(last=False)
+
+    async def _load(self, sha256: str) -> Optional[DocumentVectors]:
+        document = self._documents.get(sha256)
+        if document is None:
+            document = await asyncio.to_thread(self._read, sha256)
+            if document is None:
+                return None
+            self._remember(document)
+        else:
+            self._documents.move_to_end(sha256)
+        return document
+
+    def _path(self, sha256: str) -> str:
+        return os.path.join(self._index_dir, f"{sha256}.npz")
+
+    def _read(self, sha256: str) -> Optional[DocumentVectors]:
+        try:
+            with np.load(self._path(sha256), allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                self.disk_budget.touch(self._path(sha256))
+                return DocumentVectors(
+                    sha256, meta["filename"], meta["chunks"], meta["chunk_tokens"], data["vectors"], meta["embedder"]
+                )
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Unreadable attachment index {sha256}: {e}")
+            return None
+
+    def _save(self, document: DocumentVectors) -> None:
+        os.makedirs(self._index_dir, exist_ok=True)
+        meta = {
+            "filename": document.filename,
+            "chunks": document.chunks,
+            "chunk_tokens": document.chunk_tokens,
+            "embedder": document.embedder,
+        }
+        tmp_path = self._path(document.sha256) + ".tmp.npz"
+        np.savez(tmp_path, vectors=document.vectors, meta=np.array(json.dumps(meta)))
+        os.replace(tmp_path, self._path(document.sha256))
+        self.disk_budget.added(os.path.getsize(self._path(document.sha256)))
+
+
+chunk_index = ChunkIndex(
+    top_k=settings.ATTACHMENT_TOP_K,
+    min_score=settings.ATTACHMENT_MIN_SCORE,
+    max_bytes=settings.ATTACHMENT_INDEX_MAX_BYTES,
+    max_age=settings.ATTACHMENT_CACHE_MAX_AGE_DAYS * 86400,
+)
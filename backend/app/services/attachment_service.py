@@ -0,0 +1,310 @@
+"""
+Attachment pipeline: spool → hash → extract → chunk.
+
+Uploads are copied to a temporary file in fixed-size reads (never held in
+memory whole) while their SHA-256 is computed. Text is extracted with pypdf
+or python-docx in a process pool, so parsing a large report neither blocks
+the event loop nor holds the GIL, and is cached on disk by content hash:
+re-uploading the same document skips extraction entirely. The chunks are
+embedded and searched per thread by attachment_index.py.
+
+Both on-disk caches are kept within a byte budget by CacheBudget: files not
+read for ATTACHMENT_CACHE_MAX_AGE_DAYS go first, then the least recently
+used ones. An evicted document is re-extracted on its next upload; its
+vectors are rebuilt from whichever cache still holds it.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional
+
+from fastapi import UploadFile
+
+from app.core.config import settings
+from app.core.token_accounting import split_by_tokens
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "data")
+CACHE_DIR = os.path.join(DATA_DIR, "attachment_cache")
+
+SPOOL_READ_SIZE = 1024 * 1024
+SWEEP_INTERVAL_SECONDS = 3600
+
+# File extension / MIME type → extractor kind
+_KINDS = {
+    ".pdf": "pdf", "application/pdf": "pdf",
+    ".docx": "docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    ".txt": "text", ".md": "text", ".csv": "text", "text/plain": "text", "text/markdown": "text", "text/csv": "text",
+}
+
+
+class AttachmentError(Exception):
+    """An upload that cannot be processed; `status_code` is the HTTP status to report."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CacheBudget:
+    """
+    Keeps the files of a cache directory under `max_bytes`, least recently
+    used first, and drops files older than `max_age` seconds. Reads refresh a
+    file's mtime (touch), so mtime order is use order. Writers report their
+    bytes with added(); the directory is swept when over budget, and at least
+    once per SWEEP_INTERVAL_SECONDS for the age limit. Called from worker threads.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float):
+        self._dir = directory
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None  # bytes on disk, known after the first sweep
+        self._swept_at = 0.0
+        self.evictions = 0
+
+    @staticmethod
+    def touch(path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, nbytes: int) -> None:
+        with self._lock:
+            if self._total is not None:
+                self._total += nbytes
+            if self._total is None or self._total > self._max_bytes or time.time() - self._swept_at > SWEEP_INTERVAL_SECONDS:
+                self._sweep()
+
+    def stats(self) -> dict:
+        return {"bytes": self._total, "max_bytes": self._max_bytes, "evictions": self.evictions}
+
+    def _sweep(self) -> None:
+        """Caller holds _lock."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self._dir):
+            if entry.is_file() and ".tmp" not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # Evict down to 90% of the budget so the next few writes do not each trigger a sweep.
+        target = self._max_bytes * 0.9
+        for mtime, size, path in entries:
+            if total <= target and now - mtime <= self._max_age:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+        self._total, self._swept_at = total, now
+
+
+class SpooledUpload:
+    def __init__(self, path: str, sha256: str, size: int, filename: str, kind: str):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.filename = filename
+        self.kind = kind
+
+    def discard(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ExtractedAttachment:
+    def __init__(self, sha256: str, filename: str, text: str, cached: bool):
+        self.sha256 = sha256
+        self.filename = filename
+        self.text = text
+        self.cached = cached  # True when served from the extraction cache
+
+    def chunks(self, max_tokens: int = settings.ATTACHMENT_CHUNK_TOKENS) -> List[str]:
+        return split_by_tokens(self.text, max_tokens, overlap_tokens=max_tokens // 10)
+
+
+def detect_kind(filename: Optional[str], content_type: Optional[str]) -> Optional[str]:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return _KINDS.get(ext) or _KINDS.get((content_type or "").split(";")[0].strip().lower())
+
+
+def _spool_chunk(f, digest, chunk: bytes) -> None:
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def _extract_text(path: str, kind: str) -> str:
+    """Runs in a worker process."""
+    if kind == "pdf":
+        from pypdf import PdfReader
+
+        reader = PdfReader(path)
+        pages = []
+        for number, page in enumerate(reader.pages, start=1):
+            text = (page.extract_text() or "").strip()
+            if text:
+                pages.append(f"[Page {number}]\n{text}")
+        return "\n\n".join(pages)
+
+    if kind == "docx":
+        from docx import Document
+
+        document = Document(path)
+        parts = [p.text for p in document.paragraphs if p.text.strip()]
+        for table in document.tables:
+            for row in table.rows:
+                parts.append(" | ".join(cell.text.strip() for cell in row.cells))
+        return "\n".join(parts)
+
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+class AttachmentService:
+    def __init__(
+        self,
+        cache_dir: str = CACHE_DIR,
+        max_bytes: int = 25 * 1024 * 1024,
+        workers: int = 2,
+        cache_max_bytes: int = 1024 * 1024 * 1024,
+        cache_max_age: float = 30 * 86400,
+    ):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self.cache_budget = CacheBudget(cache_dir, cache_max_bytes, cache_max_age)
+        self._workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self.extractions = 0
+        self.cache_hits = 0
+        self.extraction_seconds = 0.0
+
+    async def spool(self, upload: UploadFile) -> SpooledUpload:
+        """Copy the upload to a temporary file, hashing it on the way."""
+        kind = detect_kind(upload.filename, upload.content_type)
+        if kind is None:
+            raise AttachmentError(
+                f"Unsupported attachment type: {upload.filename}. Upload a PDF, DOCX or text file.", 415
+            )
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(prefix="upload-", suffix=os.path.splitext(upload.filename or "")[1])
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while chunk := await upload.read(SPOOL_READ_SIZE):
+                    size += len(chunk)
+                    if size > self._max_bytes:
+                        raise AttachmentError(
+                            f"Attachment exceeds the {self._max_bytes // (1024 * 1024)} MB limit.", 413
+                        )
+                    # Hash and write off the event loop; each chunk is up to SPOOL_READ_SIZE bytes.
+                    await asyncio.to_thread(_spool_chunk, f, digest, chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return SpooledUpload(path, digest.hexdigest(), size, upload.filename or "attachment", kind)
+
+    async def extract(self, spooled: SpooledUpload) -> ExtractedAttachment:
+        """Extract (or fetch cached) text for a spooled upload; the temporary file is removed."""
+        try:
+            cached = await asyncio.to_thread(self._read_cache, spooled.sha256)
+            if cached is not None:
+                self.cache_hits += 1
+                return ExtractedAttachment(spooled.sha256, spooled.filename, cached, cached=True)
+
+            start = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            try:
+                text = await loop.run_in_executor(self._get_pool(), _extract_text, spooled.path, spooled.kind)
+            except BrokenProcessPool as e:
+                # A worker died (e.g. out of memory on a huge file); start a fresh pool next time.
+                self.close()
+                raise AttachmentError(f"Could not read {spooled.filename}: {e}", 422)
+            except Exception as e:
+                logger.warning(f"Text extraction failed for {spooled.filename}: {e}")
+                raise AttachmentError(f"Could not read {spooled.filename}: {e}", 422)
+            self.extractions += 1
+            self.extraction_seconds += time.perf_counter() - start
+
+            if not text.strip():
+                raise AttachmentError(f"No extractable text in {spooled.filename} (scanned PDFs are not supported).", 422)
+            await asyncio.to_thread(self._write_cache, spooled.sha256, text)
+            return ExtractedAttachment(spooled.sha256, spooled.filename, text, cached=False)
+        finally:
+            spooled.discard()
+
+    async def cached(self, sha256: str, filename: str = "attachment") -> Optional[ExtractedAttachment]:
+        """Previously extracted text for a document, or None if it is not (or no longer) cached."""
+        text = await asyncio.to_thread(self._read_cache, sha256)
+        return ExtractedAttachment(sha256, filename, text, cached=True) if text is not None else None
+
+    async def process(self, upload: UploadFile) -> ExtractedAttachment:
+        return await self.extract(await self.spool(upload))
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            "extractions": self.extractions,
+            "cache_hits": self.cache_hits,
+            "avg_extraction_s": round(self.extraction_seconds / self.extractions, 3) if self.extractions else None,
+            "cache": self.cache_budget.stats(),
+        }
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that runs an event loop and client threads is unsafe.
+            self._pool = ProcessPoolExecutor(
+                max_workers=self._workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
+
+    def _cache_path(self, sha256: str) -> str:
+        return os.path.join(self._cache_dir, f"{sha256}.txt")
+
+    def _read_cache(self, sha256: str) -> Optional[str]:
+        path = self._cache_path(sha256)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        self.cache_budget.touch(path)
+        return text
+
+    def _write_cache(self, sha256: str, text: str) -> None:
+        os.makedirs(self._cache_dir, exist_ok=True)
+        path = self._cache_path(sha256)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        self.cache_budget.added(os.path.getsize(path))
+
+
+attachment_service = AttachmentService(
+    max_bytes=settings.ATTACHMENT_MAX_BYTES,
+    workers=settings.ATTACHMENT_WORKERS,
+    cache_max_bytes=settings.ATTACHMENT_CACHE_MAX_BYTES,
+    cache_max_age=settings.ATTACHMENT_CACHE_MAX_AGE_DAYS * 86400,
+)
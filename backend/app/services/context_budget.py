@@ -0,0 +1,185 @@
+"""
+Context budget manager: bounds the conversation context sent with each turn.
+
+The newest messages are sent verbatim; older ones are folded into a rolling
+summary stored on the thread (`context_summary`, covering every message
+before absolute index `summary_through`). Folding happens in batches of
+CONTEXT_FOLD_BATCH messages once more than CONTEXT_KEEP_MESSAGES are
+pending, or earlier if the verbatim part exceeds CONTEXT_MAX_TOKENS, so the
+prompt size stays roughly constant however long the thread grows. If the
+summariser fails, the messages due for folding are sent verbatim instead,
+as many of the newest as fit the budget, and folding is retried next turn.
+"""
+
+import logging
+from typing import List, Optional
+
+from app.core.config import settings
+from app.core.token_accounting import TOKENS_PER_MESSAGE, count_message_tokens, count_tokens, split_by_tokens
+from app.models.history import ChatMessageModel, ChatThreadModel
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """You maintain the running summary of a wireless compliance / type approval \
+conversation. Merge the new messages into the current summary. Keep every jurisdiction, regulatory \
+body, standard number, frequency band, power limit, date, confidence level and citation URL that was \
+mentioned, and what the user is trying to certify. Drop pleasantries and repetition. Reply with the \
+updated summary only."""
+
+# Upper bound on transcript tokens sent to the summariser in one call.
+SUMMARY_INPUT_MAX_TOKENS = 8_000
+
+
+class ContextWindow:
+    def __init__(self, history: List[dict], summary: Optional[str], start: int, prompt_tokens: int):
+        self.history = history            # verbatim {"role", "content"} turns, oldest first
+        self.summary = summary            # rolling summary of everything before `start`
+        self.start = start                # absolute index of the first verbatim message
+        self.prompt_tokens = prompt_tokens
+
+
+def _turns(messages: List[ChatMessageModel]) -> List[dict]:
+    return [{"role": m.role, "content": m.content} for m in messages if m.role in ("user", "assistant")]
+
+
+class ContextBudget:
+    def __init__(
+        self,
+        max_tokens: int = 8_000,
+        keep_messages: int = 8,
+        fold_batch: int = 4,
+        summary_max_tokens: int = 800,
+    ):
+        self.max_tokens = max_tokens
+        self.keep_messages = keep_messages
+        self.fold_batch = fold_batch
+        self.summary_max_tokens = summary_max_tokens
+        self.windows = 0
+        self.prompt_tokens = 0
+        self.summaries = 0
+        self.summary_failures = 0
+        self.folded_messages = 0
+        self.summary_tokens = 0
+
+    @property
+    def messages_to_load(self) -> int:
+        """Newest messages a turn needs loaded: the verbatim window, a pending fold batch and the new turn."""
+        return self.keep_messages + self.fold_batch + 2
+
+    async def prepare(self, openai_client, thread: ChatThreadModel) -> ContextWindow:
+        """
+        Build the context for the turn whose user message was just appended to
+        `thread`, folding older messages into the thread's summary if needed.
+        """
+        prior = thread.messages[:-1]
+        base = thread.message_offset
+        end = base + len(prior)
+        start = min(max(thread.summary_through, base), end)
+
+        fold_to = start
+        if end - start > self.keep_messages + self.fold_batch:
+            fold_to = end - self.keep_messages
+
+        # Fold further while the verbatim part is over budget (always keep the last exchange).
+        summary_tokens = count_tokens(thread.context_summary or "")
+        tail_tokens = count_message_tokens(_turns(prior[fold_to - base:]), reply_priming=False)
+        while tail_tokens + summary_tokens > self.max_tokens and end - fold_to > 2:
+            tail_tokens -= count_message_tokens(_turns([prior[fold_to - base]]), reply_priming=False)
+            fold_to += 1
+
+        history = _turns(prior[fold_to - base:])
+        first = fold_to
+        if fold_to > start and not await self._fold(openai_client, thread, prior[start - base:fold_to - base], fold_to):
+            due = self._fit(prior[start - base:fold_to - base], self.max_tokens - summary_tokens - tail_tokens)
+            first = fold_to - len(due)
+            history = _turns(due) + history
+
+        prompt_tokens = count_tokens(thread.context_summary or "") + count_message_tokens(
+            history + [{"content": thread.messages[-1].content}]
+        )
+        self.windows += 1
+        self.prompt_tokens += prompt_tokens
+        return ContextWindow(history, thread.context_summary, first, prompt_tokens)
+
+    def stats(self) -> dict:
+        return {
+            "turns": self.windows,
+            "avg_context_tokens": round(self.prompt_tokens / self.windows) if self.windows else None,
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+            "folded_messages": self.folded_messages,
+            "summary_tokens": self.summary_tokens,
+        }
+
+    async def _fold(self, openai_client, thread: ChatThreadModel, messages: List[ChatMessageModel], fold_to: int) -> bool:
+        summary = thread.context_summary
+        try:
+            for batch in self._batches(_turns(messages)):
+                summary = await self._summarize(openai_client, summary, batch)
+        except Exception as e:
+            # The messages stay unsummarised and are retried next turn; this turn sends them verbatim.
+            self.summary_failures += 1
+            logger.warning(f"Context summary for thread {thread.id} failed: {e}")
+            return False
+
+        thread.context_summary = summary
+        thread.summary_through = fold_to
+        self.summaries += 1
+        self.folded_messages += len(messages)
+        return True
+
+    @staticmethod
+    def _fit(messages: List[ChatMessageModel], budget: int) -> List[ChatMessageModel]:
+        """
+        The newest of `messages` whose turns fit in `budget` tokens, oldest first.
+        The oldest one kept is cut to the tokens left if it does not fit whole.
+        """
+        kept = []
+        for message in reversed(messages):
+            tokens = count_message_tokens(_turns([message]), reply_priming=False)
+            if tokens <= budget:
+                kept.append(message)
+                budget -= tokens
+                continue
+            if budget > TOKENS_PER_MESSAGE:
+                pieces = split_by_tokens(message.content, budget - TOKENS_PER_MESSAGE)
+                kept.append(message.model_copy(update={"content": pieces[0]}))
+            break
+        kept.reverse()
+        return kept
+
+    @staticmethod
+    def _batches(turns: List[dict]) -> List[List[dict]]:
+        batches, current, size = [], [], 0
+        for turn in turns:
+            tokens = count_tokens(turn["content"])
+            if current and size + tokens > SUMMARY_INPUT_MAX_TOKENS:
+                batches.append(current)
+                current, size = [], 0
+            current.append(turn)
+            size += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _summarize(self, openai_client, summary: Optional[str], turns: List[dict]) -> str:
+        transcript = "\n\n".join(f"{t['role'].upper()}: {t['content']}" for t in turns)
+        response = await openai_client.chat.completions.create(
+            model=settings.AZURE_OPENAI_CHAT_DEPLOYMENT,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ],
+            max_tokens=self.summary_max_tokens,
+            temperature=0,
+        )
+        self.summary_tokens += getattr(response.usage, "total_tokens", 0) or 0
+        return (response.choices[0].message.content or "").strip()
+
+
+context_budget = ContextBudget(
+    max_tokens=settings.CONTEXT_MAX_TOKENS,
+    keep_messages=settings.CONTEXT_KEEP_MESSAGES,
+    fold_batch=settings.CONTEXT_FOLD_BATCH,
+    summary_max_tokens=settings.CONTEXT_SUMMARY_MAX_TOKENS,
+)
@@ -0,0 +1,104 @@
+"""
+Text embedding backends.
+
+Embedders return L2-normalised float32 row vectors, so cosine similarity
+between two texts is a plain dot product.
+"""
+
+import hashlib
+import logging
+import re
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+import numpy as np
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class Embedder(ABC):
+    """Turns a batch of texts into an (n, dim) array of unit vectors."""
+
+    @property
+    def name(self) -> str:
+        """Identifies the vector space; vectors from differently named embedders are not comparable."""
+        return type(self).__name__
+
+    @abstractmethod
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        ...
+
+
+class AzureOpenAIEmbedder(Embedder):
+    """Embeds texts with the AZURE_OPENAI_EMBEDDING_DEPLOYMENT, `batch_size` inputs per API call."""
+
+    def __init__(self, openai_client, deployment: str = settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT, batch_size: int = 64):
+        self._client = openai_client
+        self._deployment = deployment
+        self._batch_size = batch_size
+
+    @property
+    def name(self) -> str:
+        return f"azure:{self._deployment}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), self._batch_size):
+            response = await self._client.embeddings.create(
+                model=self._deployment,
+                input=texts[i:i + self._batch_size],
+            )
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda d: d.index))
+        return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+class LocalHashEmbedder(Embedder):
+    """
+    Deterministic feature-hashing embedder (word unigrams and bigrams) that needs
+    no network. A stand-in for tests and for running without an embedding
+    deployment; similarity is lexical, not semantic.
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    @property
+    def name(self) -> str:
+        return f"local-hash:{self.dim}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = re.findall(r"\w+", text.casefold())
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                vectors[row, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return normalize_rows(vectors)
+
+
+async def create_embedder(client) -> Optional[Embedder]:
+    """
+    The AZURE_OPENAI_EMBEDDING_DEPLOYMENT embedder on the shared OpenAI client,
+    or None if unavailable. The deployment is probed with one call so a missing
+    or misnamed deployment shows up at startup rather than on the first upload.
+    """
+    if not client:
+        return None
+    from app.services.agent_orchestrator import get_openai_client
+
+    try:
+        embedder = AzureOpenAIEmbedder(await get_openai_client(client))
+        await embedder.embed(["embedding probe"])
+        return embedder
+    except Exception as e:
+        logger.warning(f"Embedding deployment {settings.AZURE_OPENAI_EMBEDDING_DEPLOYMENT} unavailable: {e}")
+        return None
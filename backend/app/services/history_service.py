@@ -1,13 +1,85 @@
-import os
-from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from azure.cosmos import PartitionKey, exceptions
+from azure.cosmos.aio import CosmosClient
 from app.core.config import settings
-from app.models.history import ChatThreadModel
-from typing import List, Optional
+from app.core.tracing import add_to_span, tracer
+from app.models.history import ChatMessageModel, ChatThreadModel
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import base64
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Messages are stored in fixed-size chunk documents next to a small thread
+# header document, so a turn rewrites at most the last chunk plus the header.
+MESSAGE_CHUNK_SIZE = 20
+
+# Cosmos DB transactional batches are limited to 100 operations.
+_MAX_BATCH_OPERATIONS = 100
+
+
+class RequestChargeStats:
+    """Running Cosmos DB request-unit (RU) totals per history operation."""
+
+    def __init__(self):
+        self._ops: Dict[str, List[float]] = {}
+
+    def record(self, operation: str, headers) -> float:
+        charge = float((headers or {}).get("x-ms-request-charge", 0) or 0)
+        entry = self._ops.setdefault(operation, [0, 0.0])
+        entry[0] += 1
+        entry[1] += charge
+        add_to_span("cosmos.request_charge", charge)
+        logger.debug(f"Cosmos {operation}: {charge:.2f} RU")
+        return charge
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {
+            op: {"count": int(count), "total_ru": round(total, 2), "avg_ru": round(total / count, 2)}
+            for op, (count, total) in self._ops.items()
+        }
+
+
+def _response_headers(result) -> dict:
+    get_headers = getattr(result, "get_response_headers", None)
+    return get_headers() if get_headers else {}
+
+
+def _encode_continuation(token: Optional[str]) -> Optional[str]:
+    """Wrap a Cosmos continuation token into an opaque, URL-safe cursor."""
+    if not token:
+        return None
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+
+def _decode_continuation(cursor: Optional[str]) -> Optional[str]:
+    """Inverse of _encode_continuation. Raises ValueError for malformed cursors."""
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (ValueError, UnicodeError) as e:
+        raise ValueError("Invalid continuation token") from e
+
+
+def _chunk_id(thread_id: str, index: int) -> str:
+    return f"{thread_id}:messages:{index:05d}"
+
+
 class HistoryService:
+    """
+    Chat history persistence on Azure Cosmos DB using the async SDK, so history
+    I/O never blocks the event loop. One instance (and one CosmosClient with its
+    connection pool) is shared by all requests; see create_history_service().
+
+    Storage layout (all in the user's partition):
+      - thread header: {"id": thread_id, "doc_type": "thread", "message_count", ...}
+      - message chunks: {"id": "<thread_id>:messages:<n>", "doc_type": "messages",
+                         "thread_id", "chunk_index": n, "messages": [...]}
+        holding messages [n * MESSAGE_CHUNK_SIZE, (n + 1) * MESSAGE_CHUNK_SIZE).
+    Legacy single-document threads (messages embedded, no doc_type) are still
+    read and are converted to this layout the next time they are saved.
+    """
+
     def __init__(self):
         self.endpoint = settings.AZURE_COSMOS_ENDPOINT
         self.key = settings.AZURE_COSMOS_KEY
@@ -16,62 +88,208 @@ class HistoryService:
         self.client = None
         self.database = None
         self.container = None
-        
+        self.request_charges = RequestChargeStats()
+
+    async def initialize(self) -> None:
         # Initialize only if credentials exist (fail gracefully otherwise for local testing)
-        if self.endpoint and self.key:
-            try:
-                self.client = CosmosClient(self.endpoint, credential=self.key)
-                self.database = self.client.create_database_if_not_exists(id=self.database_name)
-                self.container = self.database.create_container_if_not_exists(
-                    id=self.container_name, 
-                    partition_key=PartitionKey(path="/partition_key"),
-                    offer_throughput=400
-                )
-            except Exception as e:
-                logger.error(f"Failed to initialize Azure Cosmos DB: {e}")
+        if not (self.endpoint and self.key):
+            return
+        try:
+            self.client = CosmosClient(self.endpoint, credential=self.key)
+            self.database = await self.client.create_database_if_not_exists(id=self.database_name)
+            self.container = await self.database.create_container_if_not_exists(
+                id=self.container_name,
+                partition_key=PartitionKey(path="/partition_key"),
+                offer_throughput=400
+            )
+        except Exception as e:
+            logger.error(f"Failed to initialize Azure Cosmos DB: {e}")
+
+    async def close(self) -> None:
+        if self.client:
+            await self.client.close()
+        self.client = None
+        self.database = None
+        self.container = None
 
     def is_configured(self) -> bool:
         return self.container is not None
 
-    def get_user_threads(self, user_id: str) -> List[dict]:
-        """Fetch all threads for a specific user."""
+    @tracer.start_as_current_span("history.get_user_threads")
+    async def get_user_threads(
+        self,
+        user_id: str,
+        limit: int = 50,
+        continuation: Optional[str] = None,
+        updated_since: Optional[str] = None,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """
+        Fetch one page of a user's threads, most recently updated first.
+
+        Args:
+            limit:         Maximum threads to return.
+            continuation:  Token from a previous page, or None for the first page.
+            updated_since: ISO-8601 UTC timestamp; only threads updated after it are returned.
+
+        Returns:
+            (threads, next_continuation) — next_continuation is None on the last page.
+        """
         if not self.is_configured():
-            return []
-            
-        query = "SELECT c.id, c.title, c.created_at, c.updated_at FROM c WHERE c.partition_key = @user_id ORDER BY c.updated_at DESC"
+            return [], None
+
+        query = (
+            "SELECT c.id, c.title, c.created_at, c.updated_at FROM c "
+            "WHERE c.partition_key = @user_id AND (NOT IS_DEFINED(c.doc_type) OR c.doc_type = 'thread')"
+        )
         parameters = [{"name": "@user_id", "value": user_id}]
-        
-        items = list(self.container.query_items(
+        if updated_since:
+            query += " AND c.updated_at > @updated_since"
+            parameters.append({"name": "@updated_since", "value": updated_since})
+        query += " ORDER BY c.updated_at DESC"
+
+        # Scoped to the user's partition: no cross-partition fan-out.
+        items = self.container.query_items(
             query=query,
             parameters=parameters,
-            enable_cross_partition_query=True
-        ))
-        return items
+            partition_key=user_id,
+            max_item_count=limit,
+            response_hook=self._query_hook("get_user_threads"),
+        )
+        pages = items.by_page(_decode_continuation(continuation))
+        try:
+            async for page in pages:
+                threads = [item async for item in page]
+                return threads, _encode_continuation(pages.continuation_token)
+        except exceptions.CosmosHttpResponseError as e:
+            if continuation and e.status_code == 400:
+                raise ValueError("Invalid continuation token") from e
+            raise
+        return [], None
+
+    @tracer.start_as_current_span("history.get_thread")
+    async def get_thread(
+        self, thread_id: str, user_id: str, max_messages: Optional[int] = None
+    ) -> Optional[ChatThreadModel]:
+        """
+        Fetch a specific thread with its message history.
 
-    def get_thread(self, thread_id: str, user_id: str) -> Optional[ChatThreadModel]:
-        """Fetch a specific thread with its full message history."""
+        With `max_messages`, only the newest chunks covering at least that many
+        messages are loaded; `thread.message_offset` tells where they start.
+        """
         if not self.is_configured():
             return None
-            
+
+        header = await self._read_header(thread_id, user_id)
+        if header is None:
+            return None
+
+        if header.get("doc_type") != "thread":
+            # Legacy document with embedded messages; nothing is stored as chunks yet.
+            return ChatThreadModel(**header)
+
+        message_count = header.get("message_count", 0)
+        messages: List[ChatMessageModel] = []
+        offset = message_count
         try:
-            query = "SELECT * FROM c WHERE c.id = @thread_id AND c.partition_key = @user_id"
-            parameters = [{"name": "@thread_id", "value": thread_id}, {"name": "@user_id", "value": user_id}]
-            items = list(self.container.query_items(
-                query=query, parameters=parameters, enable_cross_partition_query=True
-            ))
-            if not items:
-                return None
-            return ChatThreadModel(**items[0])
+            async for chunk_start, chunk in self.iter_message_chunks(thread_id, user_id, message_count):
+                messages[:0] = chunk
+                offset = chunk_start
+                if max_messages is not None and len(messages) >= max_messages:
+                    break
         except Exception as e:
-            logger.error(f"Error fetching thread: {e}")
+            logger.error(f"Error fetching messages for thread {thread_id}: {e}")
             return None
 
-    def save_thread(self, thread: ChatThreadModel) -> ChatThreadModel:
-        """Upsert a thread to Cosmos DB."""
+        thread = ChatThreadModel(**header, messages=messages)
+        thread._message_offset = offset
+        thread._persisted_count = message_count
+        return thread
+
+    async def iter_message_chunks(
+        self, thread_id: str, user_id: str, message_count: int
+    ) -> AsyncIterator[tuple]:
+        """
+        Yield (start_index, messages) for each stored chunk, newest first.
+        Chunks are point-read one at a time, so callers that stop early pay
+        only for what they consumed.
+        """
+        for index in range((message_count - 1) // MESSAGE_CHUNK_SIZE, -1, -1):
+            try:
+                item = await self.container.read_item(item=_chunk_id(thread_id, index), partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError as e:
+                self.request_charges.record("read_messages", e.headers)
+                logger.error(f"Missing message chunk {index} for thread {thread_id}")
+                return
+            self.request_charges.record("read_messages", _response_headers(item))
+            yield index * MESSAGE_CHUNK_SIZE, [ChatMessageModel(**m) for m in item.get("messages", [])]
+
+    @tracer.start_as_current_span("history.save_thread")
+    async def save_thread(self, thread: ChatThreadModel) -> ChatThreadModel:
+        """
+        Persist the thread header and any message chunks holding unsaved
+        messages, in transactional batches on the user's partition.
+        """
         if not self.is_configured():
             return thread
-            
-        self.container.upsert_item(thread.model_dump())
+
+        total = thread.message_count
+        persisted = thread._persisted_count
+        chunk_docs = []
+        if total > persisted:
+            for index in range(persisted // MESSAGE_CHUNK_SIZE, (total - 1) // MESSAGE_CHUNK_SIZE + 1):
+                start = index * MESSAGE_CHUNK_SIZE - thread.message_offset
+                chunk = thread.messages[start:start + MESSAGE_CHUNK_SIZE]
+                chunk_docs.append({
+                    "id": _chunk_id(thread.id, index),
+                    "doc_type": "messages",
+                    "thread_id": thread.id,
+                    "partition_key": thread.partition_key,
+                    "chunk_index": index,
+                    "messages": [m.model_dump() for m in chunk],
+                })
+
+        header = thread.model_dump(exclude={"messages"})
+        header.update({"doc_type": "thread", "message_count": total})
+
+        # The header goes in the last batch so it never points at chunks that are not written yet.
+        operations = [("upsert", (doc,)) for doc in chunk_docs] + [("upsert", (header,))]
+        for i in range(0, len(operations), _MAX_BATCH_OPERATIONS):
+            result = await self.container.execute_item_batch(
+                batch_operations=operations[i:i + _MAX_BATCH_OPERATIONS],
+                partition_key=thread.partition_key,
+            )
+            self.request_charges.record("save_thread", _response_headers(result))
+
+        thread._persisted_count = total
         return thread
 
-history_service = HistoryService()
+    async def _read_header(self, thread_id: str, user_id: str) -> Optional[dict]:
+        try:
+            # id + partition key are known, so this is a ~1 RU point read rather than a query.
+            item = await self.container.read_item(item=thread_id, partition_key=user_id)
+            self.request_charges.record("get_thread", _response_headers(item))
+            return item
+        except exceptions.CosmosResourceNotFoundError as e:
+            self.request_charges.record("get_thread", e.headers)
+            return None
+        except Exception as e:
+            logger.error(f"Error fetching thread: {e}")
+            return None
+
+    def _query_hook(self, operation: str):
+        def hook(headers, result):
+            # query_items also calls the hook once with the pager itself, before any page is fetched.
+            if isinstance(result, list):
+                self.request_charges.record(operation, headers)
+        return hook
+
+
+async def create_history_service() -> HistoryService:
+    """Create and connect the shared HistoryService (called from the app lifespan)."""
+    service = HistoryService()
+    await service.initialize()
+    if service.is_configured():
+        logger.info("Cosmos DB history service connected.")
+    else:
+        logger.warning("Cosmos DB not configured — chat history will not be persisted.")
+    return service
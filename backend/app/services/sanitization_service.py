@@ -2,6 +2,28 @@ import json
 import re
 from typing import Dict, Any, List
 
+# Keyword → jurisdiction code, matched case-insensitively on word boundaries.
+JURISDICTION_KEYWORDS = {
+    "US": ("fcc", "ecfr", "cfr", "usa", "united states"),
+    "CA": ("ised", "rss", "canada", "ic id"),
+    "EU": ("ce", "radio equipment directive", "etsi", "eu", "europe", "european union", "2014/53/eu"),
+    "UK": ("ukca", "ofcom", "uk", "united kingdom"),
+    "MX": ("nom", "ifetel", "ift", "mexico", "méxico"),
+    "BR": ("anatel", "brazil", "brasil", "resolução"),
+    "CN": ("srrc", "miit", "ccc", "china"),
+    "JP": ("mic", "telec", "giteki", "japan", "技術基準適合証明"),
+    "KR": ("kcc", "kc", "rra", "korea"),
+    "AU": ("rcm", "acma", "australia", "new zealand"),
+    "IN": ("bis", "wpc", "india"),
+    "CL": ("subtel", "chile"),
+    "AR": ("enacom", "argentina"),
+}
+
+_JURISDICTION_PATTERNS = {
+    code: re.compile(r"(?<!\w)(?:" + "|".join(re.escape(k) for k in keywords) + r")(?!\w)")
+    for code, keywords in JURISDICTION_KEYWORDS.items()
+}
+
 class SanitizationService:
     """
     Handles extracting, cross-referencing, and sanitizing data from Tier 3 secondary sources.
@@ -19,6 +41,15 @@ class SanitizationService:
             return matches[0]
         return "UNKNOWN_REGULATION_ID"
 
+    @staticmethod
+    def identify_jurisdictions(text: str) -> List[str]:
+        """
+        Returns the sorted jurisdiction codes (e.g. ["MX", "US"]) whose regulators,
+        marks or country names are mentioned in the text.
+        """
+        folded = text.casefold()
+        return sorted(code for code, pattern in _JURISDICTION_PATTERNS.items() if pattern.search(folded))
+
     @staticmethod
     def extract_technical_facts(text: str) -> Dict[str, Any]:
         """
@@ -0,0 +1,148 @@
+"""
+Single-flight coalescing for identical in-flight chat turns.
+
+When a regulation change is in the news, many users send the same question
+within seconds. Turns with the same normalised message and the same context
+(verbatim history, rolling summary and attachment text) share one
+orchestrator run instead of each starting their own: the first request leads,
+later ones await its result. Each request still charges its own user and
+saves its own thread.
+
+A shared result is handed to followers as a copy marked `coalesced`. The run
+happened on the leader's agent thread, so a follower's agent-thread
+bookkeeping is left alone and the turn is synced to its own agent thread on
+its next agent run. A shared run is cancelled once every request waiting on
+it has gone away (client disconnects).
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.services.answer_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+def flight_key(
+    message: str,
+    history: Optional[List[dict]] = None,
+    context_summary: Optional[str] = None,
+    attachment_context: Optional[str] = None,
+) -> str:
+    """sha256 of the normalised message plus a fingerprint of everything else the prompt is built from."""
+    fingerprint = json.dumps(
+        [
+            normalize_query(message),
+            [[turn["role"], turn["content"]] for turn in history or []],
+            context_summary or "",
+            attachment_context or "",
+        ],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+def as_follower_result(result):
+    """A copy of the leader's result, marked as coalesced."""
+    if result is None:
+        return None
+    shared = copy.copy(result)
+    shared.coalesced = True
+    return shared
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._waiting: Dict[asyncio.Future, int] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+    def follow(self, key: str) -> Optional[asyncio.Future]:
+        """The in-flight run for `key`, if any; await it with `wait`."""
+        flight = self._flights.get(key)
+        if flight is not None and not flight.done():
+            self.followers += 1
+            return flight
+        return None
+
+    def lead(self, key: str) -> asyncio.Future:
+        """Register the caller as the leader for `key`; it must call `finish` when done."""
+        flight = asyncio.get_running_loop().create_future()
+        self._register(key, flight)
+        return flight
+
+    def finish(self, key: str, result) -> None:
+        """Publish the leader's result (None when it failed) to its followers."""
+        flight = self._flights.get(key)
+        if flight is not None and not flight.done():
+            flight.set_result(result)
+
+    async def run(self, key: str, fn: Callable[[], Awaitable]):
+        """
+        Return the result of the in-flight run for `key`, or start `fn()` as the
+        shared run. The run is a task of its own, so a leader that goes away
+        does not cancel it for its followers. If the run being followed ends
+        without a result (a failed streaming leader), `fn()` runs after all.
+        """
+        flight = self.follow(key)
+        if flight is not None:
+            result = await self.wait(flight)
+            if result is not None:
+                return as_follower_result(result)
+            # A streaming leader publishes None when its run failed: this turn is still valid, so run it
+            # (followers of the failed leader that get here later share this new run).
+            self.followers -= 1
+            return await self.run(key, fn)
+
+        task = asyncio.create_task(fn())
+        self._register(key, task)
+        return await self.wait(task)
+
+    async def wait(self, flight: asyncio.Future):
+        """
+        Await a flight without cancelling it for the other requests waiting on
+        it. A shared run (a task) is cancelled when its last waiter is.
+        """
+        self._waiting[flight] = self._waiting.get(flight, 0) + 1
+        try:
+            return await asyncio.shield(flight)
+        except asyncio.CancelledError:
+            if self._waiting[flight] == 1 and isinstance(flight, asyncio.Task) and not flight.done():
+                self.abandoned += 1
+                flight.cancel()
+            raise
+        finally:
+            self._waiting[flight] -= 1
+            if not self._waiting[flight]:
+                del self._waiting[flight]
+
+    def stats(self) -> dict:
+        total = self.leaders + self.followers
+        return {
+            "in_flight": len(self._flights),
+            "runs": self.leaders,
+            "coalesced": self.followers,
+            "abandoned": self.abandoned,
+            "coalesced_ratio": round(self.followers / total, 3) if total else None,
+        }
+
+    def _register(self, key: str, flight: asyncio.Future) -> None:
+        self.leaders += 1
+        self._flights[key] = flight
+
+        def _done(f: asyncio.Future) -> None:
+            if self._flights.get(key) is f:
+                del self._flights[key]
+            if not f.cancelled() and f.exception() is not None:
+                logger.warning(f"Shared chat run failed: {f.exception()}")
+
+        flight.add_done_callback(_done)
+
+
+chat_flights = SingleFlight()
@@ -0,0 +1,141 @@
+"""
+Concurrency benchmark for chat history I/O.
+
+Runs many overlapping simulated chat turns (get_thread -> agent run ->
+save_thread) against an in-process fake Cosmos container with fixed
+per-call latency. The "sync" mode reproduces the original service, where
+each Cosmos round-trip blocked the event loop; "async" uses HistoryService
+on the async SDK interface. With blocking I/O the turns serialise behind
+history calls; with async I/O total time stays close to a single turn.
+
+    python bench_history.py                  # 200 chats, 20ms Cosmos, 500ms agent run
+    python bench_history.py 500 0.03 1.0
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from azure.cosmos import exceptions
+
+from app.models.history import ChatMessageModel, ChatThreadModel
+from app.services.history_service import HistoryService
+
+
+class FakeAsyncContainer:
+    """Mimics the azure.cosmos.aio ContainerProxy calls HistoryService makes."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.items = {}
+
+    def query_items(self, query, parameters=None, **kwargs):
+        values = {p["name"]: p["value"] for p in parameters or []}
+
+        async def _results():
+            await asyncio.sleep(self.latency)
+            for (item_id, pk), item in list(self.items.items()):
+                if values.get("@thread_id", item_id) == item_id and values.get("@user_id", pk) == pk:
+                    yield dict(item)
+
+        return _results()
+
+    async def read_item(self, item, partition_key, **kwargs):
+        await asyncio.sleep(self.latency)
+        if (item, partition_key) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity not found")
+        return dict(self.items[(item, partition_key)])
+
+    async def upsert_item(self, body, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.items[(body["id"], body["partition_key"])] = dict(body)
+        return body
+
+    async def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        await asyncio.sleep(self.latency)
+        for _, (body,) in batch_operations:
+            self.items[(body["id"], partition_key)] = dict(body)
+        return [body for _, (body,) in batch_operations]
+
+
+class BlockingHistoryService:
+    """The original behaviour: a synchronous Cosmos call inside the async endpoint."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def get_thread(self, thread_id, user_id):
+        time.sleep(self.latency)
+        return None
+
+    async def save_thread(self, thread):
+        time.sleep(self.latency)
+        return thread
+
+
+def _thread(i: int) -> ChatThreadModel:
+    now = datetime.now(timezone.utc).isoformat()
+    return ChatThreadModel(
+        id=f"thread-{i}",
+        user_id=f"user-{i}",
+        title="FCC Part 15.247 power limits",
+        created_at=now,
+        updated_at=now,
+        messages=[
+            ChatMessageModel(id=f"m-{i}", role="user", content="FCC Part 15.247 power limits", timestamp=now)
+        ],
+    )
+
+
+async def _chat_turn(service, i: int, run_latency: float) -> float:
+    start = time.perf_counter()
+    thread = await service.get_thread(f"thread-{i}", f"user-{i}") or _thread(i)
+    await asyncio.sleep(run_latency)  # agent run
+    await service.save_thread(thread)
+    return time.perf_counter() - start
+
+
+async def _loop_lag(stop: asyncio.Event) -> float:
+    """Largest delay observed scheduling a 10ms ticker — how long the loop was blocked."""
+    worst = 0.0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time.perf_counter() - start - 0.01)
+    return worst
+
+
+async def bench(mode: str, chats: int, cosmos_latency: float, run_latency: float) -> None:
+    if mode == "async":
+        service = HistoryService()
+        service.container = FakeAsyncContainer(cosmos_latency)
+    else:
+        service = BlockingHistoryService(cosmos_latency)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(_loop_lag(stop))
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(_chat_turn(service, i, run_latency) for i in range(chats)))
+    wall = time.perf_counter() - start
+    stop.set()
+    lag = await lag_task
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(
+        f"{mode:<5} {chats} chats | wall {wall:6.2f}s | turn p50 {p50:6.2f}s p99 {p99:6.2f}s | "
+        f"max event-loop stall {lag * 1000:7.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cosmos_latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    run_latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    for mode in ("sync", "async"):
+        asyncio.run(bench(mode, chats, cosmos_latency, run_latency))
@@ -0,0 +1,430 @@
+"""
+Offline load test for the whole request path.
+
+Runs the real create_app() (lifespan, middleware, auth, quotas, history,
+routing, admission, run driver) in-process against fakes for everything that
+would leave the machine:
+
+  - an AIProjectClient whose OpenAI client answers assistant runs after a
+    configurable latency with configurable token usage (plus the direct-route
+    and summary completions and embeddings);
+  - a Cosmos DB container with fixed per-call latency and RU charges;
+  - a local signing key served as the JWKS, with one minted token per user.
+
+Each simulated user opens a conversation (agent run), asks a follow-up
+(direct completion), lists its history, reloads the thread and reads its
+usage. Requests go through httpx's ASGI transport; the report gives req/s and
+latency percentiles per endpoint, so regressions in the request path show up
+on a laptop.
+
+    python bench_load.py                       # 200 users, 50 at a time, 0.5s runs, 10ms Cosmos
+    python bench_load.py 1000 200 1.0 0.02
+    ADMISSION_MAX_CONCURRENT=64 python bench_load.py 500 100
+    QUOTA_BACKEND=sqlite python bench_load.py   # shared quota counters instead of in-process
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+import httpx
+import jwt
+from azure.cosmos import exceptions
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from app.core import auth
+from app.core.config import settings
+from app.core.quota import SQLiteQuotaCounters
+from app.core.usage import TIER_LIMITS, UsageTracker, usage_tracker
+from app.core.usage_store import JsonLogUsageStore
+from app.services import agent_orchestrator, history_service
+
+PROMPT_TOKENS = 1_500
+COMPLETION_TOKENS = 400
+RU_PER_READ = 1.0
+RU_PER_WRITE = 10.0
+
+QUESTIONS = [
+    "What are the FCC Part 15.247 conducted power limits for 2.4 GHz DTS devices? (case {i})",
+    "Which EN 300 328 tests apply to a Bluetooth LE module sold in the EU? (case {i})",
+    "Does a Wi-Fi router need ISED RSS-247 certification for Canada? (case {i})",
+    "What is the MIC certification route for a 5 GHz radio in Japan? (case {i})",
+]
+FOLLOW_UP = "Summarize that as a table."
+
+
+# ── Fake Azure AI Project / OpenAI assistants ────────────────
+
+class _Page:
+    def __init__(self, data):
+        self.data = data
+
+
+def _usage(prompt: int, completion: int):
+    return SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion, total_tokens=prompt + completion)
+
+
+class FakeRuns:
+    """Runs complete `run_latency` seconds after creation."""
+
+    def __init__(self, run_latency: float):
+        self.run_latency = run_latency
+        self._runs = {}
+        self.steps = SimpleNamespace(list=self._list_steps)
+
+    async def create(self, thread_id, assistant_id, **kwargs):
+        run_id = f"run_{uuid.uuid4().hex[:12]}"
+        self._runs[run_id] = {"thread_id": thread_id, "done_at": time.monotonic() + self.run_latency, "status": None}
+        return self._view(run_id)
+
+    async def retrieve(self, thread_id, run_id):
+        return self._view(run_id)
+
+    async def cancel(self, thread_id, run_id):
+        self._runs[run_id]["status"] = "cancelled"
+        return self._view(run_id)
+
+    async def _list_steps(self, thread_id, run_id, **kwargs):
+        done = time.monotonic() >= self._runs[run_id]["done_at"]
+        return _Page([SimpleNamespace(id=f"step_{run_id}", status="completed" if done else "in_progress")])
+
+    def _view(self, run_id):
+        run = self._runs[run_id]
+        status = run["status"] or ("completed" if time.monotonic() >= run["done_at"] else "in_progress")
+        usage = _usage(PROMPT_TOKENS, COMPLETION_TOKENS) if status == "completed" else None
+        return SimpleNamespace(id=run_id, status=status, usage=usage, last_error=None)
+
+
+class FakeThreads:
+    def __init__(self, runs: FakeRuns):
+        self.runs = runs
+        self.messages = SimpleNamespace(create=self._create_message, list=self._list_messages)
+
+    async def create(self, messages=None):
+        return SimpleNamespace(id=f"thread_{uuid.uuid4().hex[:12]}")
+
+    async def delete(self, thread_id):
+        return None
+
+    async def _create_message(self, thread_id, role, content):
+        return SimpleNamespace(id=f"msg_{uuid.uuid4().hex[:12]}")
+
+    async def _list_messages(self, thread_id, run_id=None, **kwargs):
+        citation = SimpleNamespace(
+            type="url_citation", url_citation=SimpleNamespace(url="https://www.ecfr.gov/current/title-47/part-15")
+        )
+        text = SimpleNamespace(
+            value="**Confidence:** HIGH\n\nThe limit is 1 W conducted output power (47 CFR 15.247(b)(3)).",
+            annotations=[citation],
+        )
+        return _Page([SimpleNamespace(role="assistant", content=[SimpleNamespace(type="text", text=text)])])
+
+
+class FakeCompletions:
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    async def create(self, model, messages, stream=False, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = SimpleNamespace(content="| Requirement | Limit |\n|---|---|\n| Conducted power | 1 W |")
+        return SimpleNamespace(
+            model=model, choices=[SimpleNamespace(message=message)], usage=_usage(PROMPT_TOKENS, COMPLETION_TOKENS // 2)
+        )
+
+
+class FakeEmbeddings:
+    async def create(self, model, input):
+        data = []
+        for index, text in enumerate(input):
+            rng = random.Random(hashlib.sha256(text.encode("utf-8")).digest())
+            data.append(SimpleNamespace(index=index, embedding=[rng.gauss(0, 1) for _ in range(64)]))
+        return SimpleNamespace(data=data)
+
+
+class FakeOpenAI:
+    def __init__(self, run_latency: float):
+        runs = FakeRuns(run_latency)
+        self._assistants = {}
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(
+                create=self._create_assistant, update=self._update_assistant, delete=self._delete_assistant,
+                list=self._list_assistants,
+            ),
+            threads=FakeThreads(runs),
+        )
+        # Direct completions take a fraction of a grounded run, as in production.
+        self.chat = SimpleNamespace(completions=FakeCompletions(run_latency / 5))
+        self.embeddings = FakeEmbeddings()
+
+    async def _create_assistant(self, **kwargs):
+        assistant = SimpleNamespace(
+            id=f"asst_{uuid.uuid4().hex[:12]}", name=kwargs.get("name"), metadata=kwargs.get("metadata"),
+            created_at=int(time.time()),
+        )
+        self._assistants[assistant.id] = assistant
+        return assistant
+
+    async def _update_assistant(self, assistant_id, metadata=None):
+        assistant = self._assistants[assistant_id]
+        if metadata is not None:
+            assistant.metadata = metadata
+        return assistant
+
+    async def _delete_assistant(self, assistant_id):
+        self._assistants.pop(assistant_id, None)
+
+    async def _list_assistants(self, **kwargs):
+        for assistant in list(self._assistants.values()):
+            yield assistant
+
+    async def close(self):
+        return None
+
+
+class FakeProjectClient:
+    def __init__(self, run_latency: float):
+        self._openai = FakeOpenAI(run_latency)
+        self.connections = SimpleNamespace(list=self._no_connections)
+
+    async def get_openai_client(self, api_version=None):
+        return self._openai
+
+    async def _no_connections(self):
+        return
+        yield
+
+    async def close(self):
+        return None
+
+
+# ── Fake Cosmos DB container ─────────────────────────────────
+
+class _Item(dict):
+    def __init__(self, data, charge: float):
+        super().__init__(data)
+        self._headers = {"x-ms-request-charge": str(charge)}
+
+    def get_response_headers(self):
+        return self._headers
+
+
+class _Batch(list):
+    def __init__(self, data, charge: float):
+        super().__init__(data)
+        self._headers = {"x-ms-request-charge": str(charge)}
+
+    def get_response_headers(self):
+        return self._headers
+
+
+class _QueryPager:
+    def __init__(self, container, items, page_size, hook):
+        self._container = container
+        self._items = items
+        self._page_size = page_size
+        self._hook = hook
+        self.continuation_token = None
+
+    def by_page(self, continuation_token=None):
+        self._start = int(continuation_token or 0)
+        return self
+
+    def __aiter__(self):
+        return self._pages()
+
+    async def _pages(self):
+        await asyncio.sleep(self._container.latency)
+        end = self._start + self._page_size
+        page = self._items[self._start:end]
+        self.continuation_token = str(end) if end < len(self._items) else None
+        if self._hook:
+            self._hook({"x-ms-request-charge": str(RU_PER_READ * (1 + len(page) / 10))}, page)
+
+        async def _results():
+            for item in page:
+                yield dict(item)
+
+        yield _results()
+
+
+class FakeCosmosContainer:
+    """The azure.cosmos.aio ContainerProxy calls HistoryService makes, with fixed latency per call."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.items = {}
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=50, response_hook=None, **kwargs):
+        values = {p["name"]: p["value"] for p in parameters or []}
+        threads = [
+            item for (_, pk), item in self.items.items()
+            if pk == partition_key and item.get("doc_type", "thread") == "thread"
+            and item.get("updated_at", "") > values.get("@updated_since", "")
+        ]
+        threads.sort(key=lambda item: item.get("updated_at", ""), reverse=True)
+        fields = ("id", "title", "created_at", "updated_at")
+        rows = [{field: item.get(field) for field in fields} for item in threads]
+        return _QueryPager(self, rows, max_item_count, response_hook)
+
+    async def read_item(self, item, partition_key, **kwargs):
+        await asyncio.sleep(self.latency)
+        if (item, partition_key) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Entity not found")
+        return _Item(json.loads(self.items[(item, partition_key)]["_json"]), RU_PER_READ)
+
+    async def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        await asyncio.sleep(self.latency)
+        bodies = [body for _, (body,) in batch_operations]
+        for body in bodies:
+            # Stored serialised, as Cosmos would: callers never share objects with the store.
+            self.items[(body["id"], partition_key)] = {**body, "_json": json.dumps(body)}
+        return _Batch(bodies, RU_PER_WRITE * len(bodies))
+
+
+# ── Local JWKS and tokens ────────────────────────────────────
+
+class LocalJWKS:
+    """Stands in for PyJWKClient: one RSA signing key, and tokens minted with it."""
+
+    KID = "bench-key"
+
+    def __init__(self):
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        public = json.loads(RSAAlgorithm.to_jwk(self._key.public_key()))
+        self._jwk_set = {"keys": [{**public, "kid": self.KID, "use": "sig", "alg": "RS256"}]}
+
+    def get_jwk_set(self, refresh: bool = False) -> jwt.PyJWKSet:
+        return jwt.PyJWKSet.from_dict(self._jwk_set)
+
+    def mint(self, sub: str) -> str:
+        now = int(time.time())
+        claims = {
+            "sub": sub, "name": f"Bench {sub}", "email": f"{sub}@bench.example",
+            "aud": auth.CLIENT_ID, "iss": auth.ISSUER, "iat": now, "exp": now + 3600,
+        }
+        return jwt.encode(claims, self._key, algorithm="RS256", headers={"kid": self.KID})
+
+
+# ── Load generation ──────────────────────────────────────────
+
+async def _timed(http: httpx.AsyncClient, results: dict, label: str, method: str, url: str, **kwargs):
+    start = time.perf_counter()
+    response = await http.request(method, url, **kwargs)
+    results.setdefault(label, []).append((time.perf_counter() - start, response.status_code))
+    return response
+
+
+async def _session(http: httpx.AsyncClient, token: str, i: int, results: dict) -> None:
+    headers = {"Authorization": f"Bearer {token}"}
+    first = await _timed(
+        http, results, "POST /api/chat (agent)", "POST", "/api/chat",
+        data={"message": QUESTIONS[i % len(QUESTIONS)].format(i=i)}, headers=headers,
+    )
+    thread_id = first.json().get("thread_id") if first.status_code == 200 else None
+    if thread_id:
+        await _timed(
+            http, results, "POST /api/chat (direct)", "POST", "/api/chat",
+            data={"message": FOLLOW_UP, "thread_id": thread_id}, headers=headers,
+        )
+    await _timed(http, results, "GET /api/history", "GET", "/api/history", headers=headers)
+    if thread_id:
+        await _timed(http, results, "GET /api/history/{id}", "GET", f"/api/history/{thread_id}", headers=headers)
+    await _timed(http, results, "GET /api/billing/usage", "GET", "/api/billing/usage", headers=headers)
+
+
+def _percentile(ordered: list, q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _report(results: dict, wall: float) -> None:
+    total = sum(len(samples) for samples in results.values())
+    print(f"{'endpoint':<26} {'reqs':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for label, samples in results.items():
+        ordered = sorted(seconds for seconds, _ in samples)
+        errors = sum(1 for _, status in samples if status >= 400)
+        print(
+            f"{label:<26} {len(samples):>6} {errors:>6} {len(samples) / wall:>8.1f} "
+            f"{_percentile(ordered, 0.5) * 1000:>8.1f} {_percentile(ordered, 0.95) * 1000:>8.1f} "
+            f"{_percentile(ordered, 0.99) * 1000:>8.1f}"
+        )
+    print(f"{'total':<26} {total:>6} {'':>6} {total / wall:>8.1f}   wall {wall:.2f}s")
+
+
+async def bench(users: int, concurrency: int, run_latency: float, cosmos_latency: float) -> None:
+    from app.main import create_app
+
+    jwks = LocalJWKS()
+    auth.jwks_cache._client = jwks
+    container = FakeCosmosContainer(cosmos_latency)
+
+    async def create_kernel():
+        return FakeProjectClient(run_latency)
+
+    async def create_history_service():
+        service = history_service.HistoryService()
+        service.container = container
+        return service
+
+    # The lifespan imports these at startup, so the fakes are picked up from the modules.
+    agent_orchestrator.create_kernel = create_kernel
+    history_service.create_history_service = create_history_service
+
+    tokens = [jwks.mint(f"bench-user-{i}") for i in range(users)]
+    for i in range(users):
+        # Elite: unlimited quota, so the load is not cut short by 429s.
+        usage_tracker.set_tier(f"bench-user-{i}", "elite", email=f"bench-user-{i}@bench.example")
+
+    settings.STATS_TOKEN = settings.STATS_TOKEN or uuid.uuid4().hex  # the report reads /stats
+    app = create_app()
+    results = {}
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> None:
+        async with gate:
+            await _session(http, tokens[i], i, results)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+            start = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(users)))
+            wall = time.perf_counter() - start
+            health = (await http.get("/stats", headers={"Authorization": f"Bearer {settings.STATS_TOKEN}"})).json()
+
+    print(
+        f"{users} users, {concurrency} concurrent | agent run {run_latency * 1000:.0f}ms | "
+        f"Cosmos call {cosmos_latency * 1000:.0f}ms"
+    )
+    _report(results, wall)
+    print(
+        f"runs {health['agent']['runs']['runs']} (avg polls {health['agent']['runs']['avg_polls']}) | "
+        f"admission max wait {max(t['max_wait_s'] for t in health['admission']['tiers'].values())}s | "
+        f"Cosmos RU {sum(op['total_ru'] for op in health['cosmos_ru'].values()):.0f}"
+    )
+
+
+if __name__ == "__main__":
+    logging.disable(logging.WARNING)
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    run_latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    cosmos_latency = float(sys.argv[4]) if len(sys.argv) > 4 else 0.01
+
+    # Bench users go to a throwaway usage store, not data/.
+    with tempfile.TemporaryDirectory() as tmp:
+        if isinstance(usage_tracker, UsageTracker):
+            usage_tracker.__init__(JsonLogUsageStore(os.path.join(tmp, "usage.json"), os.path.join(tmp, "usage.log")))
+        else:
+            usage_tracker.__init__(SQLiteQuotaCounters(os.path.join(tmp, "quota.db")), TIER_LIMITS)
+        asyncio.run(bench(users, concurrency, run_latency, cosmos_latency))
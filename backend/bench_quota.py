@@ -0,0 +1,208 @@
+"""
+Correctness and latency check for the shared quota counters (QUOTA_BACKEND).
+
+Imports a small legacy usage store, then has many threads run chat turns
+against one free-tier user at once: reserve QUOTA_RESERVE_TOKENS, charge the
+turn's tokens (or release the reservation for every fifth turn), until
+reservations are refused. Afterwards no tokens may still be reserved, the
+tokens charged may overshoot the daily limit by less than one turn, and the
+imported paid user must keep its tier and today's usage.
+
+The Cosmos DB backend runs against an in-process container that implements
+patch `incr`, filter predicates and the 404/409/412 errors, unless --live is
+given: then a temporary container is created in AZURE_COSMOS_DATABASE (the
+Cosmos DB emulator works; its certificate must be trusted) and deleted
+afterwards.
+
+    python bench_quota.py                 # sqlite + dry-run cosmos, 32 threads
+    python bench_quota.py 64              # custom thread count
+    python bench_quota.py --live          # sqlite + a real Cosmos DB account/emulator
+"""
+
+import copy
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from azure.cosmos import exceptions
+
+from app.core.config import settings
+from app.core.quota import CosmosQuotaCounters, SharedUsageTracker, SQLiteQuotaCounters, create_quota_counters
+from app.core.usage import TIER_LIMITS
+
+TURN_TOKENS = 700
+RELEASE_EVERY = 5
+
+_PREDICATE = re.compile(r"^FROM c WHERE c\.used \+ c\.reserved < (\d+)$")
+
+
+class FakeQuotaContainer:
+    """The ContainerProxy calls CosmosQuotaCounters makes, with Cosmos DB's semantics."""
+
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+        self.patches = 0
+        self.precondition_failures = 0
+
+    def read_item(self, item, partition_key):
+        with self._lock:
+            return copy.deepcopy(self._get(partition_key, item))
+
+    def create_item(self, body):
+        with self._lock:
+            key = (body["sub"], body["id"])
+            if key in self._items:
+                raise exceptions.CosmosResourceExistsError(status_code=409, message="Conflict")
+            self._items[key] = copy.deepcopy(body)
+            return copy.deepcopy(body)
+
+    def upsert_item(self, body):
+        with self._lock:
+            self._items[(body["sub"], body["id"])] = copy.deepcopy(body)
+            return copy.deepcopy(body)
+
+    def patch_item(self, item, partition_key, patch_operations, filter_predicate=None):
+        with self._lock:
+            self.patches += 1
+            doc = self._get(partition_key, item)
+            if filter_predicate is not None:
+                match = _PREDICATE.match(filter_predicate)
+                if match is None:
+                    raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Bad predicate {filter_predicate}")
+                if not doc["used"] + doc["reserved"] < int(match.group(1)):
+                    self.precondition_failures += 1
+                    raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+            for op in patch_operations:
+                if op["op"] != "incr":
+                    raise exceptions.CosmosHttpResponseError(status_code=400, message=f"Unsupported op {op['op']}")
+                field = op["path"].lstrip("/")
+                doc[field] = doc.get(field, 0) + op["value"]
+            return copy.deepcopy(doc)
+
+    def query_items(self, query, parameters, enable_cross_partition_query=False):
+        email_key = parameters[0]["value"]
+        with self._lock:
+            profiles = [d for d in self._items.values() if d.get("doc_type") == "profile" and d.get("email_key") == email_key]
+        profiles.sort(key=lambda d: d.get("created_at") or "")
+        return iter([{"sub": d["sub"], "profile": copy.deepcopy(d["profile"])} for d in profiles[:1]])
+
+    def _get(self, sub, item_id):
+        try:
+            return self._items[(sub, item_id)]
+        except KeyError:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found") from None
+
+
+def _legacy_records():
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    return [
+        ("paid-user", {"email": "Paid@Example.com", "name": "Paid", "tier": "pro", "payment_provider": "dodo",
+                       "tokens_used_today": 4_321, "last_query_date": today, "created_at": "2025-01-01T00:00:00"}),
+        ("stale-user", {"email": "stale@example.com", "name": "Stale", "tier": "free",
+                        "tokens_used_today": 9_000, "last_query_date": "2020-01-01", "created_at": "2020-01-01T00:00:00"}),
+    ]
+
+
+def _turn(tracker: SharedUsageTracker, sub: str, n: int, latencies: list) -> bool:
+    start = time.perf_counter()
+    reservation = tracker.reserve(sub, settings.QUOTA_RESERVE_TOKENS)
+    if reservation is None:
+        return False
+    if n % RELEASE_EVERY == 0:
+        tracker.release(reservation)
+    else:
+        tracker.record_usage(sub, TURN_TOKENS, reservation)
+    latencies.append(time.perf_counter() - start)
+    return True
+
+
+def check(name: str, counters, threads: int) -> bool:
+    tracker = SharedUsageTracker(counters, TIER_LIMITS)
+    problems = []
+
+    if tracker.needs_import():
+        tracker.import_records(_legacy_records(), source="bench")
+    if tracker.needs_import() or tracker.import_records(_legacy_records(), source="bench") != 0:
+        problems.append("import is not idempotent")
+    paid = tracker.get_user("paid-user")
+    if not paid or paid["tier"] != "pro" or paid["tokens_used_today"] != 4_321:
+        problems.append(f"imported paid user wrong: {paid}")
+    if tracker.get_user("stale-user")["tokens_used_today"] != 0:
+        problems.append("yesterday's usage was imported as today's")
+    found = tracker.find_user_by_email("paid@EXAMPLE.com")
+    if not found or found[0] != "paid-user":
+        problems.append(f"email lookup failed: {found}")
+
+    sub = f"bench-{uuid.uuid4().hex[:8]}"
+    tracker.ensure_user(sub, name="Bench", email=f"{sub}@example.com")
+    limit = TIER_LIMITS["free"]
+    latencies = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        def worker(w):
+            turns = 0
+            while _turn(tracker, sub, w + turns * threads, latencies):
+                turns += 1
+            return turns
+        granted = sum(pool.map(worker, range(threads)))
+    wall = time.perf_counter() - start
+
+    used, reserved = counters.get_counter(sub, tracker._today())
+    if reserved != 0:
+        problems.append(f"{reserved} tokens still reserved")
+    if not limit - TURN_TOKENS <= used < limit + TURN_TOKENS:
+        problems.append(f"charged {used} tokens against a {limit} limit")
+    if tracker.check_budget(sub)[0]:
+        problems.append("budget still open after reservations were refused")
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1e3 if latencies else 0.0
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e3 if latencies else 0.0
+    print(
+        f"{name:<14} {threads:>3} threads | {granted:>4} turns in {wall:6.2f}s | charged {used:>6} / {limit} | "
+        f"turn p50 {p50:7.2f}ms p99 {p99:7.2f}ms | {tracker.stats()}"
+    )
+    for problem in problems:
+        print(f"  FAIL: {problem}")
+    return not problems
+
+
+def _live_cosmos():
+    settings.QUOTA_COSMOS_CONTAINER = f"QuotaCheck-{uuid.uuid4().hex[:8]}"
+    return create_quota_counters("cosmos", "")
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    threads = int(args[0]) if args else 32
+    ok = True
+
+    with tempfile.TemporaryDirectory() as workdir:
+        counters = SQLiteQuotaCounters(os.path.join(workdir, "quota.db"))
+        ok &= check("sqlite", counters, threads)
+        counters.close()
+
+    if "--live" in sys.argv:
+        counters = _live_cosmos()
+        try:
+            ok &= check("cosmos (live)", counters, threads)
+        finally:
+            from azure.cosmos import CosmosClient
+
+            client = CosmosClient(settings.AZURE_COSMOS_ENDPOINT, credential=settings.AZURE_COSMOS_KEY)
+            client.get_database_client(settings.AZURE_COSMOS_DATABASE).delete_container(settings.QUOTA_COSMOS_CONTAINER)
+    else:
+        container = FakeQuotaContainer()
+        ok &= check("cosmos (fake)", CosmosQuotaCounters(container), threads)
+        print(f"{'':<14} fake container: {container.patches} patches, {container.precondition_failures} 412s")
+
+    sys.exit(0 if ok else 1)
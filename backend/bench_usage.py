@@ -0,0 +1,172 @@
+"""
+Per-call latency benchmark for the usage stores and the write-behind tracker.
+
+Seeds N users into a temporary store, then, against random existing users:
+
+  - store rows time the UsageStore directly: a read (get) and a
+    read-modify-write persisted per call (get + put_many), which is what a
+    charge cost before the write-behind cache. The legacy backend re-reads/
+    rewrites the whole JSON file per call, as UsageTracker did originally;
+    it is only run for small N.
+  - tracker rows time UsageTracker in front of the jsonlog and sqlite stores:
+    the calls a chat request makes (ensure_user, check_budget, record_usage),
+    the billing webhook's find_user_by_email, and one flush() of everything
+    the calls left dirty. The email index is checked for consistency after.
+
+    python bench_usage.py                 # 10k and 1M users
+    python bench_usage.py 10000 100000    # custom sizes
+"""
+
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+
+from app.core.usage import UsageTracker
+from app.core.usage_store import JsonLogUsageStore, SQLiteUsageStore, UsageStore
+
+CALLS = 2_000
+LEGACY_MAX_USERS = 10_000
+
+
+class LegacyJsonFileStore(UsageStore):
+    """Reproduces the original behaviour: full parse per read, full rewrite per write."""
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def _read(self) -> dict:
+        with open(self._path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def get(self, sub):
+        return self._read().get(sub)
+
+    def put(self, sub, record):
+        data = self._read()
+        data[sub] = record
+        with open(self._path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+    def items(self):
+        return iter(self._read().items())
+
+
+def _record(i: int) -> dict:
+    return {
+        "email": f"user{i}@example.com",
+        "name": f"User {i}",
+        "tier": "free",
+        "payment_provider": None,
+        "payment_customer_id": None,
+        "tokens_used_today": 0,
+        "last_query_date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _seed_json(path: str, n: int) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({f"sub-{i}": _record(i) for i in range(n)}, f)
+
+
+def _seed_sqlite(path: str, n: int) -> None:
+    SQLiteUsageStore(path).close()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO user_usage (sub, record) VALUES (?, ?)",
+            ((f"sub-{i}", json.dumps(_record(i))) for i in range(n)),
+        )
+    conn.close()
+
+
+def _build(backend: str, n: int, workdir: str) -> UsageStore:
+    if backend == "jsonlog":
+        snapshot = os.path.join(workdir, "user_usage.json")
+        _seed_json(snapshot, n)
+        return JsonLogUsageStore(snapshot, os.path.join(workdir, "user_usage.log"))
+    if backend == "sqlite":
+        db = os.path.join(workdir, "user_usage.db")
+        _seed_sqlite(db, n)
+        return SQLiteUsageStore(db)
+    path = os.path.join(workdir, "legacy.json")
+    _seed_json(path, n)
+    return LegacyJsonFileStore(path)
+
+
+def _time_calls(fn, subs) -> float:
+    """Mean microseconds per call."""
+    start = time.perf_counter()
+    for sub in subs:
+        fn(sub)
+    return (time.perf_counter() - start) / len(subs) * 1e6
+
+
+def _charge(store: UsageStore, sub: str) -> None:
+    record = store.get(sub)
+    record["tokens_used_today"] += 100
+    store.put_many({sub: record})
+
+
+def bench_store(backend: str, n: int) -> None:
+    with tempfile.TemporaryDirectory() as workdir:
+        load_start = time.perf_counter()
+        store = _build(backend, n, workdir)
+        load_s = time.perf_counter() - load_start
+
+        calls = CALLS if backend != "legacy" else 50
+        subs = [f"sub-{random.randrange(n)}" for _ in range(calls)]
+        read = _time_calls(store.get, subs)
+        charge = _time_calls(lambda s: _charge(store, s), subs)
+        store.close()
+
+    print(
+        f"store   {backend:<8} {n:>9,} users | seed+load {load_s:7.2f}s | "
+        f"get {read:9.1f}us | get+put_many {charge:9.1f}us"
+    )
+
+
+def bench_tracker(backend: str, n: int) -> None:
+    with tempfile.TemporaryDirectory() as workdir:
+        load_start = time.perf_counter()
+        tracker = UsageTracker(store=_build(backend, n, workdir), flush_max_pending=CALLS * 4)
+        load_s = time.perf_counter() - load_start
+
+        subs = [f"sub-{random.randrange(n)}" for _ in range(CALLS)]
+        ensure = _time_calls(lambda s: tracker.ensure_user(s), subs)
+        check = _time_calls(lambda s: tracker.check_budget(s), subs)
+        record = _time_calls(lambda s: tracker.record_usage(s, 100), subs)
+        emails = [f"USER{sub[4:]}@Example.com" for sub in subs]
+        lookup = _time_calls(lambda e: tracker.find_user_by_email(e), emails)
+        pending = tracker.stats()["pending"]
+        flush_start = time.perf_counter()
+        tracker.flush()
+        flush_ms = (time.perf_counter() - flush_start) * 1e3
+        problems = tracker.check_email_index()
+        tracker.close()
+
+    print(
+        f"tracker {backend:<8} {n:>9,} users | seed+load {load_s:7.2f}s | "
+        f"ensure_user {ensure:9.1f}us | check_budget {check:9.1f}us | record_usage {record:9.1f}us | "
+        f"find_user_by_email {lookup:9.1f}us | flush of {pending} records {flush_ms:8.1f}ms"
+    )
+    if problems:
+        print(f"  email index inconsistent: {problems[:5]}")
+
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]] or [10_000, 1_000_000]
+    for n in sizes:
+        for backend in ("jsonlog", "sqlite", "legacy"):
+            if backend == "legacy" and n > LEGACY_MAX_USERS:
+                continue
+            bench_store(backend, n)
+        for backend in ("jsonlog", "sqlite"):
+            bench_tracker(backend, n)
@@ -1,20 +1,24 @@
+import asyncio
 import os
 import sys
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
-from app.services.history_service import history_service
+from app.services.history_service import create_history_service
 
-def drop_container():
+async def drop_container():
+    history_service = await create_history_service()
     if not history_service.is_configured():
         print("Cosmos DB is not configured.")
         return
 
     try:
-        history_service.database.delete_container(history_service.container_name)
+        await history_service.database.delete_container(history_service.container_name)
         print(f"Successfully deleted container {history_service.container_name}. It will be recreated on next app startup.")
     except Exception as e:
         print(f"Failed to delete container: {e}")
+    finally:
+        await history_service.close()
 
 if __name__ == "__main__":
-    drop_container()
+    asyncio.run(drop_container())
@@ -0,0 +1,56 @@
+import asyncio
+
+from app.services.attachment_index import ChunkIndex
+from app.services.attachment_service import ExtractedAttachment
+from app.services.embeddings import LocalHashEmbedder
+
+SECTIONS = {
+    "radio": "Bluetooth Low Energy transmitters use three advertising channels in the 2.4 GHz band. ",
+    "safety": "Mains powered equipment needs reinforced insulation and a touch current test. ",
+    "labelling": "The rating plate shows the manufacturer name, model number and supply voltage. ",
+    "battery": "Lithium cells are shipped at a reduced state of charge with UN 38.3 test reports. ",
+}
+
+
+def _report() -> ExtractedAttachment:
+    text = "\n\n".join(sentence * 60 for sentence in SECTIONS.values())
+    return ExtractedAttachment("a" * 64, "report.pdf", text, cached=False)
+
+
+def test_context_holds_the_chunk_matching_the_question(tmp_path):
+    index = ChunkIndex(embedder=LocalHashEmbedder(), index_dir=str(tmp_path))
+    report = _report()
+
+    async def run():
+        document = await index.add_document(report)
+        question = "How many advertising channels does Bluetooth Low Energy use?"
+        context = await index.context_for([report.sha256], question, budget_tokens=900)
+        return document, context
+
+    document, context = asyncio.run(run())
+
+    assert len(document.chunks) > 1
+    assert context.startswith("[Attachment: report.pdf, excerpt")
+    assert "advertising channels" in context
+    assert "rating plate" not in context
+    assert index.searches == 1
+
+
+def test_vectors_from_another_embedder_are_rebuilt(tmp_path):
+    report = _report()
+    first = ChunkIndex(embedder=LocalHashEmbedder(dim=512), index_dir=str(tmp_path))
+    asyncio.run(first.add_document(report))
+
+    # A new process with a different embedder finds only the old vectors on disk.
+    second = ChunkIndex(embedder=LocalHashEmbedder(dim=256), index_dir=str(tmp_path))
+    context = asyncio.run(second.context_for([report.sha256], "reinforced insulation touch current", budget_tokens=900))
+
+    assert "reinforced insulation" in context
+    assert second.documents_indexed == 1
+    stored = second._read(report.sha256)
+    assert stored.embedder == "local-hash:256"
+    assert stored.vectors.shape == (len(stored.chunks), 256)
+
+    # Vectors already in this embedder's space are reused, not embedded again.
+    asyncio.run(second.context_for([report.sha256], "rating plate", budget_tokens=900))
+    assert second.documents_indexed == 1
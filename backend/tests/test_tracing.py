@@ -0,0 +1,88 @@
+import asyncio
+
+import httpx
+
+import bench_load
+from app.core import auth
+from app.core.tracing import configure_tracing
+from app.core.usage import UsageTracker, usage_tracker
+from app.core.usage_store import JsonLogUsageStore
+from app.services import agent_orchestrator, history_service
+
+
+def _tree(spans) -> dict:
+    """Span name -> names of its direct children."""
+    by_id = {span.context.span_id: span for span in spans}
+    children = {span.name: [] for span in spans}
+    for span in spans:
+        if span.parent is not None and span.parent.span_id in by_id:
+            children[by_id[span.parent.span_id].name].append(span.name)
+    return children
+
+
+def test_chat_turn_spans_nest_under_the_request(tmp_path, monkeypatch):
+    exporter = configure_tracing("memory")
+    exporter.clear()
+
+    jwks = bench_load.LocalJWKS()
+    container = bench_load.FakeCosmosContainer(0)
+
+    async def create_kernel():
+        return bench_load.FakeProjectClient(0.01)
+
+    async def create_history_service():
+        service = history_service.HistoryService()
+        service.container = container
+        return service
+
+    monkeypatch.setattr(auth.jwks_cache, "_client", jwks)
+    monkeypatch.setattr(agent_orchestrator, "create_kernel", create_kernel)
+    monkeypatch.setattr(history_service, "create_history_service", create_history_service)
+    if isinstance(usage_tracker, UsageTracker):
+        usage_tracker.__init__(JsonLogUsageStore(str(tmp_path / "usage.json"), str(tmp_path / "usage.log")))
+
+    async def run():
+        from app.main import create_app
+
+        app = create_app()
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+                return await http.post(
+                    "/api/chat",
+                    data={"message": "Which EN 300 328 tests apply to a Bluetooth LE module?"},
+                    headers={"Authorization": f"Bearer {jwks.mint('trace-user')}"},
+                )
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+
+    spans = exporter.get_finished_spans()
+    roots = [s for s in spans if s.name == "POST /api/chat"]
+    assert len(roots) == 1
+    root = roots[0]
+    assert root.attributes["http.route"] == "/api/chat"
+    assert root.attributes["http.response.status_code"] == 200
+
+    turn = [s for s in spans if s.context.trace_id == root.context.trace_id]
+    assert all(s.parent is not None for s in turn if s is not root)
+    tree = _tree(turn)
+    assert tree["POST /api/chat"] == [
+        "auth.verify_token",
+        "usage.ensure_user",
+        "usage.check_budget",
+        "usage.reserve",
+        "chat.extract_attachment",
+        "chat.start_turn",
+        "chat.attachment_context",
+        "chat.answer_cache",
+        "agent.process_turn",
+        "chat.finish_turn",
+    ]
+    assert tree["agent.process_turn"] == [
+        "agent.classify", "agent.get_assistant", "agent.prepare_thread", "agent.run", "agent.list_messages",
+    ]
+    assert tree["chat.finish_turn"] == ["usage.record_usage", "history.save_thread"]
+
+    run_span = next(s for s in turn if s.name == "agent.run")
+    assert run_span.attributes["llm.total_tokens"] == bench_load.PROMPT_TOKENS + bench_load.COMPLETION_TOKENS
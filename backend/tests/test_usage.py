@@ -0,0 +1,65 @@
+import threading
+import time
+
+from app.core.usage import UsageTracker
+from app.core.usage_store import SQLiteUsageStore
+
+
+class SlowToAcquireLock:
+    """A store lock that the thread named "older" only gets after a delay, so a later flush can try to overtake it."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if threading.current_thread().name == "older":
+            time.sleep(0.2)
+        self._lock.acquire()
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+def test_concurrent_flushes_keep_the_newest_record(tmp_path):
+    store = SQLiteUsageStore(str(tmp_path / "usage.db"))
+    tracker = UsageTracker(store=store, flush_max_pending=10_000, cache_max_entries=0)
+    tracker._store_lock = SlowToAcquireLock()
+    tracker.ensure_user("sub-1", email="one@example.com")
+
+    tracker.record_usage("sub-1", 100)
+    older = threading.Thread(target=tracker.flush, name="older")
+    older.start()
+    time.sleep(0.05)  # the older flush has taken its snapshot
+    tracker.record_usage("sub-1", 250)
+    newer = threading.Thread(target=tracker.flush, name="newer")
+    newer.start()
+    older.join(timeout=5)
+    newer.join(timeout=5)
+
+    assert store.get("sub-1")["tokens_used_today"] == 350
+    # cache_max_entries=0 evicts every flushed record, so this reload reads the store.
+    assert "sub-1" not in tracker._records
+    assert tracker.get_user("sub-1")["tokens_used_today"] == 350
+    assert tracker.stats()["pending"] == 0
+    tracker.close()
+
+
+def test_email_index_follows_an_email_change_in_set_tier(tmp_path):
+    path = str(tmp_path / "usage.db")
+    tracker = UsageTracker(store=SQLiteUsageStore(path))
+    tracker.ensure_user("sub-1", email="old@example.com")
+    tracker.ensure_user("sub-2", email="other@example.com")
+
+    tracker.set_tier("sub-1", "pro", provider="dodo", email="New@Example.com")
+
+    assert tracker.check_email_index() == []
+    assert tracker.find_user_by_email("old@example.com") is None
+    assert tracker.find_user_by_email("new@example.COM")[0] == "sub-1"
+    assert tracker.find_user_by_email("other@example.com")[0] == "sub-2"
+    tracker.close()
+
+    # set_tier flushed, so a restart rebuilds the same index from the store.
+    reopened = UsageTracker(store=SQLiteUsageStore(path))
+    assert reopened.find_user_by_email("new@example.com")[0] == "sub-1"
+    assert reopened.find_user_by_email("old@example.com") is None
+    reopened.close()
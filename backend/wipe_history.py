@@ -1,18 +1,20 @@
+import asyncio
 import os
 import sys
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__))))
 
-from app.services.history_service import history_service
+from app.services.history_service import create_history_service
 
-def wipe_history():
+async def wipe_history():
+    history_service = await create_history_service()
     if not history_service.is_configured():
         print("Cosmos DB is not configured.")
         return
 
     container = history_service.container
     query = "SELECT * FROM c"
-    items = list(container.query_items(query=query, enable_cross_partition_query=True))
+    items = [item async for item in container.query_items(query=query)]
     
     print(f"Found {len(items)} items to delete.")
     
@@ -25,13 +27,14 @@ def wipe_history():
         
         print(f"Attempting to delete {item['id']} with partition key '{pkey}'")
         try:
-            container.delete_item(item=item['id'], partition_key=pkey)
+            await container.delete_item(item=item['id'], partition_key=pkey)
             deleted_count += 1
             print(f" -> Success")
         except Exception as e:
             print(f" -> Failed: {e}")
             
     print(f"Successfully deleted {deleted_count} records.")
+    await history_service.close()
 
 if __name__ == "__main__":
-    wipe_history()
+    asyncio.run(wipe_history())